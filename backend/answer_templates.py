@@ -0,0 +1,156 @@
+"""
+Deterministic answers for scalar and small tabular aggregation results.
+
+Pipelines ending in $count, or a $group that returns a handful of flat rows, are
+answered from templates ("There are 412 matching records.") instead of a
+second LLM round trip. Results that contain nested documents, long text or more
+than TEMPLATE_ANSWER_MAX_ROWS rows still go to the LLM. Set
+TEMPLATE_ANSWERS_ENABLED=false to have the LLM phrase every answer.
+"""
+import logging
+import os
+import re
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+from bson import Decimal128, ObjectId
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_ANSWERS_ENABLED = os.getenv("TEMPLATE_ANSWERS_ENABLED", "true").lower() == "true"
+TEMPLATE_ANSWER_MAX_ROWS = int(os.getenv("TEMPLATE_ANSWER_MAX_ROWS", "10"))
+
+# Stages whose output rows are aggregates rather than stored documents.
+_AGGREGATE_STAGES = {"$group", "$count", "$sortByCount", "$bucket", "$bucketAuto"}
+_MAX_TEXT_CHARS = 100
+_CAMEL_RE = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+
+
+def _stage_name(stage: Dict[str, Any]) -> Optional[str]:
+    return next(iter(stage)) if isinstance(stage, dict) and len(stage) == 1 else None
+
+
+def _label(name: str) -> str:
+    """'avgProcessingTime' / 'unsafe_count' -> 'Avg processing time' / 'Unsafe count'."""
+    words = _CAMEL_RE.sub(" ", name).replace("_", " ").replace(".", " ").split()
+    text = " ".join(words).lower()
+    return text[:1].upper() + text[1:]
+
+
+def _is_scalar(value: Any) -> bool:
+    if isinstance(value, str):
+        return len(value) <= _MAX_TEXT_CHARS
+    return value is None or isinstance(value, (bool, int, float, Decimal, Decimal128, ObjectId, datetime, date))
+
+
+def _format(value: Any) -> str:
+    if value is None:
+        return "none"
+    if isinstance(value, bool):
+        return "yes" if value else "no"
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    if isinstance(value, Decimal):
+        value = float(value)
+    if isinstance(value, int):
+        return f"{value:,}"
+    if isinstance(value, float):
+        if value.is_integer():
+            return f"{int(value):,}"
+        return f"{value:,.2f}" if abs(value) >= 1 else f"{value:.3g}"
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ", timespec="seconds")
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def _format_key(key: Any) -> str:
+    if isinstance(key, dict):
+        return ", ".join(_format(v) for v in key.values())
+    return _format(key)
+
+
+def _group_key_label(pipeline: List[Dict[str, Any]]) -> Optional[str]:
+    """Label of the last grouping key when it is a plain field path."""
+    for stage in reversed(pipeline):
+        name = _stage_name(stage)
+        if name == "$group":
+            key = stage["$group"].get("_id")
+        elif name == "$sortByCount":
+            key = stage["$sortByCount"]
+        else:
+            continue
+        if isinstance(key, str) and key.startswith("$") and not key.startswith("$$"):
+            return _label(key[1:].rsplit(".", 1)[-1])
+        return None
+    return None
+
+
+def _plain_rows(data: List[Any]) -> bool:
+    for row in data:
+        if not isinstance(row, dict) or not row:
+            return False
+        for field, value in row.items():
+            if field == "_id" and isinstance(value, dict):
+                if not all(_is_scalar(v) for v in value.values()):
+                    return False
+            elif not _is_scalar(value):
+                return False
+    return True
+
+
+def _render_rows(rows: List[Dict[str, Any]], pipeline: List[Dict[str, Any]]) -> str:
+    values = [f for f in rows[0] if f != "_id"]
+    single_value = "_id" in rows[0] and len(values) == 1 and all(list(r) == list(rows[0]) for r in rows)
+
+    lines = []
+    for row in rows:
+        fields = [f for f in row if f != "_id"]
+        if single_value:
+            body = _format(row[fields[0]])
+        else:
+            body = ", ".join(f"{_label(f).lower()} {_format(row[f])}" for f in fields)
+        lines.append(f"- {_format_key(row['_id'])}: {body}" if "_id" in row else f"- {body}")
+
+    key_label = _group_key_label(pipeline)
+    if single_value and key_label:
+        header = f"{_label(values[0])} by {key_label.lower()}:"
+    elif key_label:
+        header = f"Results by {key_label.lower()}:"
+    else:
+        header = "Results:"
+    return "\n".join([header] + lines)
+
+
+def render_answer(data: Any, pipeline: Optional[List[Dict[str, Any]]]) -> Optional[str]:
+    """
+    Answer text for the results of `pipeline`, or None when the result needs the
+    LLM to phrase it.
+    """
+    if not TEMPLATE_ANSWERS_ENABLED or not pipeline or not isinstance(data, list):
+        return None
+    stages = {_stage_name(stage) for stage in pipeline}
+    ends_in_count = _stage_name(pipeline[-1]) == "$count"
+
+    if not data:
+        # $count emits no document at all when nothing matched.
+        return "There are 0 matching records." if ends_in_count else "No matching records were found."
+    if not stages & _AGGREGATE_STAGES or len(data) > TEMPLATE_ANSWER_MAX_ROWS or not _plain_rows(data):
+        return None
+
+    if ends_in_count and len(data) == 1 and len(data[0]) == 1:
+        count = next(iter(data[0].values()))
+        if isinstance(count, int) and not isinstance(count, bool):
+            return "There is 1 matching record." if count == 1 else f"There are {count:,} matching records."
+
+    if len(data) == 1 and data[0].get("_id") is None:
+        # A single overall $group: one line per accumulator.
+        fields = [f for f in data[0] if f != "_id"]
+        if not fields:
+            return None
+        lines = [f"{_label(f)}: {_format(data[0][f])}" for f in fields]
+        return lines[0] + "." if len(lines) == 1 else "\n".join(lines)
+
+    return _render_rows(data, pipeline)
@@ -0,0 +1,100 @@
+"""
+Query latency before and after applying the index advisor's recommendations.
+
+Seeds a local mongod with N synthetic moderation events (skipped when the
+collection already holds N documents), runs a fixed set of typical generated
+pipelines with no secondary indexes, lets the advisor observe and explain them,
+creates the recommended indexes and runs the same pipelines again.
+
+    cd backend
+    MONGO_URL=mongodb://127.0.0.1:27017 python benchmarks/bench_index_advisor.py --docs 5000000
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PIPELINES = {
+    "count_nudity_true": [
+        {"$match": {"processStatus.featureStatus.Nudity": True}},
+        {"$count": "n"},
+    ],
+    "org_unsafe_in_range": [
+        {"$match": {"orgId": "org007", "safe": False,
+                    "eventStartTime": {"$gte": datetime(2025, 6, 10), "$lt": datetime(2025, 6, 17)}}},
+        {"$count": "n"},
+    ],
+    "latest_minor_events": [
+        {"$match": {"processStatus.featureStatus.Minor": True}},
+        {"$sort": {"eventStartTime": -1}},
+        {"$limit": 20},
+    ],
+    "avg_minor_time_for_org": [
+        {"$match": {"orgId": "org012"}},
+        {"$group": {"_id": None, "avg": {"$avg": {"$toDouble": "$eventLog.Minor.report.documentReport.report.MediaProcessingTimeInSeconds"}}}},
+    ],
+}
+
+
+async def _measure(collection, repeats: int) -> dict:
+    out = {}
+    for name, pipeline in PIPELINES.items():
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            await collection.aggregate(pipeline).to_list(length=100)
+            timings.append((time.perf_counter() - started) * 1000)
+        out[name] = {"p50_ms": round(statistics.median(timings), 1), "max_ms": round(max(timings), 1)}
+    return out
+
+
+async def main_async(args) -> None:
+    import index_advisor
+    from benchmarks.synthetic import seed
+    from db import get_db
+
+    collection = get_db()[args.collection]
+    await seed(collection, args.docs, args.batch_size)
+
+    # Start from a clean slate: only the _id index.
+    await collection.drop_indexes()
+    before = await _measure(collection, args.repeats)
+
+    for pipeline in PIPELINES.values():
+        index_advisor.observe(args.collection, pipeline)
+    while index_advisor._explaining:
+        await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    created = await index_advisor.apply_recommendations(min_hits=1)
+    build_seconds = time.perf_counter() - started
+    after = await _measure(collection, args.repeats)
+
+    print(json.dumps({
+        "documents": args.docs,
+        "indexes_created": [c["index"] for c in created],
+        "index_build_seconds": round(build_seconds, 1),
+        "before": before,
+        "after": after,
+    }, indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=5_000_000)
+    parser.add_argument("--collection", default="bench_events")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    args = parser.parse_args()
+    os.environ.setdefault("MONGO_DB_NAME", "chatbot_bench")
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
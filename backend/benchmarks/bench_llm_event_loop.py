@@ -0,0 +1,139 @@
+"""
+Event-loop latency while N concurrent LLM calls run against a local stub server.
+
+A ticker task sleeps in 10 ms steps and records how late it wakes up; that lag
+is what every other request on the same loop would experience. `async` runs
+llm.query_llm; `blocking` reproduces the previous synchronous implementation
+(a blocking HTTP POST inside a coroutine) for comparison.
+
+    cd backend
+    python benchmarks/bench_llm_event_loop.py --calls 100 --stub-latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TICK_SECONDS = 0.01
+
+
+def _start_stub_server(port: int, latency: float) -> None:
+    """
+    Minimal OpenAI-compatible /chat/completions endpoint on its own thread and loop,
+    so a blocked benchmark loop cannot stall the server.
+    """
+    body = json.dumps({
+        "id": "stub",
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "stub answer"}, "finish_reason": "stop"}],
+    }).encode("utf-8")
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                headers = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in headers.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                await reader.readexactly(length)
+                await asyncio.sleep(latency)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+                    + body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    ready = threading.Event()
+
+    def run() -> None:
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(asyncio.start_server(handle, "127.0.0.1", port, backlog=1024))
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+
+
+async def _ticker(lags: list, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK_SECONDS)
+        lags.append((time.perf_counter() - started - TICK_SECONDS) * 1000)
+
+
+async def _blocking_call(url: str) -> dict:
+    payload = json.dumps({"model": "stub", "messages": [{"role": "user", "content": "hi"}]}).encode("utf-8")
+    req = urllib.request.Request(url, data=payload, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as resp:  # blocks the event loop, as requests.post did
+        return {"response": json.loads(resp.read())["choices"][0]["message"]["content"]}
+
+
+async def _run(mode: str, calls: int, url: str) -> dict:
+    import llm
+
+    lags: list = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(_ticker(lags, stop))
+    await asyncio.sleep(TICK_SECONDS * 5)
+
+    started = time.perf_counter()
+    if mode == "async":
+        results = await asyncio.gather(*(llm.query_llm("hi") for _ in range(calls)))
+    else:
+        results = await asyncio.gather(*(_blocking_call(url) for _ in range(calls)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await ticker
+    if mode == "async":
+        await llm.close_http_client()
+
+    lags.sort()
+    return {
+        "mode": mode,
+        "calls": calls,
+        "errors": sum(1 for r in results if "error" in r),
+        "wall_seconds": round(elapsed, 3),
+        "loop_lag_ms_p50": round(statistics.median(lags), 2) if lags else None,
+        "loop_lag_ms_p99": round(lags[int(len(lags) * 0.99) - 1], 2) if lags else None,
+        "loop_lag_ms_max": round(lags[-1], 2) if lags else None,
+        "ticks": len(lags),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=100)
+    parser.add_argument("--stub-latency", type=float, default=0.5, help="seconds per stub response")
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--modes", nargs="+", choices=["async", "blocking"], default=["async", "blocking"])
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    # Configure llm/llm_gateway before import: point at the stub, disable throttling.
+    os.environ["OPENROUTER_BASE_URL"] = base_url
+    os.environ.setdefault("OPENROUTER_API_KEY", "stub")
+    os.environ["LLM_MAX_CONCURRENCY"] = str(args.calls)
+    os.environ["LLM_RATE_PER_SECOND"] = "0"
+
+    _start_stub_server(args.port, args.stub_latency)
+    for mode in args.modes:
+        print(json.dumps(asyncio.run(_run(mode, args.calls, f"{base_url}/chat/completions"))))
+
+
+if __name__ == "__main__":
+    main()
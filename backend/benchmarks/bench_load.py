@@ -0,0 +1,368 @@
+"""
+End-to-end load test of the API against local stand-ins.
+
+Seeds a local mongod with N synthetic moderation events, starts a fake
+OpenAI-compatible LLM (benchmarks/fake_llm.py) with canned pipelines and the
+FastAPI app from main.py under uvicorn, then drives a weighted mix of traffic
+at each requested concurrency:
+
+  new_chat   POST /chat/new with a first question
+  message    POST /chat/{id}/message with a follow-up
+  report     a CSV report request, timed until its job has finished
+
+For every level the p50/p95/p99 latency per operation, overall RPS and the
+server's peak RSS are printed and saved as JSON next to the git commit, so
+runs can be compared between commits (--compare).
+
+    cd backend
+    MONGO_URL=mongodb://127.0.0.1:27017 python benchmarks/bench_load.py --docs 200000 --concurrency 1 8 32
+    python benchmarks/bench_load.py --compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+
+Extra server settings go through --env, e.g. --env PIPELINE_CACHE_MAX_ENTRIES=0.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+
+# Question -> pipeline the fake LLM returns for it.
+QUESTIONS = {
+    "count of nudity true": [
+        {"$match": {"processStatus.featureStatus.Nudity": True}},
+        {"$count": "nudity_count"},
+    ],
+    "unsafe events per organisation": [
+        {"$match": {"safe": False}},
+        {"$group": {"_id": "$orgId", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": 10},
+    ],
+    "average minor processing time for org012": [
+        {"$match": {"orgId": "org012"}},
+        {"$group": {"_id": None, "avgMinorSeconds": {"$avg": {
+            "$toDouble": "$eventLog.Minor.report.documentReport.report.MediaProcessingTimeInSeconds"}}}},
+    ],
+    "latest minor events": [
+        {"$match": {"processStatus.featureStatus.Minor": True}},
+        {"$sort": {"eventStartTime": -1}},
+        {"$limit": 20},
+    ],
+}
+REPORT_QUESTION = "generate csv report of unsafe events for org007"
+REPORT_PIPELINE = [{"$match": {"orgId": "org007", "safe": False}}]
+
+_JOB_RE = re.compile(r"/reports/jobs/([0-9a-f-]+)")
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))  # nearest rank
+    return round(ordered[rank], 1)
+
+
+def _rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None  # not Linux, or the process is gone
+    return None
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def add(self, op: str, ms: float, ok: bool) -> None:
+        self.latencies.setdefault(op, []).append(ms)
+        if not ok:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            op: {
+                "count": len(values),
+                "errors": self.errors.get(op, 0),
+                "p50_ms": _percentile(values, 50),
+                "p95_ms": _percentile(values, 95),
+                "p99_ms": _percentile(values, 99),
+                "max_ms": round(max(values), 1),
+            }
+            for op, values in sorted(self.latencies.items())
+        }
+
+
+async def _timed(recorder: Recorder, op: str, coro) -> Any:
+    started = time.perf_counter()
+    ok = False
+    try:
+        result = await coro
+        ok = True
+        return result
+    except Exception:
+        return None
+    finally:
+        recorder.add(op, (time.perf_counter() - started) * 1000, ok)
+
+
+async def _post(client, path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    response = await client.post(path, json=body)
+    response.raise_for_status()
+    return response.json()
+
+
+async def _report(client, chat_id: str, poll_seconds: float) -> Dict[str, Any]:
+    reply = await _post(client, f"/chat/{chat_id}/message", {"content": REPORT_QUESTION, "role": "user"})
+    match = _JOB_RE.search(reply.get("response", ""))
+    if match is None:
+        raise RuntimeError(f"No report job in reply: {reply}")
+    while True:
+        status = (await client.get(f"/reports/jobs/{match.group(1)}")).json()
+        if status.get("status") == "done":
+            return status
+        if status.get("status") == "failed":
+            raise RuntimeError(status.get("error"))
+        await asyncio.sleep(poll_seconds)
+
+
+async def _worker(client, recorder: Recorder, ops: List[str], rng: random.Random, poll_seconds: float) -> None:
+    questions = list(QUESTIONS)
+    chat_id = None
+    while ops:
+        op = ops.pop()
+        if op == "new_chat" or chat_id is None:
+            created = await _timed(recorder, "new_chat", _post(
+                client, "/chat/new", {"is_temporary": False, "first_message": rng.choice(questions)}
+            ))
+            chat_id = created.get("chat_id") if created else None
+            if op == "new_chat":
+                continue
+        if chat_id is None:
+            continue
+        if op == "message":
+            await _timed(recorder, "message", _post(
+                client, f"/chat/{chat_id}/message", {"content": rng.choice(questions), "role": "user"}
+            ))
+        elif op == "report":
+            await _timed(recorder, "report", _report(client, chat_id, poll_seconds))
+
+
+async def _sample_rss(pid: int, peak: Dict[str, float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        rss = _rss_mb(pid)
+        if rss is not None:
+            peak["rss_mb"] = max(peak.get("rss_mb", 0.0), rss)
+        await asyncio.sleep(0.25)
+
+
+async def _run_level(args, server: subprocess.Popen, concurrency: int, seed: int) -> Dict[str, Any]:
+    import httpx
+
+    rng = random.Random(seed)
+    names, weights = zip(*args.mix.items())
+    ops = rng.choices(names, weights=weights, k=args.requests)
+    recorder = Recorder()
+    peak: Dict[str, float] = {}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(_sample_rss(server.pid, peak, stop))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            _worker(client, recorder, ops, random.Random(seed * 1000 + i), args.poll_seconds)
+            for i in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - started
+    stop.set()
+    await sampler
+
+    completed = sum(len(v) for v in recorder.latencies.values())
+    return {
+        "concurrency": concurrency,
+        "requests": completed,
+        "errors": sum(recorder.errors.values()),
+        "wall_seconds": round(elapsed, 2),
+        "rps": round(completed / elapsed, 1) if elapsed else None,
+        "server_rss_mb_peak": peak.get("rss_mb"),
+        "server_rss_mb_end": _rss_mb(server.pid),
+        "operations": recorder.summary(),
+    }
+
+
+def _start_server(args, llm_url: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "OPENROUTER_BASE_URL": llm_url,
+        "OPENROUTER_API_KEY": env.get("OPENROUTER_API_KEY", "fake"),
+        "MONGO_DB_NAME": args.db,
+        "KNOWLEDGE_COLLECTION": args.collection,
+        # Measure the app, not the provider-side rate limit.
+        "LLM_RATE_PER_SECOND": "0",
+        "LLM_MAX_CONCURRENCY": str(max(args.concurrency) * 2),
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+         "--port", str(args.port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+
+
+async def _wait_ready(base_url: str, server: subprocess.Popen, timeout: float) -> None:
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url, timeout=2) as client:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with status {server.returncode}")
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("The API did not become healthy in time")
+
+
+async def main_async(args) -> Dict[str, Any]:
+    from benchmarks.fake_llm import FakeLLM
+    from benchmarks.synthetic import seed
+    from db import get_db
+
+    await seed(get_db()[args.collection], args.docs, args.batch_size)
+
+    pipelines = dict(QUESTIONS)
+    pipelines[REPORT_QUESTION] = REPORT_PIPELINE
+    llm = FakeLLM(args.llm_port, args.llm_latency, pipelines).start()
+
+    server = _start_server(args, llm.base_url)
+    try:
+        await _wait_ready(args.base_url, server, args.startup_timeout)
+        idle_rss = _rss_mb(server.pid)
+        levels = []
+        for i, concurrency in enumerate(args.concurrency):
+            level = await _run_level(args, server, concurrency, seed=i + 1)
+            print(json.dumps(level))
+            levels.append(level)
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    return {
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "settings": {
+            "documents": args.docs,
+            "requests_per_level": args.requests,
+            "mix": args.mix,
+            "llm_latency_seconds": args.llm_latency,
+            "llm_calls": llm.calls,
+            "env": args.env,
+        },
+        "server_rss_mb_idle": idle_rss,
+        "levels": levels,
+    }
+
+
+def _compare(old_path: str, new_path: str) -> None:
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_levels = {level["concurrency"]: level for level in old["levels"]}
+    for level in new["levels"]:
+        before = old_levels.get(level["concurrency"])
+        if before is None:
+            continue
+        row = {"concurrency": level["concurrency"], "rps": [before["rps"], level["rps"]]}
+        for op, stats in level["operations"].items():
+            prev = before["operations"].get(op)
+            if prev:
+                row[f"{op}_p95_ms"] = [prev["p95_ms"], stats["p95_ms"]]
+        print(json.dumps(row))
+
+
+def _parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("new_chat", "message", "report"):
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=200_000)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--db", default="chatbot_bench")
+    parser.add_argument("--collection", default="bench_events")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="operations per concurrency level")
+    parser.add_argument("--mix", type=_parse_mix, default=_parse_mix("new_chat=2,message=7,report=1"))
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds per fake LLM response")
+    parser.add_argument("--llm-port", type=int, default=18765)
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--poll-seconds", type=float, default=0.2)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server setting")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/load_<commit>_<time>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        _compare(*args.compare)
+        return
+
+    args.base_url = f"http://127.0.0.1:{args.port}"
+    os.environ["MONGO_DB_NAME"] = args.db
+    result = asyncio.run(main_async(args))
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"load_{result['commit'] or 'unknown'}_{stamp}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps({"saved": output}))
+
+
+if __name__ == "__main__":
+    main()
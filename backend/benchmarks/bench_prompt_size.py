@@ -0,0 +1,122 @@
+"""
+Pipeline-generation prompt size with the full versus the per-question schema.
+
+Profiles synthetic events (raw and normalized shapes) the way the app does,
+then, for every question of the corpus, counts the prompt tokens sent with the
+whole sampled schema and with schema_slicer.slice_schema(), and times the
+slicing itself. The system message (the rules only) is the same for every
+question and is reported as the prefix the provider can cache; the prompt
+with the hand-written structure, used when profiling is off, is reported too.
+
+With --live MODEL both prompts are also sent to the LLM (OPENROUTER_API_KEY etc.
+as for the app) and the median completion latency and cached prompt tokens are
+reported.
+
+    cd backend
+    python benchmarks/bench_prompt_size.py --docs 1000
+    python benchmarks/bench_prompt_size.py --questions my_questions.txt --live gpt-4o-mini
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_QUESTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "questions.txt")
+
+
+def load_questions(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def _live(model: str, prompts: List[List[Dict[str, str]]]) -> Dict[str, Any]:
+    from llm_gateway import chat_completion
+
+    timings, cached = [], 0
+    for messages in prompts:
+        started = time.perf_counter()
+        completion = await chat_completion(model, messages, temperature=0.0)
+        timings.append((time.perf_counter() - started) * 1000)
+        details = getattr(getattr(completion, "usage", None), "prompt_tokens_details", None)
+        cached += getattr(details, "cached_tokens", 0) or 0
+    return {"median_ms": round(statistics.median(timings), 1), "cached_prompt_tokens": cached}
+
+
+def measure(shape: str, description: str, questions: List[str], normalized: bool) -> Tuple[Dict[str, Any], list, list]:
+    from query_generator import pipeline_messages
+    from result_compactor import count_tokens
+    from schema_slicer import slice_schema
+
+    full, sliced, sliced_schema, slice_ms, untouched = [], [], [], [], 0
+    full_prompts, sliced_prompts = [], []
+    for question in questions:
+        started = time.perf_counter()
+        piece = slice_schema(description, question)
+        slice_ms.append((time.perf_counter() - started) * 1000)
+        untouched += piece == description
+        full_prompts.append(pipeline_messages(question, normalized, description))
+        sliced_schema.append(count_tokens(piece))
+        sliced_prompts.append(pipeline_messages(question, normalized, piece))
+        full.append(sum(count_tokens(m["content"]) for m in full_prompts[-1]))
+        sliced.append(sum(count_tokens(m["content"]) for m in sliced_prompts[-1]))
+
+    result = {
+        "shape": shape,
+        "questions": len(questions),
+        "not_sliced": untouched,
+        "system_prompt_tokens": count_tokens(full_prompts[0][0]["content"]),
+        "hand_written_prompt_tokens": sum(count_tokens(m["content"]) for m in pipeline_messages(questions[0], normalized)),
+        "profile_tokens": {"full": count_tokens(description), "sliced_median": statistics.median(sliced_schema)},
+        "full_prompt_tokens": {"median": statistics.median(full), "max": max(full)},
+        "sliced_prompt_tokens": {"median": statistics.median(sliced), "max": max(sliced)},
+        "token_reduction": round(1 - sum(sliced) / sum(full), 3),
+        "slice_ms": {"median": round(statistics.median(slice_ms), 3), "p95": round(_percentile(slice_ms, 0.95), 3)},
+    }
+    return result, full_prompts, sliced_prompts
+
+
+async def _live_all(model: str, measured: List[Tuple[Dict[str, Any], list, list]]) -> None:
+    for result, full_prompts, sliced_prompts in measured:
+        result["llm_full"] = await _live(model, full_prompts)
+        result["llm_sliced"] = await _live(model, sliced_prompts)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=1000, help="synthetic events to profile")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS, help="file with one question per line")
+    parser.add_argument("--live", metavar="MODEL", help="also send the prompts to MODEL and time the completions")
+    args = parser.parse_args()
+
+    import normalizer
+    import schema_profiler
+    from benchmarks.synthetic import iter_events
+
+    questions = load_questions(args.questions)
+    docs = list(iter_events(args.docs))
+    raw, _ = schema_profiler.profile(docs)
+    normalized, _ = schema_profiler.profile(normalizer.normalize_events(docs))
+
+    measured = [
+        measure("raw", raw, questions, False),
+        measure("normalized", normalized, questions, True),
+    ]
+    if args.live:
+        asyncio.run(_live_all(args.live, measured))
+
+    print(json.dumps([result for result, _, _ in measured], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Report export benchmark: peak RSS and throughput while exporting N synthetic
+moderation events through report_generator's streaming writers.
+
+Each format runs in its own subprocess because ru_maxrss is a per-process
+high-water mark. The `legacy-*` modes reproduce the previous behaviour
+(materialize every document, then build the whole file in memory) for comparison.
+
+    cd backend
+    python benchmarks/bench_report_export.py --rows 1000000
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODES = ["csv", "xlsx", "legacy-csv", "legacy-xlsx"]
+
+
+def _peak_rss_mb() -> float:
+    # Linux reports kilobytes, macOS bytes.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+async def _docs(n: int):
+    from benchmarks.synthetic import iter_events
+
+    for doc in iter_events(n):
+        yield doc
+
+
+async def _legacy(mode: str, n: int, path: str) -> int:
+    import openpyxl
+    from report_generator import _flatten_event_log
+
+    docs = [doc async for doc in _docs(n)]
+    rows = [_flatten_event_log(d) for d in docs]
+    headers = list(rows[0].keys())
+    if mode == "legacy-csv":
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=headers)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.append(headers)
+        for item in rows:
+            ws.append([str(item.get(h, "")) for h in headers])
+        wb.save(path)
+    return len(rows)
+
+
+def run_child(mode: str, n: int) -> None:
+    from report_generator import _write_csv, _write_xlsx
+
+    suffix = ".csv" if mode.endswith("csv") else ".xlsx"
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    baseline = _peak_rss_mb()
+    started = time.perf_counter()
+    try:
+        if mode == "csv":
+            rows = asyncio.run(_write_csv(_docs(n), path))
+        elif mode == "xlsx":
+            rows = asyncio.run(_write_xlsx(_docs(n), path))
+        else:
+            rows = asyncio.run(_legacy(mode, n, path))
+        elapsed = time.perf_counter() - started
+        size_mb = os.path.getsize(path) / (1024 * 1024)
+    finally:
+        os.remove(path)
+
+    print(json.dumps({
+        "mode": mode,
+        "rows": rows,
+        "seconds": round(elapsed, 2),
+        "rows_per_second": round(rows / elapsed) if elapsed else None,
+        "file_mb": round(size_mb, 1),
+        "baseline_rss_mb": round(baseline, 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=["csv", "xlsx"])
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.rows)
+        return
+
+    for mode in args.modes:
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", mode, "--rows", str(args.rows)],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        print(out.stdout.strip())
+
+
+if __name__ == "__main__":
+    main()
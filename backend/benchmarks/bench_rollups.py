@@ -0,0 +1,121 @@
+"""
+Query latency on raw events versus the rollup buckets, with a result check.
+
+Seeds a local mongod with N synthetic moderation events (skipped when the
+collection already holds N documents), builds the rollups from scratch, then
+runs typical count / per-org / per-day / processing-time pipelines both ways.
+Exits non-zero if a rewritten pipeline returns different results.
+
+    cd backend
+    MONGO_URL=mongodb://127.0.0.1:27017 python benchmarks/bench_rollups.py --docs 2000000
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_TIME = "$eventLog.Minor.report.documentReport.report.MediaProcessingTimeInSeconds"
+
+PIPELINES = {
+    "count_nudity_true": [
+        {"$match": {"processStatus.featureStatus.Nudity": True}},
+        {"$count": "nudity_count"},
+    ],
+    "unsafe_per_org": [
+        {"$match": {"safe": False}},
+        {"$group": {"_id": "$orgId", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1, "_id": 1}},
+    ],
+    "events_per_day_in_range": [
+        {"$match": {"eventStartTime": {"$gte": datetime(2025, 6, 3), "$lt": datetime(2025, 6, 10)}}},
+        {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$eventStartTime"}}, "count": {"$sum": 1}}},
+        {"$sort": {"_id": 1}},
+    ],
+    "minor_time_stats_for_org": [
+        {"$match": {"orgId": "org012"}},
+        {"$group": {
+            "_id": None,
+            "avg": {"$avg": {"$toDouble": _TIME}},
+            "max": {"$max": {"$toDouble": _TIME}},
+            "events": {"$sum": 1},
+        }},
+    ],
+}
+
+
+def _same(a, b) -> bool:
+    if isinstance(a, float) or isinstance(b, float):
+        return isinstance(a, (int, float)) and isinstance(b, (int, float)) and abs(a - b) <= 1e-9 * max(1.0, abs(a))
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_same(a[k], b[k]) for k in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+async def _time(collection, pipeline, repeats: int):
+    timings = []
+    docs = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        docs = await collection.aggregate(pipeline).to_list(length=None)
+        timings.append((time.perf_counter() - started) * 1000)
+    return docs, round(statistics.median(timings), 2)
+
+
+async def main_async(args) -> int:
+    import rollups
+    from benchmarks.synthetic import seed
+    from db import ROLLUP_COLLECTION, get_db
+
+    db = get_db()
+    await seed(db[args.collection], args.docs, args.batch_size)
+
+    rollups._source = args.collection
+    rollups._lock = asyncio.Lock()
+    started = time.perf_counter()
+    await rollups.rebuild()
+    build_seconds = time.perf_counter() - started
+    buckets = await db[ROLLUP_COLLECTION].estimated_document_count()
+
+    failures = 0
+    results = {}
+    for name, pipeline in PIPELINES.items():
+        rewritten = rollups.rewrite(args.collection, pipeline)
+        if rewritten is None:
+            results[name] = {"rewritten": False}
+            continue
+        raw_docs, raw_ms = await _time(db[args.collection], pipeline, args.repeats)
+        rollup_docs, rollup_ms = await _time(db[ROLLUP_COLLECTION], rewritten, args.repeats)
+        same = _same(raw_docs, rollup_docs)
+        failures += not same
+        results[name] = {"raw_ms": raw_ms, "rollup_ms": rollup_ms, "same_results": same}
+
+    print(json.dumps({
+        "documents": args.docs,
+        "buckets": buckets,
+        "build_seconds": round(build_seconds, 1),
+        "pipelines": results,
+    }, indent=2))
+    return 1 if failures else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=2_000_000)
+    parser.add_argument("--collection", default="bench_events")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    args = parser.parse_args()
+    os.environ.setdefault("MONGO_DB_NAME", "chatbot_bench")
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
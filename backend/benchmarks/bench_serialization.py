@@ -0,0 +1,110 @@
+"""
+Serialization cost for realistic moderation results.
+
+Encodes a batch of synthetic events (deep eventLog trees, plus ObjectId,
+Decimal128 and bytes fields) the way the old code did it (recursive
+_to_jsonable copy, then stdlib json with default=str) and with the
+single-pass serialization module, for both entry points:
+
+  dumps     a result set to JSON text (answer prompt, result cache sizing)
+  jsonable  a result set to plain Python structures (database tool results)
+
+    cd backend
+    python benchmarks/bench_serialization.py --docs 200 --repeats 50
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import date, datetime
+from datetime import time as dt_time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import Decimal128, ObjectId  # noqa: E402
+
+
+def _legacy_to_jsonable(value):
+    """The previous database._to_jsonable, kept here for comparison."""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date, dt_time)):
+        try:
+            return value.isoformat()
+        except Exception:
+            return str(value)
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    if isinstance(value, dict):
+        return {str(k): _legacy_to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_legacy_to_jsonable(v) for v in value]
+    return value
+
+
+def _documents(n: int) -> list:
+    from benchmarks.synthetic import iter_events
+
+    rng = random.Random(7)
+    docs = []
+    for doc in iter_events(n):
+        doc["sourceId"] = ObjectId()
+        doc["riskScore"] = Decimal128(f"{rng.random():.6f}")
+        doc["thumbnailHash"] = rng.randbytes(16).hex().encode("ascii")
+        docs.append(doc)
+    return docs
+
+
+def _time_ms(fn, docs, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn(docs)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    import serialization
+
+    docs = _documents(args.docs)
+    cases = {
+        "dumps": (
+            lambda d: json.dumps(_legacy_to_jsonable(d), ensure_ascii=False, default=str),
+            serialization.dumps,
+        ),
+        "jsonable": (_legacy_to_jsonable, serialization.to_jsonable),
+        # Tool result handed to the answer prompt: copy, then encode again.
+        "jsonable_then_dumps": (
+            lambda d: json.dumps(_legacy_to_jsonable(d), default=str),
+            lambda d: serialization.dumps(serialization.to_jsonable(d)),
+        ),
+    }
+    for name, (legacy, fast) in cases.items():
+        legacy_ms = _time_ms(legacy, docs, args.repeats)
+        fast_ms = _time_ms(fast, docs, args.repeats)
+        print(json.dumps({
+            "case": name,
+            "encoder": "orjson" if serialization.orjson is not None else "stdlib",
+            "docs": args.docs,
+            "legacy_ms": round(legacy_ms, 2),
+            "single_pass_ms": round(fast_ms, 2),
+            "speedup": round(legacy_ms / fast_ms, 1) if fast_ms else None,
+        }))
+
+
+if __name__ == "__main__":
+    main()
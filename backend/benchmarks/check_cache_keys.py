@@ -0,0 +1,51 @@
+"""
+Collision check for the pipeline cache keys.
+
+Every pair in DISTINCT asks for a different pipeline, so the two questions
+must normalize to different pipeline-cache keys and, once their literals are
+abstracted, to different template keys. Every pair in SAME must share both.
+Exits non-zero on any mismatch.
+
+    cd backend
+    python benchmarks/check_cache_keys.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DISTINCT = [
+    ("how many events are safe", "how many events are not safe"),
+    ("events with nudity and minor true", "events with nudity or minor true"),
+    ("events with neither nudity nor minor true", "events with neither nudity or minor true"),
+    ("processing time above 2 seconds", "processing time below 2 seconds"),
+    ("events before 2025-06-10", "events after 2025-06-10"),
+    ("top 5 orgs by unsafe events", "top 10 orgs by unsafe events"),
+]
+
+SAME = [
+    ("How many events are safe?", "how many events are safe"),
+    ("what is the count of the unsafe events", "count of unsafe events"),
+]
+
+
+def keys(question: str):
+    from database import normalize_question
+    from query_templates import extract_literals
+
+    return normalize_question(question), normalize_question(extract_literals(question)[0])
+
+
+def main() -> None:
+    failures = 0
+    for pairs, expect_same in ((DISTINCT, False), (SAME, True)):
+        for first, second in pairs:
+            (key_a, tpl_a), (key_b, tpl_b) = keys(first), keys(second)
+            ok = (key_a == key_b) == expect_same and (tpl_a == tpl_b) == expect_same
+            failures += not ok
+            print(f"{'ok  ' if ok else 'FAIL'} {first!r} / {second!r}: {key_a!r} vs {key_b!r}, templates {tpl_a!r} vs {tpl_b!r}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
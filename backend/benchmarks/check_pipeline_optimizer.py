@@ -0,0 +1,175 @@
+"""
+Equivalence check for pipeline_optimizer against a local mongod.
+
+Runs every pipeline in CORPUS as written and as rewritten by optimize_pipeline
+on a seeded collection of synthetic events, and compares the documents
+execute_aggregation would return (ordered when the pipeline sorts, as a
+multiset otherwise). Exits non-zero on any mismatch and prints timings.
+
+    cd backend
+    MONGO_URL=mongodb://127.0.0.1:27017 python benchmarks/check_pipeline_optimizer.py --docs 50000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MINOR_SECONDS = "$eventLog.Minor.report.documentReport.report.MediaProcessingTimeInSeconds"
+
+# Shapes the LLM actually produces, most of them needlessly expensive as written.
+CORPUS = {
+    "project_then_match": [
+        {"$project": {"orgId": 1, "safe": 1, "eventStartTime": 1}},
+        {"$match": {"safe": False, "orgId": "org003"}},
+        {"$sort": {"eventStartTime": -1, "_id": 1}},
+    ],
+    "todouble_before_filter": [
+        {"$addFields": {"seconds": {"$toDouble": MINOR_SECONDS}}},
+        {"$match": {"processStatus.featureStatus.Minor": True}},
+        {"$group": {"_id": None, "avg": {"$avg": "$seconds"}, "max": {"$max": "$seconds"}}},
+    ],
+    "filter_on_computed_field": [
+        {"$addFields": {"seconds": {"$toDouble": MINOR_SECONDS}}},
+        {"$match": {"seconds": {"$gt": 2.5}, "orgId": "org010"}},
+        {"$count": "slow_minor"},
+    ],
+    "adjacent_matches": [
+        {"$match": {"processStatus.featureStatus.Nudity": True}},
+        {"$match": {"orgId": {"$in": ["org001", "org002"]}}},
+        {"$match": {"eventStartTime": {"$gte": datetime(2025, 6, 2)}}},
+        {"$count": "n"},
+    ],
+    "overlapping_matches": [
+        {"$match": {"eventStartTime": {"$gte": datetime(2025, 6, 1, 12)}}},
+        {"$match": {"eventStartTime": {"$lt": datetime(2025, 6, 2)}}},
+        {"$group": {"_id": "$moderationCode", "n": {"$sum": 1}}},
+        {"$sort": {"_id": 1}},
+    ],
+    "group_without_match": [
+        {"$group": {"_id": "$orgId", "events": {"$sum": 1}, "unsafe": {"$sum": {"$cond": ["$safe", 0, 1]}}}},
+        {"$sort": {"_id": 1}},
+    ],
+    "sort_without_limit": [
+        {"$match": {"processStatus.featureStatus.Scamster": True}},
+        {"$sort": {"eventStartTime": -1, "_id": 1}},
+        {"$project": {"_id": 1, "orgId": 1, "eventStartTime": 1}},
+    ],
+    "sort_then_match": [
+        {"$sort": {"eventStartTime": 1, "_id": 1}},
+        {"$match": {"moderationCode": "REVIEW", "safe": False}},
+        {"$project": {"userId": 1, "eventStartTime": 1}},
+        {"$limit": 25},
+    ],
+    "limit_after_addfields": [
+        {"$match": {"orgId": "org020"}},
+        {"$sort": {"eventStartTime": -1, "_id": 1}},
+        {"$addFields": {"seconds": {"$toDouble": MINOR_SECONDS}}},
+        {"$limit": 10},
+    ],
+    "unwind_feature_counts": [
+        {"$match": {"orgId": "org030"}},
+        {"$project": {"features": {"$objectToArray": "$processStatus.featureStatus"}}},
+        {"$unwind": "$features"},
+        {"$match": {"features.v": True}},
+        {"$group": {"_id": "$features.k", "n": {"$sum": 1}}},
+        {"$sort": {"_id": 1}},
+    ],
+    "exclusion_projection": [
+        {"$project": {"eventLog": 0, "media": 0}},
+        {"$match": {"safe": True, "orgId": "org040"}},
+        {"$sort": {"eventStartTime": 1, "_id": 1}},
+        {"$limit": 5},
+    ],
+    "nested_inclusion": [
+        {"$match": {"orgId": "org015"}},
+        {"$addFields": {"seconds": {"$toDouble": MINOR_SECONDS}}},
+        {"$project": {"processStatus": {"featureStatus": 1}, "seconds": 1.0}},
+        {"$match": {"processStatus.featureStatus.Minor": True}},
+    ],
+    "nested_exclusion": [
+        {"$project": {"processStatus": {"featureStatus": 0}, "eventLog": 0}},
+        {"$match": {"processStatus.featureStatus": {"$exists": True}}},
+        {"$count": "with_status"},
+    ],
+    "root_reference": [
+        {"$match": {"orgId": "org005", "safe": False}},
+        {"$group": {"_id": "$moderationCode", "latest": {"$last": "$$ROOT"}}},
+        {"$project": {"_id": 1, "latest._id": 1}},
+        {"$sort": {"_id": 1}},
+    ],
+}
+
+
+def _canonical(docs: list, ordered: bool) -> list:
+    rows = [json.dumps(d, sort_keys=True, default=str) for d in docs]
+    return rows if ordered else sorted(rows)
+
+
+async def _seed(collection, n: int) -> None:
+    from benchmarks.synthetic import iter_events
+
+    if await collection.estimated_document_count() == n:
+        return
+    await collection.drop()
+    batch = []
+    for doc in iter_events(n):
+        batch.append(doc)
+        if len(batch) >= 5000:
+            await collection.insert_many(batch)
+            batch = []
+    if batch:
+        await collection.insert_many(batch)
+
+
+async def _run(collection, pipeline: list, limit: int):
+    started = time.perf_counter()
+    docs = await collection.aggregate(pipeline).to_list(length=limit)
+    return docs, (time.perf_counter() - started) * 1000
+
+
+async def main_async(args) -> int:
+    from db import get_db
+    from pipeline_optimizer import optimize_pipeline
+    from query_generator import AGGREGATION_RESULT_LIMIT
+
+    collection = get_db()[args.collection]
+    await _seed(collection, args.docs)
+
+    failures = 0
+    for name, pipeline in CORPUS.items():
+        optimized = optimize_pipeline(pipeline, result_limit=AGGREGATION_RESULT_LIMIT)
+        before, before_ms = await _run(collection, pipeline, AGGREGATION_RESULT_LIMIT)
+        after, after_ms = await _run(collection, optimized, AGGREGATION_RESULT_LIMIT)
+        ordered = any("$sort" in stage for stage in pipeline)
+        same = _canonical(before, ordered) == _canonical(after, ordered)
+        failures += not same
+        print(json.dumps({
+            "pipeline": name,
+            "equivalent": same,
+            "rewritten": optimized != pipeline,
+            "rows": len(before),
+            "before_ms": round(before_ms, 1),
+            "after_ms": round(after_ms, 1),
+        }))
+        if not same or args.verbose:
+            print(json.dumps({"original": pipeline, "optimized": optimized}, default=str))
+    return 1 if failures else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=50_000)
+    parser.add_argument("--collection", default="optimizer_check_events")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    os.environ.setdefault("MONGO_DB_NAME", "chatbot_bench")
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
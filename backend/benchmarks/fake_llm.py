@@ -0,0 +1,108 @@
+"""
+OpenAI-compatible stand-in for the LLM provider, for load tests.
+
+Serves POST /chat/completions (plain and streamed) on its own thread and event
+loop, after a configurable delay. Pipeline-generation prompts are answered with
+the canned pipeline registered for the question (matched on the
+`User Question: "..."` line of QUERY_GENERATION_PROMPT), or with DEFAULT_PIPELINE.
+Every other prompt gets a short fixed answer. Responses carry a `usage` block
+so token metrics are exercised as well.
+"""
+import asyncio
+import json
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+DEFAULT_PIPELINE = [{"$match": {"safe": False}}, {"$count": "unsafe_count"}]
+ANSWER = "Here is a short summary of the data you asked about."
+
+_QUESTION_RE = re.compile(r'User Question: "(.*)"')
+
+
+class FakeLLM:
+    def __init__(self, port: int, latency: float, pipelines: Optional[Dict[str, List[Dict[str, Any]]]] = None):
+        self.port = port
+        self.latency = latency
+        self.pipelines = pipelines or {}
+        self.calls = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _content(self, payload: Dict[str, Any]) -> str:
+        prompt = "\n".join(str(m.get("content", "")) for m in payload.get("messages", []))
+        match = _QUESTION_RE.search(prompt)
+        if match is None:
+            return ANSWER
+        return json.dumps(self.pipelines.get(match.group(1), DEFAULT_PIPELINE))
+
+    def _response(self, payload: Dict[str, Any]) -> bytes:
+        content = self._content(payload)
+        usage = {"prompt_tokens": len(json.dumps(payload)) // 4, "completion_tokens": len(content) // 4}
+        if not payload.get("stream"):
+            body = json.dumps({
+                "id": "fake",
+                "object": "chat.completion",
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            }).encode("utf-8")
+            return (
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+                + body
+            )
+
+        chunks = []
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            delta = {"content": word if i == 0 else f" {word}"}
+            chunks.append({"id": "fake", "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta}]})
+        chunks.append({
+            "id": "fake", "object": "chat.completion.chunk",
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage,
+        })
+        body = "".join(f"data: {json.dumps(c)}\n\n" for c in chunks) + "data: [DONE]\n\n"
+        body_bytes = body.encode("utf-8")
+        return (
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            + f"Content-Length: {len(body_bytes)}\r\n\r\n".encode("ascii")
+            + body_bytes
+        )
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                headers = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in headers.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                body = await reader.readexactly(length)
+                try:
+                    payload = json.loads(body or b"{}")
+                except ValueError:
+                    payload = {}
+                self.calls += 1
+                await asyncio.sleep(self.latency)
+                writer.write(self._response(payload))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self) -> "FakeLLM":
+        ready = threading.Event()
+
+        def run() -> None:
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", self.port, backlog=1024))
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self
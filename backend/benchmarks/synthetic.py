@@ -0,0 +1,89 @@
+"""
+Synthetic moderation events shaped like schema.get_collection_schema(), shared
+by the benchmark scripts in this folder.
+"""
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator
+
+FEATURES = ["Nudity", "Minor", "Scamster", "ImageSearch"]
+ORG_IDS = [f"org{i:03d}" for i in range(50)]
+START = datetime(2025, 6, 1)
+
+
+def _custom_ts(dt: datetime) -> str:
+    # Matches the collection's non-standard format, e.g. 2025-06-10T00:01:15:005433
+    return dt.strftime("%Y-%m-%dT%H:%M:%S:%f")
+
+
+def make_event(i: int, rng: random.Random) -> Dict[str, Any]:
+    started = START + timedelta(seconds=i * 7 + rng.randint(0, 6))
+    feature_status = {f: rng.random() < 0.15 for f in FEATURES}
+    event_log: Dict[str, Any] = {}
+    for feature in FEATURES:
+        seconds = rng.uniform(0.05, 3.0)
+        event_log[feature] = {
+            "processingStartTime": _custom_ts(started),
+            "processingEndTime": _custom_ts(started + timedelta(seconds=seconds)),
+            "report": {
+                "documentReport": {
+                    "report": {
+                        "Model": f"{feature.lower()}-v3",
+                        "Predictions": str({
+                            "na/selfie": round(rng.random(), 4),
+                            "na/document": round(rng.random(), 4),
+                            f"{feature.lower()}/positive": round(rng.random(), 4),
+                        }),
+                        "StatusCode": "200",
+                        "MediaProcessingTimeInSeconds": f"{seconds:.6f}",
+                    }
+                }
+            },
+        }
+    return {
+        "_id": f"V{1333 + i % 7}_{i}_EVT_{rng.randint(1000, 9999)}",
+        "userId": f"user{rng.randint(1, 5000)}",
+        "orgId": rng.choice(ORG_IDS),
+        "requestType": "URL",
+        "eventStartTime": started,
+        "eventEndTime": started + timedelta(seconds=4),
+        "processExitStatus": True,
+        "operationsPerFeature": {f: rng.randint(0, 3) for f in FEATURES},
+        "eventLog": event_log,
+        "processStatus": {
+            "completedProcesses": len(FEATURES),
+            "complete": True,
+            "featureStatus": feature_status,
+        },
+        "media": {"inputMediaURL": f"https://cdn.example.com/m/{i}.jpg", "type": "IMAGE"},
+        "safe": not any(feature_status.values()),
+        "complete": True,
+        "moderationCode": rng.choice(["OK", "FLAGGED", "REVIEW"]),
+    }
+
+
+def iter_events(n: int, seed: int = 42) -> Iterator[Dict[str, Any]]:
+    rng = random.Random(seed)
+    for i in range(n):
+        yield make_event(i, rng)
+
+
+async def seed(collection, n: int, batch_size: int = 10_000) -> None:
+    """Fills `collection` with n events, unless it already holds at least n documents."""
+    existing = await collection.estimated_document_count()
+    if existing >= n:
+        print(json.dumps({"seed": "skipped", "documents": existing}))
+        return
+    await collection.drop()
+    started = time.perf_counter()
+    batch = []
+    for doc in iter_events(n):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            await collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await collection.insert_many(batch, ordered=False)
+    print(json.dumps({"seed": "inserted", "documents": n, "seconds": round(time.perf_counter() - started, 1)}))
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    Small LRU cache with per-entry TTL and optional JSON persistence.
+
+    Values must be JSON-serializable when `path` is set. Entries store wall-clock
+    expiry so a persisted cache survives a restart with the right remaining TTL.
+    When `max_bytes` is set, callers pass each entry's size to `set` and the
+    least recently used entries are evicted to stay under the budget.
+
+    Changes are written to `path` at most every `flush_seconds`, on a timer
+    thread, and by flush() (call it at shutdown).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 512,
+        ttl_seconds: float = 3600.0,
+        path: Optional[str] = None,
+        max_bytes: Optional[int] = None,
+        flush_seconds: float = 5.0,
+    ):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = float(ttl_seconds)
+        self.path = path or None
+        self.max_bytes = int(max_bytes) if max_bytes else None
+        self.flush_seconds = max(0.0, float(flush_seconds))
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._data: "OrderedDict[str, Any]" = OrderedDict()
+        self._expires: Dict[str, float] = {}
+        self._sizes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._flush_timer: Optional[threading.Timer] = None
+        if self.path:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+            if self._expires.get(key, 0) <= time.time():
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None, size: int = 0) -> None:
+        ttl = self.ttl_seconds if ttl_seconds is None else float(ttl_seconds)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._data[key] = value
+            self._expires[key] = time.time() + ttl
+            self._sizes[key] = size
+            self.bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+                oldest = next(iter(self._data))
+                self._drop(oldest)
+        if self.path:
+            self._mark_dirty()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._drop(key)
+        if self.path:
+            self._mark_dirty()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            self._sizes.clear()
+            self.bytes = 0
+        if self.path:
+            self._mark_dirty()
+
+    def flush(self) -> None:
+        """Writes pending changes to `path` now."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            dirty, self._dirty = self._dirty, False
+        if dirty:
+            self._save()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / total) if total else 0.0,
+        }
+
+    def _drop(self, key: str) -> None:
+        self._data.pop(key, None)
+        self._expires.pop(key, None)
+        self.bytes -= self._sizes.pop(key, 0)
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache file {self.path}: {e}")
+            return
+
+        now = time.time()
+        for item in payload.get("entries", []):
+            try:
+                key, value, expires = item["key"], item["value"], float(item["expires"])
+            except Exception:
+                continue
+            if expires > now:
+                self._data[key] = value
+                self._expires[key] = expires
+        while len(self._data) > self.max_entries:
+            self._drop(next(iter(self._data)))
+
+    def _mark_dirty(self) -> None:
+        with self._lock:
+            self._dirty = True
+            if self._flush_timer is not None:
+                return
+            timer = self._flush_timer = threading.Timer(self.flush_seconds, self.flush)
+        timer.daemon = True
+        timer.start()
+
+    def _save(self) -> None:
+        # One writer at a time, snapshotting under it, so an older snapshot never lands last.
+        with self._save_lock:
+            with self._lock:
+                entries = [
+                    {"key": k, "value": v, "expires": self._expires.get(k, 0)}
+                    for k, v in self._data.items()
+                ]
+            tmp_path = f"{self.path}.tmp"
+            try:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"entries": entries}, f, default=str)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.warning(f"Could not persist cache to {self.path}: {e}")
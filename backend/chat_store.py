@@ -0,0 +1,153 @@
+import asyncio
+import base64
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from db import CHATS_COLLECTION, MESSAGES_COLLECTION, get_db
+
+DEFAULT_CHAT_PAGE = 100
+DEFAULT_MESSAGE_PAGE = 200
+MAX_PAGE = 500
+
+
+def now() -> datetime:
+    # BSON dates have millisecond precision; truncate so cursors round-trip exactly.
+    ts = datetime.utcnow()
+    return ts.replace(microsecond=(ts.microsecond // 1000) * 1000)
+
+
+def _encode_cursor(ts: datetime, key: str) -> str:
+    raw = json.dumps([ts.isoformat(), key]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _decode_cursor(cursor: str, object_id: bool = False) -> Tuple[datetime, Any]:
+    try:
+        ts, key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(ts), ObjectId(key) if object_id else str(key)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _page_size(limit: Optional[int], default: int) -> int:
+    try:
+        value = int(limit) if limit is not None else default
+    except Exception:
+        value = default
+    return max(1, min(MAX_PAGE, value))
+
+
+def _chat_out(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "chat_id": doc["chat_id"],
+        "title": doc.get("title", ""),
+        "created_at": doc["created_at"].isoformat(),
+        "updated_at": doc["updated_at"].isoformat(),
+        "is_temporary": False,
+    }
+
+
+def _message_out(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "role": doc["role"],
+        "content": doc["content"],
+        "timestamp": doc["timestamp"].isoformat(),
+    }
+
+
+async def create_chat(chat_id: str, title: str) -> Dict[str, Any]:
+    ts = now()
+    doc = {"chat_id": chat_id, "title": title, "created_at": ts, "updated_at": ts}
+    await get_db()[CHATS_COLLECTION].insert_one(doc)
+    return _chat_out(doc)
+
+
+async def get_chat(chat_id: str) -> Optional[Dict[str, Any]]:
+    doc = await get_db()[CHATS_COLLECTION].find_one({"chat_id": chat_id}, {"_id": 0})
+    return _chat_out(doc) if doc else None
+
+
+async def delete_chat(chat_id: str) -> bool:
+    db = get_db()
+    result = await db[CHATS_COLLECTION].delete_one({"chat_id": chat_id})
+    await db[MESSAGES_COLLECTION].delete_many({"chat_id": chat_id})
+    return result.deleted_count > 0
+
+
+async def list_chats(
+    limit: Optional[int] = None, cursor: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Returns one page of chats, most recently updated first, and the cursor of the next page.
+    """
+    size = _page_size(limit, DEFAULT_CHAT_PAGE)
+    query: Dict[str, Any] = {}
+    if cursor:
+        ts, chat_id = _decode_cursor(cursor)
+        query = {
+            "$or": [
+                {"updated_at": {"$lt": ts}},
+                {"updated_at": ts, "chat_id": {"$lt": chat_id}},
+            ]
+        }
+    docs = (
+        await get_db()[CHATS_COLLECTION]
+        .find(query, {"_id": 0})
+        .sort([("updated_at", -1), ("chat_id", -1)])
+        .limit(size + 1)
+        .to_list(length=size + 1)
+    )
+    next_cursor = None
+    if len(docs) > size:
+        docs = docs[:size]
+        next_cursor = _encode_cursor(docs[-1]["updated_at"], docs[-1]["chat_id"])
+    return [_chat_out(d) for d in docs], next_cursor
+
+
+async def list_messages(
+    chat_id: str, limit: Optional[int] = None, cursor: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Returns one page of a chat's messages in chronological order and the cursor of the next page.
+    """
+    size = _page_size(limit, DEFAULT_MESSAGE_PAGE)
+    query: Dict[str, Any] = {"chat_id": chat_id}
+    if cursor:
+        ts, last_id = _decode_cursor(cursor, object_id=True)
+        query["$or"] = [
+            {"timestamp": {"$gt": ts}},
+            {"timestamp": ts, "_id": {"$gt": last_id}},
+        ]
+    docs = (
+        await get_db()[MESSAGES_COLLECTION]
+        .find(query)
+        .sort([("timestamp", 1), ("_id", 1)])
+        .limit(size + 1)
+        .to_list(length=size + 1)
+    )
+    next_cursor = None
+    if len(docs) > size:
+        docs = docs[:size]
+        next_cursor = _encode_cursor(docs[-1]["timestamp"], str(docs[-1]["_id"]))
+    return [_message_out(d) for d in docs], next_cursor
+
+
+async def save_exchange(chat_id: str, user_message: Dict[str, Any], assistant_message: Dict[str, Any]) -> None:
+    """
+    Writes a user/assistant message pair in a single insert and bumps the chat's
+    updated_at concurrently.
+    """
+    db = get_db()
+    docs = [
+        {"chat_id": chat_id, **user_message},
+        {"chat_id": chat_id, **assistant_message},
+    ]
+    await asyncio.gather(
+        db[MESSAGES_COLLECTION].insert_many(docs, ordered=True),
+        db[CHATS_COLLECTION].update_one(
+            {"chat_id": chat_id}, {"$set": {"updated_at": assistant_message["timestamp"]}}
+        ),
+    )
@@ -0,0 +1,172 @@
+"""
+Admission control for interactive aggregations.
+
+Before a pipeline runs, its leading $match (with a following $sort/$limit) is
+explained. A collection scan is costed at the collection's size; an index plan
+at the number of matching documents, counted with a limit just above the budget
+so the check itself stays cheap. A top-k served in index order is free.
+Pipelines over COST_GUARD_MAX_DOCS_EXAMINED are rejected, or downgraded to run
+on a random $sample, depending on COST_GUARD_ACTION.
+
+Every pipeline also runs with a server-side maxTimeMS. A timeout is reported as
+QueryTooExpensive, just like a rejection, so the user gets a clear message
+instead of a hang.
+"""
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo.errors import ExecutionTimeout
+
+import metrics
+from cache import LRUCache
+from result_cache import pipeline_key
+
+logger = logging.getLogger(__name__)
+
+# "downgrade": run over-budget pipelines on a $sample, "reject": refuse them, "off": no checks.
+COST_GUARD_ACTION = os.getenv("COST_GUARD_ACTION", "downgrade").lower()
+COST_GUARD_MAX_DOCS_EXAMINED = int(os.getenv("COST_GUARD_MAX_DOCS_EXAMINED", "1000000"))
+COST_GUARD_SAMPLE_SIZE = int(os.getenv("COST_GUARD_SAMPLE_SIZE", "10000"))
+COST_GUARD_EXPLAIN_MAX_TIME_MS = int(os.getenv("COST_GUARD_EXPLAIN_MAX_TIME_MS", "2000"))
+AGGREGATION_MAX_TIME_MS = int(os.getenv("AGGREGATION_MAX_TIME_MS", "15000"))
+
+# Stages that must consume every input document before emitting anything.
+_BLOCKING_STAGES = {"$group", "$count", "$sort", "$bucket", "$bucketAuto", "$sortByCount", "$facet"}
+_UNKNOWN = -1
+
+# pipeline key -> estimated documents examined (_UNKNOWN when it could not be estimated)
+_estimates = LRUCache(max_entries=1024, ttl_seconds=300)
+metrics.register_cache("cost_estimates", _estimates.stats)
+
+
+class QueryTooExpensive(Exception):
+    """Raised with a user-facing message when a pipeline is over budget or times out."""
+
+
+def _stage_name(stage: Dict[str, Any]) -> Optional[str]:
+    return next(iter(stage)) if len(stage) == 1 else None
+
+
+def _leading_match(pipeline: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], int]:
+    """The filter of the leading $match stages, and the index of the first other stage."""
+    filters = []
+    i = 0
+    while i < len(pipeline) and _stage_name(pipeline[i]) == "$match":
+        filters.append(pipeline[i]["$match"])
+        i += 1
+    if not filters:
+        return {}, i
+    return (filters[0] if len(filters) == 1 else {"$and": filters}), i
+
+
+def _is_streaming(pipeline: List[Dict[str, Any]], start: int) -> bool:
+    """
+    True when documents flow to the client as soon as they match: the caller stops
+    reading after a batch, so the server never scans the rest of the collection.
+    """
+    for stage in pipeline[start:]:
+        name = _stage_name(stage)
+        if name == "$limit":
+            return True
+        if name in _BLOCKING_STAGES:
+            return False
+    return True
+
+
+def _winning_stages(plan: Any, inside: bool = False) -> set:
+    """Stage names ("COLLSCAN", "IXSCAN", "SORT" ...) of the winning plans in an explain."""
+    found = set()
+    if isinstance(plan, dict):
+        if inside and isinstance(plan.get("stage"), str):
+            found.add(plan["stage"])
+        for key, value in plan.items():
+            if key != "rejectedPlans":
+                found |= _winning_stages(value, inside or key == "winningPlan")
+    elif isinstance(plan, list):
+        for value in plan:
+            found |= _winning_stages(value, inside)
+    return found
+
+
+async def estimate_docs_examined(collection, pipeline: List[Dict[str, Any]]) -> Optional[int]:
+    """
+    Upper estimate of the documents `pipeline` examines, capped just above the
+    budget. None when the pipeline is cheap by construction or cannot be costed.
+    """
+    if not pipeline or _stage_name(pipeline[0]) in ("$sample", "$geoNear", "$search"):
+        return None
+    match, start = _leading_match(pipeline)
+    if _is_streaming(pipeline, start):
+        return None
+    prefix = [{"$match": match}]
+    if start < len(pipeline) and _stage_name(pipeline[start]) == "$sort":
+        prefix.append(pipeline[start])
+        if start + 1 < len(pipeline) and _stage_name(pipeline[start + 1]) == "$limit":
+            prefix.append(pipeline[start + 1])
+
+    key = pipeline_key(collection.name, prefix)
+    cached = _estimates.get(key)
+    if cached is not None:
+        return None if cached == _UNKNOWN else cached
+
+    estimate: Optional[int] = None
+    try:
+        plan = await collection.database.command(
+            {
+                "explain": {"aggregate": collection.name, "pipeline": prefix, "cursor": {}},
+                "verbosity": "queryPlanner",
+            },
+            maxTimeMS=COST_GUARD_EXPLAIN_MAX_TIME_MS,
+        )
+        stages = _winning_stages(plan)
+        if "COLLSCAN" in stages:
+            estimate = await collection.estimated_document_count()
+        elif len(prefix) == 3 and "SORT" not in stages:
+            estimate = None  # top-k read straight off an index in sort order
+        else:
+            estimate = await collection.count_documents(
+                match, limit=COST_GUARD_MAX_DOCS_EXAMINED + 1, maxTimeMS=COST_GUARD_EXPLAIN_MAX_TIME_MS
+            )
+    except ExecutionTimeout:
+        estimate = COST_GUARD_MAX_DOCS_EXAMINED + 1  # even counting the matches is too slow
+    except Exception as e:
+        # Fall back to maxTimeMS alone; a failed estimate must not block the query.
+        logger.info(f"Cost estimate failed, relying on maxTimeMS: {e}")
+
+    _estimates.set(key, _UNKNOWN if estimate is None else estimate)
+    return estimate
+
+
+async def admit(collection, pipeline: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Returns the pipeline to run and, when it was downgraded, a note for the user.
+    Raises QueryTooExpensive when the pipeline is over budget and COST_GUARD_ACTION
+    is "reject".
+    """
+    if COST_GUARD_ACTION == "off":
+        return pipeline, None
+    estimate = await estimate_docs_examined(collection, pipeline)
+    if estimate is None or estimate <= COST_GUARD_MAX_DOCS_EXAMINED:
+        return pipeline, None
+
+    logger.warning(f"Pipeline over budget (~{estimate} docs examined): {pipeline}")
+    if COST_GUARD_ACTION == "reject":
+        raise QueryTooExpensive(
+            f"This question would scan more than {COST_GUARD_MAX_DOCS_EXAMINED:,} documents, which is over the "
+            "limit for chat queries. Try narrowing it down (for example to an organisation or a date range), "
+            "or ask for a CSV/Excel report instead."
+        )
+    note = (
+        f"Note: this answer is based on a random sample of {COST_GUARD_SAMPLE_SIZE:,} documents, because "
+        f"the full query would scan more than {COST_GUARD_MAX_DOCS_EXAMINED:,}. Counts and totals refer to "
+        "the sample; narrow the question down (for example to an organisation or a date range) for exact figures."
+    )
+    return [{"$sample": {"size": COST_GUARD_SAMPLE_SIZE}}] + pipeline, note
+
+
+def timeout_error() -> QueryTooExpensive:
+    return QueryTooExpensive(
+        f"The query took longer than {AGGREGATION_MAX_TIME_MS / 1000:g} seconds and was stopped. "
+        "Try narrowing it down (for example to an organisation or a date range), or ask for a CSV/Excel report instead."
+    )
@@ -1,60 +1,43 @@
 from __future__ import annotations
 
-import json
-from datetime import date, datetime, time
-from decimal import Decimal
+import asyncio
+import re
 from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-from bson import Decimal128, ObjectId
-
-from db import DB_NAME, get_db
+from db import DB_NAME, collection_names, get_db
+from serialization import dumps, to_jsonable
 
 MAX_DOCS = 200
 DEFAULT_SCAN_LIMIT = 500
 DEFAULT_SEARCH_RESULTS = 30
 
 
-def _to_jsonable(value: Any) -> Any:
-    if isinstance(value, ObjectId):
-        return str(value)
-    if isinstance(value, (datetime, date, time)):
-        try:
-            return value.isoformat()
-        except Exception:
-            return str(value)
-    if isinstance(value, Decimal128):
-        return value.to_decimal()
-    if isinstance(value, Decimal):
-        return float(value)
-    if isinstance(value, bytes):
-        return value.decode("utf-8", errors="replace")
-    if isinstance(value, dict):
-        return {str(k): _to_jsonable(v) for k, v in value.items()}
-    if isinstance(value, (list, tuple)):
-        return [_to_jsonable(v) for v in value]
-    return value
+def dumps_json(value: Any) -> str:
+    return dumps(value)
 
 
-def dumps_json(value: Any) -> str:
-    return json.dumps(_to_jsonable(value), ensure_ascii=False, default=str)
+async def _estimated_count(db, name: str) -> Optional[int]:
+    try:
+        return await db[name].estimated_document_count()
+    except Exception:
+        return None
 
 
 async def list_collections() -> List[Dict[str, Any]]:
     db = get_db()
-    names = await db.list_collection_names()
-    collections: List[Dict[str, Any]] = []
-    for name in sorted(names):
-        try:
-            count = await db[name].estimated_document_count()
-        except Exception:
-            count = None
-        collections.append({"name": name, "estimated_document_count": count})
-    return collections
+    names = sorted(await collection_names())
+    counts = await asyncio.gather(*(_estimated_count(db, name) for name in names))
+    return [
+        {"name": name, "estimated_document_count": count}
+        for name, count in zip(names, counts)
+    ]
 
 
 async def _ensure_collection_exists(collection: str) -> None:
-    db = get_db()
-    names = await db.list_collection_names()
+    names = await collection_names()
+    if collection not in names:
+        # The cached catalog may predate the collection; check once more before failing.
+        names = await collection_names(refresh=True)
     if collection not in names:
         if not names:
             raise ValueError(
@@ -131,7 +114,7 @@ async def find_documents(
     if sort_spec:
         cursor = cursor.sort(sort_spec)
     docs = await cursor.limit(_clamp_limit(limit)).to_list(length=_clamp_limit(limit))
-    return _to_jsonable(docs)
+    return to_jsonable(docs)
 
 
 async def aggregate_documents(
@@ -148,7 +131,7 @@ async def aggregate_documents(
     db = get_db()
     cursor = db[collection].aggregate(pipeline, allowDiskUse=False)
     docs = await cursor.to_list(length=_clamp_limit(limit, default=MAX_DOCS))
-    return _to_jsonable(docs)
+    return to_jsonable(docs)
 
 
 async def count_documents(
@@ -181,82 +164,82 @@ async def find_one_document(
     return docs[0]
 
 
-def _tokenize_query(query: str) -> List[str]:
-    raw = (query or "").lower()
-    tokens: List[str] = []
-    current: List[str] = []
-    for ch in raw:
-        if ch.isalnum():
-            current.append(ch)
-        else:
-            if current:
-                tokens.append("".join(current))
-                current = []
-    if current:
-        tokens.append("".join(current))
-
-    stop = {
-        "the",
-        "a",
-        "an",
-        "and",
-        "or",
-        "to",
-        "of",
-        "in",
-        "on",
-        "for",
-        "with",
-        "is",
-        "are",
-        "was",
-        "were",
-        "be",
-        "been",
-        "it",
-        "this",
-        "that",
-        "these",
-        "those",
-        "i",
-        "you",
-        "we",
-        "they",
-        "he",
-        "she",
-        "them",
-        "his",
-        "her",
-        "their",
-        "my",
-        "your",
-        "our",
-        "as",
-        "at",
-        "by",
-        "from",
-        "not",
-        "do",
-        "does",
-        "did",
-        "can",
-        "could",
-        "should",
-        "would",
-        "what",
-        "which",
-        "who",
-        "whom",
-        "when",
-        "where",
-        "why",
-        "how",
-    }
+_STOPWORDS = {
+    "the",
+    "a",
+    "an",
+    "and",
+    "or",
+    "to",
+    "of",
+    "in",
+    "on",
+    "for",
+    "with",
+    "is",
+    "are",
+    "was",
+    "were",
+    "be",
+    "been",
+    "it",
+    "this",
+    "that",
+    "these",
+    "those",
+    "i",
+    "you",
+    "we",
+    "they",
+    "he",
+    "she",
+    "them",
+    "his",
+    "her",
+    "their",
+    "my",
+    "your",
+    "our",
+    "as",
+    "at",
+    "by",
+    "from",
+    "not",
+    "do",
+    "does",
+    "did",
+    "can",
+    "could",
+    "should",
+    "would",
+    "what",
+    "which",
+    "who",
+    "whom",
+    "when",
+    "where",
+    "why",
+    "how",
+}
+
+
+# Runs of alphanumeric characters: the same split as str.isalnum(), but in C.
+_TOKEN_RE = re.compile(r"[^\W_]+")
+
+
+def _split_tokens(query: str) -> List[str]:
+    return _TOKEN_RE.findall((query or "").lower())
+
+
+def content_tokens(text: str, min_length: int = 1) -> List[str]:
+    """Lowercased words of `text` other than stopwords, in order and with repeats."""
+    return [t for t in _split_tokens(text) if len(t) >= min_length and t not in _STOPWORDS]
+
+
+def tokenize_query(query: str) -> List[str]:
     uniq: List[str] = []
     seen = set()
-    for t in tokens:
-        if len(t) < 3 or t in stop:
-            continue
+    for t in content_tokens(query, min_length=3):
         if t in seen:
             continue
         seen.add(t)
@@ -264,6 +247,25 @@ def _tokenize_query(query: str) -> List[str]:
     return uniq[:12]
 
 
+# Words that flip, bound or combine conditions. Search can ignore them, cache keys cannot:
+# "events that are not safe" and "events that are safe" need different pipelines, and so
+# do "nudity and minor true" and "nudity or minor true".
+_KEY_WORDS = {
+    "not", "no", "without", "except", "above", "below", "before", "after", "over",
+    "under", "more", "less", "than", "between", "only", "and", "or", "nor",
+}
+
+
+def normalize_question(query: str) -> str:
+    """
+    Canonical form of a question for cache lookups: lowercased, punctuation and
+    stopwords dropped, whitespace collapsed. Unlike tokenize_query, short tokens
+    and digits are kept because they usually change the answer ("top 5", "day 10"),
+    and so are negations and comparisons (_KEY_WORDS).
+    """
+    return " ".join(t for t in _split_tokens(query) if t in _KEY_WORDS or t not in _STOPWORDS)
+
+
 def _score_doc(doc: Any, tokens: List[str], query: str) -> int:
     try:
         text = dumps_json(doc).lower()
@@ -294,7 +296,8 @@ async def search_documents_text(
     """
     Best-effort search when schema is unknown.
 
-    - Tries MongoDB $text if an index exists, otherwise falls back to client-side scoring.
+    - Tries MongoDB $text if an index exists, then the in-process BM25 index over the
+      knowledge collection (text_index), otherwise falls back to client-side scoring.
     - Returns up to return_limit documents.
     """
     await _ensure_collection_exists(collection)
@@ -317,17 +320,29 @@ async def search_documents_text(
         for d in docs:
             if isinstance(d, dict):
                 d.pop("score", None)
-        return _to_jsonable(docs)
+        return to_jsonable(docs)
     except Exception:
         pass
 
-    # Fallback: scan a limited number of docs and score client-side.
+    # Inverted index: covers the whole collection, one round trip to fetch the hits.
+    from text_index import get_index
+
+    index = get_index(collection)
+    if index is not None:
+        ids = await asyncio.to_thread(index.search, query, limit)
+        if not ids:
+            return []
+        hits = await db[collection].find({"_id": {"$in": ids}}, projection).to_list(length=len(ids))
+        by_id = {d.get("_id"): d for d in hits}
+        return to_jsonable([by_id[i] for i in ids if i in by_id])
+
+    # Fallback (index still building): scan a limited number of docs and score client-side.
     scan = max(1, int(scan_limit) if scan_limit else DEFAULT_SCAN_LIMIT)
     scan = min(5000, scan)
     cursor2 = db[collection].find({}, projection).limit(scan)
     docs2 = await cursor2.to_list(length=scan)
 
-    tokens = _tokenize_query(query)
+    tokens = tokenize_query(query)
     scored: List[Tuple[int, Any]] = []
     for d in docs2:
         s = _score_doc(d, tokens, query)
@@ -335,4 +350,4 @@ async def search_documents_text(
             scored.append((s, d))
     scored.sort(key=lambda x: x[0], reverse=True)
     top = [d for _, d in scored[:limit]]
-    return _to_jsonable(top)
+    return to_jsonable(top)
@@ -1,4 +1,6 @@
+import asyncio
 import os
+import time
 from pathlib import Path
 from typing import List, Optional
 
@@ -17,8 +19,34 @@ KNOWLEDGE_COLLECTION_ALIASES: List[str] = list(
     dict.fromkeys([KNOWLEDGE_COLLECTION, "mycollection", "products", "orders", "ordes"])
 )
 
+# App bookkeeping lives in the same database; these are never knowledge collections.
+CHATS_COLLECTION = os.getenv("CHATS_COLLECTION", "chats")
+MESSAGES_COLLECTION = os.getenv("MESSAGES_COLLECTION", "chat_messages")
+INDEX_ADVISOR_COLLECTION = os.getenv("INDEX_ADVISOR_COLLECTION", "index_advisor")
+ROLLUP_COLLECTION = os.getenv("ROLLUP_COLLECTION", "moderation_rollups")
+ROLLUP_STATE_COLLECTION = os.getenv("ROLLUP_STATE_COLLECTION", "moderation_rollups_state")
+ROLLUP_SEEN_COLLECTION = os.getenv("ROLLUP_SEEN_COLLECTION", "moderation_rollups_seen")
+NORMALIZED_COLLECTION = os.getenv("NORMALIZED_COLLECTION", "events_normalized")
+NORMALIZER_STATE_COLLECTION = os.getenv("NORMALIZER_STATE_COLLECTION", "events_normalized_state")
+REPORT_JOBS_COLLECTION = os.getenv("REPORT_JOBS_COLLECTION", "report_jobs")
+INTERNAL_COLLECTIONS = {
+    CHATS_COLLECTION, MESSAGES_COLLECTION, INDEX_ADVISOR_COLLECTION, ROLLUP_COLLECTION, ROLLUP_STATE_COLLECTION,
+    ROLLUP_SEEN_COLLECTION, NORMALIZED_COLLECTION, NORMALIZER_STATE_COLLECTION, REPORT_JOBS_COLLECTION,
+}
+
+# Report exports use their own small connection pool so long-running cursors
+# cannot exhaust the connections interactive chat queries rely on.
+REPORT_DB_MAX_POOL_SIZE = int(os.getenv("REPORT_DB_MAX_POOL_SIZE", "4"))
+
+# Collection names change rarely; tool calls check them on every request.
+COLLECTION_CATALOG_TTL_SECONDS = float(os.getenv("COLLECTION_CATALOG_TTL_SECONDS", "60"))
+
 client = None
+report_client = None
 _knowledge_collection_cache: Optional[str] = None
+_catalog: Optional[List[str]] = None
+_catalog_loaded_at = 0.0
+_catalog_lock: Optional[asyncio.Lock] = None
 
 def get_client():
     global client
@@ -34,6 +62,53 @@ def get_db():
     return get_client()[DB_NAME]
 
 
+def get_report_db():
+    global report_client
+    if report_client is None:
+        report_client = AsyncIOMotorClient(
+            MONGO_URL,
+            serverSelectionTimeoutMS=5000,
+            connectTimeoutMS=5000,
+            maxPoolSize=REPORT_DB_MAX_POOL_SIZE,
+        )
+    return report_client[DB_NAME]
+
+
+def _catalog_fresh() -> bool:
+    return _catalog is not None and time.monotonic() - _catalog_loaded_at < COLLECTION_CATALOG_TTL_SECONDS
+
+
+async def collection_names(refresh: bool = False) -> List[str]:
+    """
+    Collection names of the current DB, cached for COLLECTION_CATALOG_TTL_SECONDS.
+    Concurrent callers share a single list_collection_names() round trip.
+    """
+    global _catalog, _catalog_loaded_at, _catalog_lock, _knowledge_collection_cache
+    if not refresh and _catalog_fresh():
+        return _catalog
+    if _catalog_lock is None:
+        _catalog_lock = asyncio.Lock()
+    loaded_at = _catalog_loaded_at
+    async with _catalog_lock:
+        # Someone else refreshed while we waited.
+        if _catalog_loaded_at != loaded_at and _catalog_fresh():
+            return _catalog
+        _catalog = await get_db().list_collection_names()
+        _catalog_loaded_at = time.monotonic()
+        _knowledge_collection_cache = None
+    return _catalog
+
+
+def invalidate_collection_catalog() -> None:
+    """
+    Forces the next collection_names() call to hit the database, and the knowledge
+    collection to be resolved again.
+    """
+    global _catalog, _knowledge_collection_cache
+    _catalog = None
+    _knowledge_collection_cache = None
+
+
 async def resolve_knowledge_collection() -> str:
     """
     Returns the best matching knowledge collection name in the current DB.
@@ -43,13 +118,13 @@ async def resolve_knowledge_collection() -> str:
     if _knowledge_collection_cache:
         return _knowledge_collection_cache
 
-    db = get_db()
     try:
-        existing = await db.list_collection_names()
+        existing = await collection_names()
     except Exception:
         _knowledge_collection_cache = KNOWLEDGE_COLLECTION
         return _knowledge_collection_cache
 
+    existing = [name for name in existing if name not in INTERNAL_COLLECTIONS]
     existing_lower = {name.lower(): name for name in existing}
     for alias in KNOWLEDGE_COLLECTION_ALIASES:
         match = existing_lower.get(alias.lower())
@@ -66,4 +141,13 @@ async def resolve_knowledge_collection() -> str:
 
 
 async def create_indexes():
-    return
+    db = get_db()
+    await db[CHATS_COLLECTION].create_index("chat_id", unique=True)
+    await db[CHATS_COLLECTION].create_index([("updated_at", -1), ("chat_id", -1)])
+    await db[MESSAGES_COLLECTION].create_index([("chat_id", 1), ("timestamp", 1), ("_id", 1)])
+    await db[ROLLUP_COLLECTION].create_index([("orgId", 1), ("hour", 1)])
+    await db[ROLLUP_COLLECTION].create_index("hour")
+    await db[ROLLUP_SEEN_COLLECTION].create_index([("orgId", 1), ("hour", 1)])
+    await db[NORMALIZED_COLLECTION].create_index("eventStartTime")
+    await db[NORMALIZED_COLLECTION].create_index([("orgId", 1), ("eventStartTime", 1)])
+    await db[REPORT_JOBS_COLLECTION].create_index("expires_at", expireAfterSeconds=0)
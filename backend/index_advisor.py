@@ -0,0 +1,265 @@
+"""
+Index advisor for LLM-generated pipelines.
+
+execute_aggregation reports every pipeline it runs. The advisor reduces each
+one to a query shape: equality, sort and range fields of the leading $match and
+$sort stages. The first time a shape is seen, its explain plan is checked for
+COLLSCAN. Shape counts are flushed periodically to the index_advisor
+collection, so recommendations survive restarts and are shared across workers.
+
+Recommended indexes follow the equality-sort-range rule. They are created at
+startup when INDEX_ADVISOR_AUTO_CREATE is enabled, and are otherwise only
+reported through the admin endpoints.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+
+from db import INDEX_ADVISOR_COLLECTION, get_db
+
+logger = logging.getLogger(__name__)
+
+INDEX_ADVISOR_ENABLED = os.getenv("INDEX_ADVISOR_ENABLED", "true").lower() == "true"
+INDEX_ADVISOR_AUTO_CREATE = os.getenv("INDEX_ADVISOR_AUTO_CREATE", "false").lower() == "true"
+INDEX_ADVISOR_MIN_HITS = int(os.getenv("INDEX_ADVISOR_MIN_HITS", "5"))
+INDEX_ADVISOR_FLUSH_SECONDS = float(os.getenv("INDEX_ADVISOR_FLUSH_SECONDS", "60"))
+INDEX_ADVISOR_MAX_FIELDS = 4
+
+_EQUALITY_OPS = {"$eq", "$in"}
+_RANGE_OPS = {"$gt", "$gte", "$lt", "$lte", "$ne", "$nin", "$exists", "$regex"}
+
+# shape key -> {"collection", "equality", "sort", "range", "hits", "collscan"}
+_shapes: Dict[str, Dict[str, Any]] = {}
+_pending_hits: Dict[str, int] = {}
+_explaining: set = set()
+# Strong references to running explain tasks; the event loop only keeps weak ones.
+_explain_tasks: Set[asyncio.Task] = set()
+_flusher: Optional[asyncio.Task] = None
+
+
+def _match_fields(match: Dict[str, Any], equality: List[str], ranges: List[str]) -> None:
+    for key, value in match.items():
+        if key == "$and" and isinstance(value, list):
+            for clause in value:
+                if isinstance(clause, dict):
+                    _match_fields(clause, equality, ranges)
+            continue
+        if key.startswith("$"):
+            continue  # $or / $expr / $text cannot use a single compound index prefix
+        if isinstance(value, dict) and value and all(k.startswith("$") for k in value):
+            ops = set(value)
+            if ops & _EQUALITY_OPS and not ops & _RANGE_OPS:
+                equality.append(key)
+            elif ops & (_RANGE_OPS | _EQUALITY_OPS):
+                ranges.append(key)
+        else:
+            equality.append(key)
+
+
+def query_shape(pipeline: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Field sets of the leading $match stages and the $sort right after them.
+    Returns None when there is nothing an index could serve.
+    """
+    equality: List[str] = []
+    ranges: List[str] = []
+    sort: List[Tuple[str, int]] = []
+    for stage in pipeline:
+        if "$match" in stage and isinstance(stage["$match"], dict):
+            _match_fields(stage["$match"], equality, ranges)
+            continue
+        if "$sort" in stage and isinstance(stage["$sort"], dict):
+            sort = [(k, v) for k, v in stage["$sort"].items() if v in (1, -1)]
+        break
+
+    equality = list(dict.fromkeys(equality))
+    ranges = [f for f in dict.fromkeys(ranges) if f not in equality]
+    if not equality and not sort and not ranges:
+        return None
+    if equality == ["_id"] and not sort:
+        return None
+    return {"equality": equality, "sort": sort, "range": ranges}
+
+
+def recommended_index(shape: Dict[str, Any]) -> List[Tuple[str, int]]:
+    keys: List[Tuple[str, int]] = [(f, 1) for f in shape["equality"]]
+    seen = set(shape["equality"])
+    for field, direction in shape["sort"]:
+        if field not in seen:
+            keys.append((field, direction))
+            seen.add(field)
+    for field in shape["range"]:
+        if field not in seen:
+            keys.append((field, 1))
+            seen.add(field)
+    return keys[:INDEX_ADVISOR_MAX_FIELDS]
+
+
+def _shape_key(collection: str, shape: Dict[str, Any]) -> str:
+    return json.dumps([collection, shape["equality"], shape["sort"], shape["range"]])
+
+
+def _has_collscan(plan: Any) -> bool:
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(_has_collscan(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(v) for v in plan)
+    return False
+
+
+async def _explain(key: str, collection: str, pipeline: List[Dict[str, Any]]) -> None:
+    try:
+        plan = await get_db().command(
+            {"explain": {"aggregate": collection, "pipeline": pipeline, "cursor": {}}, "verbosity": "queryPlanner"}
+        )
+        _shapes[key]["collscan"] = _has_collscan(plan)
+        if _shapes[key]["collscan"]:
+            logger.info(f"COLLSCAN for {key}; recommended index {recommended_index(_shapes[key])}")
+    except Exception as e:
+        logger.info(f"Explain failed for {key}: {e}")
+    finally:
+        _explaining.discard(key)
+
+
+def observe(collection: str, pipeline: List[Dict[str, Any]]) -> None:
+    """
+    Records a pipeline about to run. Never blocks: the first sighting of a shape
+    schedules an explain in the background.
+    """
+    if not INDEX_ADVISOR_ENABLED:
+        return
+    shape = query_shape(pipeline)
+    if shape is None:
+        return
+    key = _shape_key(collection, shape)
+    entry = _shapes.get(key)
+    if entry is None:
+        entry = _shapes[key] = {"collection": collection, **shape, "hits": 0, "collscan": None}
+    entry["hits"] += 1
+    _pending_hits[key] = _pending_hits.get(key, 0) + 1
+    if entry["collscan"] is None and key not in _explaining:
+        _explaining.add(key)
+        task = asyncio.create_task(_explain(key, collection, pipeline))
+        _explain_tasks.add(task)
+        task.add_done_callback(_explain_tasks.discard)
+
+
+def recommendations(min_hits: int = 1) -> List[Dict[str, Any]]:
+    out = []
+    for entry in sorted(_shapes.values(), key=lambda e: e["hits"], reverse=True):
+        if not entry["collscan"] or entry["hits"] < min_hits:
+            continue
+        out.append({
+            "collection": entry["collection"],
+            "index": recommended_index(entry),
+            "hits": entry["hits"],
+            "equality": entry["equality"],
+            "sort": entry["sort"],
+            "range": entry["range"],
+        })
+    return out
+
+
+def _key_pattern(key: Any) -> List[Tuple[str, Any]]:
+    return [(f, int(d) if isinstance(d, (int, float)) else d) for f, d in key]
+
+
+async def apply_recommendations(min_hits: int = INDEX_ADVISOR_MIN_HITS) -> List[Dict[str, Any]]:
+    """
+    Creates the recommended indexes, skipping any whose key pattern is already
+    covered as a prefix of an existing index.
+    """
+    db = get_db()
+    created = []
+    for rec in recommendations(min_hits):
+        keys = [tuple(k) for k in rec["index"]]
+        existing = await db[rec["collection"]].index_information()
+        if any(_key_pattern(info["key"])[: len(keys)] == keys for info in existing.values()):
+            continue
+        name = await db[rec["collection"]].create_index(keys)
+        logger.info(f"Created index {name} on {rec['collection']}")
+        created.append({**rec, "name": name})
+
+    # Plans change once indexes exist; re-explain shapes on their next sighting.
+    for entry in _shapes.values():
+        entry["collscan"] = None
+    return created
+
+
+async def flush() -> None:
+    if not _pending_hits:
+        return
+    pending = dict(_pending_hits)
+    _pending_hits.clear()
+    ops = []
+    for key, hits in pending.items():
+        entry = _shapes[key]
+        update: Dict[str, Any] = {
+            "$inc": {"hits": hits},
+            "$setOnInsert": {
+                "collection": entry["collection"],
+                "equality": entry["equality"],
+                "sort": entry["sort"],
+                "range": entry["range"],
+            },
+        }
+        if entry["collscan"] is not None:
+            update["$set"] = {"collscan": entry["collscan"]}
+        ops.append(UpdateOne({"_id": key}, update, upsert=True))
+    try:
+        await get_db()[INDEX_ADVISOR_COLLECTION].bulk_write(ops, ordered=False)
+    except Exception as e:
+        logger.warning(f"Could not persist index advisor stats: {e}")
+        for key, hits in pending.items():
+            _pending_hits[key] = _pending_hits.get(key, 0) + hits
+
+
+async def load() -> None:
+    async for doc in get_db()[INDEX_ADVISOR_COLLECTION].find({}):
+        entry = _shapes.setdefault(doc["_id"], {
+            "collection": doc["collection"],
+            "equality": doc.get("equality", []),
+            "sort": [tuple(s) for s in doc.get("sort", [])],
+            "range": doc.get("range", []),
+            "hits": 0,
+            "collscan": doc.get("collscan"),
+        })
+        entry["hits"] += int(doc.get("hits", 0))
+
+
+async def _flush_forever() -> None:
+    while True:
+        await asyncio.sleep(INDEX_ADVISOR_FLUSH_SECONDS)
+        await flush()
+
+
+async def start() -> None:
+    global _flusher
+    if not INDEX_ADVISOR_ENABLED:
+        return
+    try:
+        await load()
+        if INDEX_ADVISOR_AUTO_CREATE:
+            await apply_recommendations()
+    except Exception as e:
+        logger.warning(f"Index advisor startup failed: {e}")
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.create_task(_flush_forever())
+
+
+async def stop() -> None:
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        await asyncio.gather(_flusher, return_exceptions=True)
+        _flusher = None
+    for task in list(_explain_tasks):
+        task.cancel()
+    await asyncio.gather(*_explain_tasks, return_exceptions=True)
+    await flush()
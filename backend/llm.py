@@ -1,30 +1,49 @@
 import os
-import requests
 import json
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
 from dotenv import load_dotenv
 
+import metrics
+from llm_gateway import LLMOverloaded, admission
+
 # Load environment variables
 load_dotenv()
 
 # Configuration
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-API_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+API_URL = f"{OPENROUTER_BASE_URL}/chat/completions"
 MODEL_ID = "arcee-ai/trinity-large-preview:free"
 
-def query_llm(message: str, history: list = []):
+CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "5"))
+READ_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_http_client() -> httpx.AsyncClient:
     """
-    Sends a message to the OpenRouter API.
-    
-    Args:
-        message (str): The user's input message.
-        history (list): List of previous messages [{"role": "user", "content": "..."}, ...]
-        
-    Returns:
-        dict: The response from the model or an error message.
+    Shared pooled client: connections to OpenRouter are kept alive across calls.
     """
-    if not OPENROUTER_API_KEY:
-        return {"error": "OPENROUTER_API_KEY is missing. Please check your .env file."}
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+    return _http_client
+
+
+async def close_http_client() -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
 
+
+def _request(message: str, history: Optional[List[Dict[str, Any]]], stream: bool):
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json",
@@ -33,7 +52,7 @@ def query_llm(message: str, history: list = []):
     }
 
     # Construct messages list with history
-    messages = history.copy()
+    messages = list(history or [])
     messages.append({"role": "user", "content": message})
 
     # OpenRouter uses the standard chat-completions format
@@ -41,17 +60,41 @@ def query_llm(message: str, history: list = []):
         "model": MODEL_ID,
         "messages": messages,
         "temperature": 0.7,
-        "max_tokens": 1024
+        "max_tokens": 1024,
+        "stream": stream,
     }
+    if stream:
+        # Token usage is only reported on a final chunk when asked for.
+        payload["stream_options"] = {"include_usage": True}
+    return headers, payload
+
+
+async def query_llm(message: str, history: Optional[List[Dict[str, Any]]] = None) -> Dict[str, str]:
+    """
+    Sends a message to the OpenRouter API.
+    
+    Args:
+        message (str): The user's input message.
+        history (list): List of previous messages [{"role": "user", "content": "..."}, ...]
+        
+    Returns:
+        dict: The response from the model or an error message.
+    """
+    if not OPENROUTER_API_KEY:
+        return {"error": "OPENROUTER_API_KEY is missing. Please check your .env file."}
+
+    headers, payload = _request(message, history, stream=False)
 
     try:
-        response = requests.post(API_URL, headers=headers, json=payload)
+        async with admission(MODEL_ID):
+            response = await _get_http_client().post(API_URL, headers=headers, json=payload)
         
         # OpenRouter might return 402 for payment required if free limits hit, or other codes
         if response.status_code != 200:
              return {"error": f"API Error {response.status_code}: {response.text}"}
 
         data = response.json()
+        metrics.record_llm_usage(MODEL_ID, data.get("usage"))
         
         # Parse standard chat completion response
         if "choices" in data and len(data["choices"]) > 0:
@@ -62,5 +105,54 @@ def query_llm(message: str, history: list = []):
         else:
             return {"error": "Unexpected response format from API."}
 
-    except requests.exceptions.RequestException as e:
+    except LLMOverloaded as e:
+        return {"error": str(e)}
+    except httpx.HTTPError as e:
         return {"error": f"Request failed: {str(e)}"}
+    except ValueError as e:
+        # Non-JSON body with a 200, e.g. a proxy error page.
+        return {"error": f"Request failed: {str(e)}"}
+
+
+async def stream_llm(message: str, history: Optional[List[Dict[str, Any]]] = None) -> AsyncIterator[Dict[str, str]]:
+    """
+    Streaming variant of query_llm. Yields {"response": <text chunk>} as tokens
+    arrive, or a single {"error": ...} with the same messages as query_llm.
+    """
+    if not OPENROUTER_API_KEY:
+        yield {"error": "OPENROUTER_API_KEY is missing. Please check your .env file."}
+        return
+
+    headers, payload = _request(message, history, stream=True)
+
+    try:
+        async with admission(MODEL_ID):
+            async with _get_http_client().stream("POST", API_URL, headers=headers, json=payload) as response:
+                if response.status_code != 200:
+                    body = (await response.aread()).decode("utf-8", errors="replace")
+                    yield {"error": f"API Error {response.status_code}: {body}"}
+                    return
+
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue  # blank separators and ": OPENROUTER PROCESSING" keep-alives
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        return
+                    try:
+                        chunk = json.loads(data)
+                    except ValueError:
+                        continue
+                    if "error" in chunk:
+                        yield {"error": f"API Error: {chunk['error']}"}
+                        return
+                    metrics.record_llm_usage(MODEL_ID, chunk.get("usage"))
+                    choices = chunk.get("choices") or []
+                    content = choices[0].get("delta", {}).get("content") if choices else None
+                    if content:
+                        yield {"response": content}
+
+    except LLMOverloaded as e:
+        yield {"error": str(e)}
+    except httpx.HTTPError as e:
+        yield {"error": f"Request failed: {str(e)}"}
@@ -0,0 +1,230 @@
+"""
+Shared gateway for every chat-completion call.
+
+Each model gets its own pooled AsyncOpenAI client plus a concurrency semaphore
+and a token-bucket rate limiter. Calls that cannot be admitted within
+LLM_MAX_QUEUE_WAIT_SECONDS fail fast with LLMOverloaded (surfaced as HTTP 503)
+instead of piling up. 429 and 5xx responses are retried with jittered
+exponential backoff.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+from openai import APIConnectionError, APIStatusError, APITimeoutError, AsyncOpenAI
+
+import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_RATE_PER_SECOND = float(os.getenv("LLM_RATE_PER_SECOND", "5"))
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "10"))
+LLM_MAX_QUEUE_WAIT_SECONDS = float(os.getenv("LLM_MAX_QUEUE_WAIT_SECONDS", "5"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+LLM_RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", "8"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "5"))
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", str(LLM_MAX_CONCURRENCY * 2)))
+LLM_POOL_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_POOL_KEEPALIVE_CONNECTIONS", str(LLM_MAX_CONCURRENCY)))
+LLM_POOL_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY_SECONDS", "30"))
+
+if not OPENROUTER_API_KEY:
+    logger.warning("OPENROUTER_API_KEY is not set. LLM features will fail.")
+
+
+class LLMOverloaded(Exception):
+    """Raised when a call could not be admitted within the queue-wait budget."""
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _ModelGateway:
+    def __init__(self, model: str):
+        self.model = model
+        self.client = AsyncOpenAI(
+            api_key=OPENROUTER_API_KEY,
+            base_url=OPENROUTER_BASE_URL,
+            max_retries=0,  # retries are handled here, with backoff and load shedding
+            http_client=httpx.AsyncClient(
+                timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+                limits=httpx.Limits(
+                    max_connections=LLM_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_POOL_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=LLM_POOL_KEEPALIVE_EXPIRY_SECONDS,
+                ),
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(max(1, LLM_MAX_CONCURRENCY))
+        self.bucket = _TokenBucket(LLM_RATE_PER_SECOND, LLM_RATE_BURST)
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def admit(self) -> None:
+        """
+        Waits for a concurrency slot and a rate-limit token, or raises LLMOverloaded.
+        """
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), timeout=LLM_MAX_QUEUE_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                raise LLMOverloaded("The assistant is busy right now. Please try again in a moment.")
+            remaining = LLM_MAX_QUEUE_WAIT_SECONDS - (time.monotonic() - started)
+            try:
+                await asyncio.wait_for(self.bucket.acquire(), timeout=max(0.0, remaining))
+            except BaseException as e:
+                # Timed out or cancelled (client gone) while holding the slot: give it back.
+                self.semaphore.release()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise LLMOverloaded("The assistant is busy right now. Please try again in a moment.")
+                raise
+        except LLMOverloaded:
+            _stats["shed"] += 1
+            raise
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self.semaphore.release()
+
+
+_gateways: Dict[str, _ModelGateway] = {}
+_stats = {"calls": 0, "retries": 0, "shed": 0, "errors": 0}
+
+
+def _gateway(model: str) -> _ModelGateway:
+    gw = _gateways.get(model)
+    if gw is None:
+        gw = _gateways[model] = _ModelGateway(model)
+    return gw
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (APIConnectionError, APITimeoutError)):
+        return True
+    if isinstance(exc, APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return False
+
+
+def _backoff_seconds(attempt: int, exc: Exception) -> float:
+    retry_after = None
+    response = getattr(exc, "response", None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_after = None
+    if retry_after is not None:
+        return min(LLM_RETRY_MAX_SECONDS, retry_after)
+    # Full jitter: spreads retries from a burst instead of re-synchronizing them.
+    return random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * (2 ** attempt)))
+
+
+async def _create_with_retries(gw: _ModelGateway, **kwargs: Any) -> Any:
+    attempt = 0
+    while True:
+        try:
+            return await gw.client.chat.completions.create(model=gw.model, **kwargs)
+        except Exception as e:
+            if attempt >= LLM_MAX_RETRIES or not _is_retryable(e):
+                _stats["errors"] += 1
+                raise
+            delay = _backoff_seconds(attempt, e)
+            logger.warning(f"LLM call failed ({e.__class__.__name__}); retrying in {delay:.2f}s")
+            _stats["retries"] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+async def chat_completion(model: str, messages: List[Dict[str, Any]], **kwargs: Any) -> Any:
+    """
+    Rate-limited, retried equivalent of client.chat.completions.create(...).
+    """
+    gw = _gateway(model)
+    await gw.admit()
+    _stats["calls"] += 1
+    try:
+        completion = await _create_with_retries(gw, messages=messages, **kwargs)
+        metrics.record_llm_usage(model, getattr(completion, "usage", None))
+        return completion
+    finally:
+        gw.release()
+
+
+async def stream_chat_completion(model: str, messages: List[Dict[str, Any]], **kwargs: Any) -> AsyncIterator[Any]:
+    """
+    Streaming variant of chat_completion; yields completion chunks. The
+    concurrency slot is held until the stream is exhausted or closed. Only
+    opening the stream is retried, never a partially consumed one.
+    """
+    gw = _gateway(model)
+    await gw.admit()
+    _stats["calls"] += 1
+    # Without this, OpenAI-compatible providers leave usage out of streamed responses.
+    kwargs.setdefault("stream_options", {"include_usage": True})
+    try:
+        stream = await _create_with_retries(gw, messages=messages, stream=True, **kwargs)
+        async for chunk in stream:
+            # Usage arrives on a final chunk with no choices.
+            metrics.record_llm_usage(model, getattr(chunk, "usage", None))
+            yield chunk
+    finally:
+        gw.release()
+
+
+@asynccontextmanager
+async def admission(model: str) -> AsyncIterator[None]:
+    """
+    Holds a concurrency slot and rate-limit token for `model` around a call made
+    with a different HTTP client (see llm.query_llm).
+    """
+    gw = _gateway(model)
+    await gw.admit()
+    _stats["calls"] += 1
+    try:
+        yield
+    finally:
+        gw.release()
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        **_stats,
+        "in_flight": sum(gw.in_flight for gw in _gateways.values()),
+        "waiting": sum(gw.waiting for gw in _gateways.values()),
+    }
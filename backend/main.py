@@ -1,22 +1,42 @@
 from __future__ import annotations
 
+import asyncio
+import hmac
+import json
 import logging
-from datetime import datetime
-from typing import Any, Dict, List
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from uuid import uuid4
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, Header, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import os
 
-from db import get_db
-from mcp_server import orchestrate_llm
+import chat_store
+import index_advisor
+import llm
+import llm_gateway
+import metrics
+import normalizer
+import result_cache
+import rollups
+import schema_profiler
+import temp_store
+import text_index
+from db import collection_names, create_indexes, get_db, invalidate_collection_catalog, resolve_knowledge_collection
+from llm_gateway import LLMOverloaded
+from mcp_server import orchestrate_llm, orchestrate_llm_events
+from query_generator import pipeline_cache
+from report_jobs import get_job_status, shutdown_workers
+from models import Chat, Message
 from utils import generate_title
 
 logger = logging.getLogger(__name__)
 
+metrics.install_trace_logging()
+
 app = FastAPI(title="MCP Chatbot API")
 
 # Ensure reports directory exists (in project root, one level up from backend)
@@ -24,8 +44,6 @@ app = FastAPI(title="MCP Chatbot API")
 REPORTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "reports")
 os.makedirs(REPORTS_DIR, exist_ok=True)
 
-app.mount("/reports", StaticFiles(directory=REPORTS_DIR), name="reports")
-
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -35,11 +53,22 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"] + ([metrics.TRACE_ID_HEADER] if metrics.TRACE_ID_HEADER else []),
 )
+app.add_middleware(metrics.MetricsMiddleware)
+
+metrics.register_cache("pipelines", pipeline_cache.stats)
+metrics.register_cache("results", result_cache.result_cache.stats)
+metrics.register_gauges("llm", llm_gateway.stats)
+metrics.register_gauges("temp_chats", temp_store.stats)
+
+
+FALLBACK_RESPONSE = "I couldn't generate a response right now. Please try again."
 
 
-CHATS: Dict[str, Dict[str, Any]] = {}
-MESSAGES: Dict[str, List[Dict[str, Any]]] = {}
+@app.exception_handler(LLMOverloaded)
+async def llm_overloaded_handler(request: Request, exc: LLMOverloaded):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "5"})
 
 
 @app.get("/")
@@ -47,15 +76,62 @@ def read_root():
     return {"status": "ok", "message": "MCP Chatbot API is running"}
 
 
+@app.on_event("startup")
+async def ensure_indexes():
+    try:
+        await create_indexes()
+    except Exception as e:
+        logger.warning(f"Could not create indexes at startup: {e}")
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    temp_store.start_sweeper()
+    knowledge_collection = await resolve_knowledge_collection()
+    result_cache.start_invalidation(knowledge_collection)
+    text_index.start(knowledge_collection)
+    rollups.start(knowledge_collection)
+    normalizer.start(knowledge_collection)
+    await index_advisor.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await shutdown_workers()
+    await temp_store.stop_sweeper()
+    await result_cache.stop_invalidation()
+    await index_advisor.stop()
+    await text_index.stop()
+    await llm.close_http_client()
+    await rollups.stop()
+    await normalizer.stop()
+    await asyncio.to_thread(pipeline_cache.flush)
+
+
 @app.get("/health")
 async def health():
     try:
         await get_db().command("ping")
-        return {"status": "ok"}
+        return {
+            "status": "ok",
+            "temp_chats": temp_store.stats(),
+            "caches": {
+                "pipelines": pipeline_cache.stats(),
+                "results": result_cache.result_cache.stats(),
+            },
+        }
     except Exception:
         raise HTTPException(status_code=503, detail="Database unavailable")
 
 
+@app.get("/metrics")
+def prometheus_metrics():
+    body = metrics.render()
+    if body is None:
+        raise HTTPException(status_code=503, detail="prometheus_client is not installed")
+    return Response(content=body, media_type=metrics.CONTENT_TYPE)
+
+
 class NewChatRequest(BaseModel):
     is_temporary: bool = False
     first_message: str
@@ -70,27 +146,108 @@ class LegacyChatRequest(BaseModel):
     message: str
 
 
-def _now_iso() -> str:
-    return datetime.utcnow().isoformat()
+def _temp_chat_out(chat: Chat) -> Dict[str, Any]:
+    return {
+        "chat_id": chat.chat_id,
+        "title": chat.title,
+        "created_at": chat.created_at.isoformat(),
+        "updated_at": chat.updated_at.isoformat(),
+        "is_temporary": True,
+    }
+
+
+def _temp_message_out(message: Message) -> Dict[str, Any]:
+    return {
+        "role": message.role,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+    }
 
 
-def _require_chat(chat_id: str) -> Dict[str, Any]:
-    chat = CHATS.get(chat_id)
+async def _require_chat(chat_id: str) -> Dict[str, Any]:
+    temp_chat = temp_store.get_temp_chat(chat_id)
+    chat = _temp_chat_out(temp_chat) if temp_chat else await chat_store.get_chat(chat_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     return chat
 
 
-def _append_message(chat_id: str, role: str, content: str) -> None:
-    MESSAGES.setdefault(chat_id, []).append(
-        {
-            "role": role,
-            "content": content,
-            "timestamp": _now_iso(),
-        }
+def _new_message(role: str, content: str) -> Dict[str, Any]:
+    return {"role": role, "content": content, "timestamp": chat_store.now()}
+
+
+def _history(chat: Dict[str, Any], user_message: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # orchestrate_llm only acts on the latest turn, so persistent chats skip the
+    # extra history read and pass just the pending message.
+    if chat.get("is_temporary"):
+        history = [_temp_message_out(m) for m in temp_store.get_temp_messages(chat["chat_id"])]
+        return history + [user_message]
+    return [user_message]
+
+
+async def _record_exchange(chat: Dict[str, Any], user_message: Dict[str, Any], response: str) -> None:
+    assistant_message = _new_message("assistant", response)
+    chat_id = chat["chat_id"]
+    if chat.get("is_temporary"):
+        for m in (user_message, assistant_message):
+            temp_store.add_temp_message(chat_id, Message(chat_id=chat_id, **m))
+        return
+    await chat_store.save_exchange(chat_id, user_message, assistant_message)
+
+
+async def _reply(chat: Dict[str, Any], content: str) -> str:
+    user_message = _new_message("user", content)
+    try:
+        response = await orchestrate_llm(content, _history(chat, user_message))
+    except LLMOverloaded:
+        raise
+    except Exception:
+        response = FALLBACK_RESPONSE
+    await _record_exchange(chat, user_message, response)
+    return response
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _sse_response(events: AsyncIterator[str]) -> StreamingResponse:
+    # Proxies such as nginx would otherwise buffer the events until the stream ends.
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
+def _stream_reply(chat: Dict[str, Any], content: str, prelude: Optional[Dict[str, Any]] = None) -> StreamingResponse:
+    """
+    Streams status updates and answer tokens as Server-Sent Events, then stores
+    the exchange once the stream completes. Events: `chat` (optional),
+    `status`, `token` and a final `done` carrying the full response.
+    """
+    user_message = _new_message("user", content)
+
+    async def events() -> AsyncIterator[str]:
+        if prelude:
+            yield _sse("chat", prelude)
+        parts: List[str] = []
+        try:
+            async for event, data in orchestrate_llm_events(content, _history(chat, user_message)):
+                if event == "token":
+                    parts.append(data)
+                yield _sse(event, data)
+        except LLMOverloaded as e:
+            # Headers are already sent, so report the 503 in-band and store nothing.
+            yield _sse("error", {"status": 503, "detail": str(e)})
+            return
+        response = "".join(parts) or FALLBACK_RESPONSE
+        await _record_exchange(chat, user_message, response)
+        yield _sse("done", {"chat_id": chat["chat_id"], "response": response})
+
+    return _sse_response(events())
+
+
 @app.post("/chat")
 async def legacy_chat(req: LegacyChatRequest):
     if not req.message.strip():
@@ -98,69 +255,90 @@ async def legacy_chat(req: LegacyChatRequest):
 
     try:
         response = await orchestrate_llm(req.message, [])
+    except LLMOverloaded:
+        raise
     except Exception:
-        response = "I couldn't generate a response right now. Please try again."
+        response = FALLBACK_RESPONSE
     return {"response": response}
 
 
+async def _new_chat(req: NewChatRequest) -> Dict[str, Any]:
+    if req.is_temporary:
+        title = generate_title(req.first_message) if req.first_message else "Temporary Chat"
+        return _temp_chat_out(temp_store.new_temp_chat(title))
+
+    title = generate_title(req.first_message) if req.first_message else "New chat"
+    return await chat_store.create_chat(str(uuid4()), title)
+
+
 @app.post("/chat/new")
 async def create_chat(req: NewChatRequest):
+    chat = await _new_chat(req)
     if req.is_temporary:
-        chat_id = str(uuid4())
-        CHATS[chat_id] = {
-            "chat_id": chat_id,
-            "title": generate_title(req.first_message) if req.first_message else "Temporary Chat",
-            "created_at": _now_iso(),
-            "updated_at": _now_iso(),
-            "is_temporary": True,
-        }
-        MESSAGES[chat_id] = []
-        return {"chat_id": chat_id, "is_temporary": True}
-
-    chat_id = str(uuid4())
-    CHATS[chat_id] = {
-        "chat_id": chat_id,
-        "title": generate_title(req.first_message) if req.first_message else "New chat",
-        "created_at": _now_iso(),
-        "updated_at": _now_iso(),
-        "is_temporary": False,
-    }
-    MESSAGES[chat_id] = []
-    _append_message(chat_id, "user", req.first_message)
+        return {"chat_id": chat["chat_id"], "is_temporary": True}
+
+    response = await _reply(chat, req.first_message)
+    return {"chat_id": chat["chat_id"], "is_temporary": False, "response": response}
 
-    try:
-        response = await orchestrate_llm(req.first_message, MESSAGES.get(chat_id, []))
-    except Exception:
-        response = "I couldn't generate a response right now. Please try again."
 
-    _append_message(chat_id, "assistant", response)
-    CHATS[chat_id]["updated_at"] = _now_iso()
-    return {"chat_id": chat_id, "is_temporary": False, "response": response}
+@app.post("/chat/new/stream")
+async def create_chat_stream(req: NewChatRequest):
+    chat = await _new_chat(req)
+    prelude = {"chat_id": chat["chat_id"], "is_temporary": req.is_temporary}
+    if req.is_temporary:
+        # Temporary chats get their first message through /chat/temp/message/stream.
+        async def only_prelude() -> AsyncIterator[str]:
+            yield _sse("chat", prelude)
+            yield _sse("done", {"chat_id": chat["chat_id"], "response": ""})
+
+        return _sse_response(only_prelude())
+
+    return _stream_reply(chat, req.first_message, prelude=prelude)
 
 
 @app.get("/chat/list")
-async def list_chats():
-    chats = list(CHATS.values())
-    chats.sort(key=lambda c: c.get("updated_at") or "", reverse=True)
-    return chats[:100]
+async def list_chats(response: Response, limit: Optional[int] = None, cursor: Optional[str] = None):
+    """
+    Returns one page of chats, newest first. The cursor for the next page is
+    sent in the X-Next-Cursor header. Temporary chats are listed on the first page.
+    """
+    try:
+        chats, next_cursor = await chat_store.list_chats(limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if not cursor:
+        chats = [_temp_chat_out(c) for c in temp_store.list_temp_chats()] + chats
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return chats
 
 
 @app.get("/chat/{chat_id}")
-async def get_chat(chat_id: str):
-    chat = _require_chat(chat_id)
-    return {"chat": chat, "messages": MESSAGES.get(chat_id, [])[:200]}
+async def get_chat(chat_id: str, limit: Optional[int] = None, cursor: Optional[str] = None):
+    chat = await _require_chat(chat_id)
+    if chat.get("is_temporary"):
+        messages = [_temp_message_out(m) for m in temp_store.get_temp_messages(chat_id)]
+        return {"chat": chat, "messages": messages, "next_cursor": None}
+
+    try:
+        messages, next_cursor = await chat_store.list_messages(chat_id, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"chat": chat, "messages": messages, "next_cursor": next_cursor}
 
 
 @app.delete("/chat/{chat_id}")
 async def delete_chat(chat_id: str):
-    _require_chat(chat_id)
-    CHATS.pop(chat_id, None)
-    MESSAGES.pop(chat_id, None)
+    chat = await _require_chat(chat_id)
+    if chat.get("is_temporary"):
+        temp_store.delete_temp_chat(chat_id)
+    else:
+        await chat_store.delete_chat(chat_id)
     return {"deleted": True, "chat_id": chat_id}
 
 
-@app.post("/chat/temp/message")
-async def post_temp_message(request: Request):
+async def _require_temp_message(request: Request) -> Tuple[Dict[str, Any], str]:
     data = await request.json()
     chat_id = data.get("chat_id")
     content = data.get("content")
@@ -168,31 +346,113 @@ async def post_temp_message(request: Request):
     if not chat_id or not content:
         raise HTTPException(400, "chat_id and content are required")
 
-    chat = _require_chat(chat_id)
+    chat = await _require_chat(chat_id)
     if not chat.get("is_temporary"):
         raise HTTPException(status_code=400, detail="Not a temporary chat")
+    return chat, content
 
-    _append_message(chat_id, "user", content)
-    try:
-        response = await orchestrate_llm(content, MESSAGES.get(chat_id, []))
-    except Exception:
-        response = "I couldn't generate a response right now. Please try again."
-    _append_message(chat_id, "assistant", response)
-    chat["updated_at"] = _now_iso()
-    return {"response": response}
 
+@app.post("/chat/temp/message")
+async def post_temp_message(request: Request):
+    chat, content = await _require_temp_message(request)
+    return {"response": await _reply(chat, content)}
 
-@app.post("/chat/{chat_id}/message")
-async def post_message(chat_id: str, req: MessageRequest):
-    chat = _require_chat(chat_id)
+
+@app.post("/chat/temp/message/stream")
+async def post_temp_message_stream(request: Request):
+    chat, content = await _require_temp_message(request)
+    return _stream_reply(chat, content)
+
+
+async def _require_persistent_chat(chat_id: str) -> Dict[str, Any]:
+    chat = await _require_chat(chat_id)
     if chat.get("is_temporary"):
         raise HTTPException(status_code=400, detail="Not a persistent chat")
+    return chat
 
-    _append_message(chat_id, "user", req.content)
-    try:
-        response = await orchestrate_llm(req.content, MESSAGES.get(chat_id, []))
-    except Exception:
-        response = "I couldn't generate a response right now. Please try again."
-    _append_message(chat_id, "assistant", response)
-    chat["updated_at"] = _now_iso()
-    return {"response": response}
+
+@app.post("/chat/{chat_id}/message")
+async def post_message(chat_id: str, req: MessageRequest):
+    chat = await _require_persistent_chat(chat_id)
+    return {"response": await _reply(chat, req.content)}
+
+
+@app.post("/chat/{chat_id}/message/stream")
+async def post_message_stream(chat_id: str, req: MessageRequest):
+    chat = await _require_persistent_chat(chat_id)
+    return _stream_reply(chat, req.content)
+
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def _require_admin(token: Optional[str]) -> None:
+    # Admin endpoints build indexes and rebuild collections: closed unless a token is configured.
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=503, detail="Admin endpoints are disabled (ADMIN_TOKEN is not set)")
+    if not token or not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+@app.get("/admin/indexes/recommendations")
+async def index_recommendations(min_hits: int = 1, x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    return index_advisor.recommendations(min_hits)
+
+
+@app.post("/admin/indexes/apply")
+async def apply_index_recommendations(
+    min_hits: int = index_advisor.INDEX_ADVISOR_MIN_HITS,
+    x_admin_token: Optional[str] = Header(None),
+):
+    _require_admin(x_admin_token)
+    return {"created": await index_advisor.apply_recommendations(min_hits)}
+
+
+@app.post("/admin/collections/refresh")
+async def refresh_collection_catalog(x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    invalidate_collection_catalog()
+    schema_profiler.invalidate()
+    return {
+        "collections": await collection_names(refresh=True),
+        "knowledge_collection": await resolve_knowledge_collection(),
+    }
+
+
+@app.get("/admin/rollups")
+async def rollup_status(x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    return rollups.status()
+
+
+@app.post("/admin/rollups/rebuild")
+async def rebuild_rollups(x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    if not rollups.schedule_rebuild():
+        raise HTTPException(status_code=409, detail="Rollups are not running")
+    return rollups.status()
+
+
+@app.get("/admin/schema")
+async def schema_profiles(x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    return schema_profiler.cached_profiles()
+
+
+@app.get("/admin/normalizer")
+async def normalizer_status(x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    return normalizer.status()
+
+
+@app.get("/reports/jobs/{job_id}")
+async def report_job_status(job_id: str):
+    status = await get_job_status(job_id)
+    if not status:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    return status
+
+
+# Mounted last so /reports/jobs/{job_id} above takes precedence over static files.
+app.mount("/reports", StaticFiles(directory=REPORTS_DIR), name="reports")
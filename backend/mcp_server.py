@@ -1,34 +1,32 @@
 
 import logging
-import os
 import re
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
 
 from database import (
     find_one_document,
     dumps_json,
 )
+import metrics
+from answer_templates import render_answer
+from cost_guard import QueryTooExpensive
 from db import resolve_knowledge_collection
-from report_generator import generate_report
-from query_generator import generate_pipeline_from_llm, execute_aggregation, generate_natural_response
+from llm_gateway import LLMOverloaded
+from report_jobs import ReportQueueFull, submit_report_job
+from query_generator import (
+    generate_pipeline_from_llm,
+    execute_aggregation,
+    generate_natural_response,
+    stream_natural_response,
+)
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 MODEL_ID = "arcee-ai/trinity-large-preview:free" # Or any other capable model
 
-if not OPENROUTER_API_KEY:
-    logger.warning("OPENROUTER_API_KEY is not set. LLM features will fail.")
-
-client = AsyncOpenAI(
-    api_key=OPENROUTER_API_KEY,
-    base_url="https://openrouter.ai/api/v1"
-)
-
 # Regex to detect specific Media/Event IDs
 _EVENT_ID_PATTERN = re.compile(r"\bV\d+_\d+_[A-Z]+_\d+\b")
 
@@ -36,8 +34,27 @@ async def orchestrate_llm(user_message: str, history: List[Dict[str, Any]]) -> s
     """
     Main entry point for handling user messages.
     """
+    parts: List[str] = []
+    async for event, data in orchestrate_llm_events(user_message, history, stream_tokens=False):
+        if event == "token":
+            parts.append(data)
+    return "".join(parts)
+
+
+@metrics.timed("orchestrate")
+async def orchestrate_llm_events(
+    user_message: str,
+    history: List[Dict[str, Any]],
+    stream_tokens: bool = True,
+) -> AsyncIterator[Tuple[str, str]]:
+    """
+    Same flow as orchestrate_llm, but yields ("status", text) progress events and
+    ("token", text) answer chunks as they become available.
+    """
     try:
-        collection_name = await resolve_knowledge_collection()
+        yield "status", "Thinking..."
+        with metrics.span("resolve_collection"):
+            collection_name = await resolve_knowledge_collection()
         
         # 1. Check for specific ID lookup intent first (keep it fast and deterministic)
         media_id_match = _EVENT_ID_PATTERN.search(user_message)
@@ -45,25 +62,31 @@ async def orchestrate_llm(user_message: str, history: List[Dict[str, Any]]) -> s
             media_id = media_id_match.group(0)
             # Simple heuristic: if user provides an ID, fetch the doc.
             logger.info(f"Detected Media ID: {media_id}")
-            doc = await find_one_document(
-                collection=collection_name,
-                filter={"_id": media_id}
-            )
+            yield "status", f"Looking up {media_id}..."
+            with metrics.span("id_lookup"):
+                doc = await find_one_document(
+                    collection=collection_name,
+                    filter={"_id": media_id}
+                )
             if doc:
                 # If doc found, let the LLM answer based on this single doc
-                return await generate_natural_response(client, MODEL_ID, user_message, doc)
+                async for token in _answer_tokens(user_message, doc, stream_tokens):
+                    yield "token", token
             else:
-                 return f"I couldn't find any record with ID {media_id}."
+                yield "token", f"I couldn't find any record with ID {media_id}."
+            return
 
         # 2. Check for Report Intent
         is_report_request = any(keyword in user_message.lower() for keyword in ["excel", "csv", "download report", "generate report"])
 
         # 3. If no ID, treat as an aggregation query
         logger.info("Generating aggregation pipeline...")
-        pipeline = await generate_pipeline_from_llm(client, MODEL_ID, user_message)
+        yield "status", "Generating query..."
+        pipeline = await generate_pipeline_from_llm(MODEL_ID, user_message)
         
         if not pipeline:
-             return "I'm sorry, I couldn't understand how to query the data for that question."
+            yield "token", "I'm sorry, I couldn't understand how to query the data for that question."
+            return
 
         if is_report_request:
             logger.info("Report intent detected. Generating report.")
@@ -72,22 +95,58 @@ async def orchestrate_llm(user_message: str, history: List[Dict[str, Any]]) -> s
             is_csv = "csv" in user_message.lower()
             file_format = "csv" if is_csv else "xlsx"
             
-            filename = await generate_report(pipeline, format=file_format)
-            
-            if filename:
-                return f"I've generated the {file_format.upper()} report for you. You can download it here: [Download Report](/reports/{filename})"
-            else:
-                return "I was unable to generate the report. The query might have returned no results (or only a count)."
+            # Exports run in the background job pool; reply right away with a status link.
+            try:
+                job = await submit_report_job(pipeline, format=file_format)
+            except ReportQueueFull as e:
+                yield "token", str(e)
+                return
+            yield "token", f"I'm generating the {file_format.upper()} report for you. You can follow its progress and download it here: [Report Status](/reports/jobs/{job['id']})"
+            return
 
         logger.info(f"Executing pipeline: {pipeline}")
-        results = await execute_aggregation(pipeline)
+        yield "status", "Running query..."
+        notes: List[str] = []
+        try:
+            results = await execute_aggregation(pipeline, on_downgrade=notes.append)
+        except QueryTooExpensive as e:
+            yield "token", str(e)
+            return
         
         if isinstance(results, str) and results.startswith("Error"):
-             return f"I encountered an error querying the database: {results}"
+            yield "token", f"I encountered an error querying the database: {results}"
+            return
              
         # 4. Generate natural language response
-        return await generate_natural_response(client, MODEL_ID, user_message, results)
+        yield "status", "Writing answer..."
+        if notes:
+            yield "token", f"{notes[0]}\n\n"
+        async for token in _answer_tokens(user_message, results, stream_tokens, pipeline):
+            yield "token", token
 
+    except LLMOverloaded:
+        # Propagate so the API can shed load with a 503 instead of a canned answer.
+        raise
     except Exception as e:
         logger.exception("Error in orchestrate_llm")
-        return "I encountered an error processing your request."
+        yield "token", "I encountered an error processing your request."
+
+
+async def _answer_tokens(
+    question: str,
+    data: Any,
+    stream_tokens: bool,
+    pipeline: Optional[List[Dict[str, Any]]] = None,
+) -> AsyncIterator[str]:
+    # Counts and small grouped results are answered from templates, without an LLM call.
+    with metrics.span("answer_template"):
+        answer = render_answer(data, pipeline) if pipeline is not None else None
+    if answer is not None:
+        logger.info("Answered from template")
+        yield answer
+        return
+    if stream_tokens:
+        async for token in stream_natural_response(MODEL_ID, question, data, pipeline):
+            yield token
+    else:
+        yield await generate_natural_response(MODEL_ID, question, data, pipeline)
@@ -0,0 +1,258 @@
+"""
+Latency spans and Prometheus metrics.
+
+`span(stage)` times one stage of a request (collection resolution, pipeline
+generation, Mongo execution, answer generation ...) into the
+chatbot_stage_seconds histogram. LLM token usage, cache hit ratios, LLM and
+HTTP in-flight gauges and per-route request latency are exported next to it
+at /metrics.
+
+MetricsMiddleware also assigns every request a trace ID (taken from the
+incoming TRACE_ID_HEADER when the client sent one), returns it in that header
+and keeps it in `trace_id`. install_trace_logging() stamps it on every log
+record as %(trace_id)s, which LOG_FORMAT prints. Leave TRACE_ID_HEADER empty to
+turn trace IDs off.
+
+prometheus_client is optional: without it spans are still timed for debug
+logging and /metrics reports that the exporter is unavailable.
+"""
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+from uuid import uuid4
+
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:  # pragma: no cover - optional dependency
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+TRACE_ID_HEADER = os.getenv("TRACE_ID_HEADER", "X-Trace-Id")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s")
+
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_id", default=None)
+
+
+class _NoopMetric:
+    def labels(self, *args: Any, **kwargs: Any) -> "_NoopMetric":
+        return self
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def inc(self, value: float = 1) -> None:
+        pass
+
+    def dec(self, value: float = 1) -> None:
+        pass
+
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        "chatbot_stage_seconds", "Time spent in one stage of a request.", ["stage"], buckets=_BUCKETS
+    )
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        "chatbot_http_request_seconds", "HTTP request latency, until the last byte is sent.",
+        ["method", "route", "status"], buckets=_BUCKETS,
+    )
+    REQUESTS_IN_FLIGHT = prometheus_client.Gauge(
+        "chatbot_http_requests_in_flight", "HTTP requests currently being served."
+    )
+    LLM_TOKENS = prometheus_client.Counter(
+        "chatbot_llm_tokens", "Tokens reported by the LLM provider.", ["model", "kind"]
+    )
+else:
+    STAGE_SECONDS = REQUEST_SECONDS = REQUESTS_IN_FLIGHT = LLM_TOKENS = _NoopMetric()
+
+# name -> zero-argument callable returning a stats() dict with hits/misses/entries
+_caches: Dict[str, Callable[[], Dict[str, Any]]] = {}
+# name -> zero-argument callable returning {"in_flight": n, "waiting": n, ...}
+_gauges: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+class TraceIdFilter(logging.Filter):
+    """Sets record.trace_id to the current request's trace ID ("-" outside requests)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id.get() or "-"
+        return True
+
+
+def install_trace_logging() -> None:
+    """
+    Adds TraceIdFilter to the root handlers, configuring the root logger with
+    LOG_FORMAT / LOG_LEVEL first when nothing else has.
+    """
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+    for handler in root.handlers:
+        if not any(isinstance(f, TraceIdFilter) for f in handler.filters):
+            handler.addFilter(TraceIdFilter())
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Times the enclosed block as `stage`, whether it returns or raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        logger.debug(f"{stage} took {elapsed * 1000:.1f} ms")
+
+
+def timed(stage: str) -> Callable:
+    """Decorator form of span() for coroutine and async generator functions."""
+
+    def decorate(fn: Callable) -> Callable:
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def gen_wrapper(*args: Any, **kwargs: Any):
+                agen = fn(*args, **kwargs)
+                with span(stage):
+                    try:
+                        async for item in agen:
+                            yield item
+                    finally:
+                        await agen.aclose()
+
+            return gen_wrapper
+
+        @functools.wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any):
+            with span(stage):
+                return await fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def record_llm_usage(model: str, usage: Any) -> None:
+    """Counts the prompt/completion tokens of a completion's `usage` (object or dict)."""
+    if usage is None:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        count = usage.get(kind) if isinstance(usage, dict) else getattr(usage, kind, None)
+        if isinstance(count, int) and count > 0:
+            LLM_TOKENS.labels(model, kind[: -len("_tokens")]).inc(count)
+
+
+def register_cache(name: str, stats: Callable[[], Dict[str, Any]]) -> None:
+    """Exports hits, misses and hit ratio of a cache with a stats() method."""
+    _caches[name] = stats
+
+
+def register_gauges(name: str, stats: Callable[[], Dict[str, Any]]) -> None:
+    """Exports the numeric values of `stats()` as chatbot_<name>_<key> gauges."""
+    _gauges[name] = stats
+
+
+class _StatsCollector:
+    def collect(self):
+        hits = CounterMetricFamily("chatbot_cache_hits", "Cache hits.", labels=["cache"])
+        misses = CounterMetricFamily("chatbot_cache_misses", "Cache misses.", labels=["cache"])
+        ratio = GaugeMetricFamily("chatbot_cache_hit_ratio", "Cache hit ratio since start.", labels=["cache"])
+        entries = GaugeMetricFamily("chatbot_cache_entries", "Entries currently cached.", labels=["cache"])
+        for name, stats in list(_caches.items()):
+            try:
+                values = stats()
+            except Exception as e:
+                logger.debug(f"Cache stats for {name} failed: {e}")
+                continue
+            hits.add_metric([name], values.get("hits", 0))
+            misses.add_metric([name], values.get("misses", 0))
+            ratio.add_metric([name], values.get("hit_ratio", 0.0))
+            entries.add_metric([name], values.get("entries", 0))
+        yield from (hits, misses, ratio, entries)
+
+        for name, stats in list(_gauges.items()):
+            try:
+                values = stats()
+            except Exception as e:
+                logger.debug(f"Gauge stats for {name} failed: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauge = GaugeMetricFamily(f"chatbot_{name}_{key}", f"{name} {key}.")
+                    gauge.add_metric([], value)
+                    yield gauge
+
+
+if prometheus_client is not None:
+    prometheus_client.REGISTRY.register(_StatsCollector())
+
+
+def render() -> Optional[bytes]:
+    """The Prometheus text exposition, or None when prometheus_client is missing."""
+    if prometheus_client is None:
+        return None
+    return prometheus_client.generate_latest()
+
+
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST if prometheus_client is not None else "text/plain"
+
+
+def _route_label(scope: Dict[str, Any]) -> str:
+    # Route templates, not raw paths, so chat IDs don't explode label cardinality.
+    route = scope.get("route")
+    if getattr(route, "path", None):
+        return route.path
+    endpoint = scope.get("endpoint")
+    return getattr(endpoint, "__name__", "unmatched")
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware: the request is timed until its last body chunk is sent,
+    so streamed answers are measured end to end.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.header = TRACE_ID_HEADER.lower().encode("latin-1") if TRACE_ID_HEADER else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = trace = None
+        if self.header:
+            incoming = dict(scope.get("headers") or []).get(self.header)
+            trace = incoming.decode("latin-1")[:64] if incoming else uuid4().hex
+            token = trace_id.set(trace)
+        status = {"code": 500}
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if trace is not None:
+                    headers = [(k, v) for k, v in message.get("headers", []) if k.lower() != self.header]
+                    headers.append((self.header, trace.encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            REQUEST_SECONDS.labels(scope["method"], _route_label(scope), str(status["code"])).observe(
+                time.perf_counter() - started
+            )
+            if token is not None:
+                trace_id.reset(token)
@@ -0,0 +1,409 @@
+"""
+Query-optimized shadow copy of the knowledge collection.
+
+Every event is copied to NORMALIZED_COLLECTION with the same _id and fields,
+except that:
+
+  - eventStartTime / eventEndTime and eventLog.<F>.processingStartTime /
+    processingEndTime are BSON dates, parsed from the collection's custom
+    `2025-06-10T00:01:15:005433` format (or ISO 8601) when stored as strings;
+  - eventLog.<F>...MediaProcessingTimeInSeconds is a double;
+  - features.<F> flattens what is spread over processStatus, operationsPerFeature
+    and eventLog: {flag, seconds, operations, startedAt, endedAt, durationSeconds,
+    scores: {<label>: score}, topLabel, topScore}, the scores parsed from the
+    Predictions string (see predictions.py).
+
+Range filters and $group/$sort on these fields can then use indexes instead of
+converting strings per document. Values that cannot be parsed are left as they
+were (and the flattened field is omitted).
+
+The copy is kept in sync like the text index: by following a change stream
+("change_stream", the default; inserts, updates and deletes, needs a replica
+set) or by tailing in TAIL_FIELD order ("tail", inserts only, see tailing.py).
+Both are idempotent replaces, so a batch interrupted by a crash is simply
+copied again. After every catch-up the copy's document count is compared with
+the source's, and events the tail skipped are looked up by _id and copied.
+The initial copy (the backfill) normalizes batches on a pool of
+NORMALIZER_BACKFILL_WORKERS processes. Once it and the count check have caught
+up, `ready()` turns true and pipeline generation, execution and reports switch
+to the shadow collection; until then everything runs on the source as before.
+"""
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from pymongo import ReplaceOne
+
+import predictions
+import tailing
+from db import NORMALIZED_COLLECTION, NORMALIZER_STATE_COLLECTION, get_db
+from utils import DATE_FIELDS, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+NORMALIZER_ENABLED = os.getenv("NORMALIZER_ENABLED", "true").lower() == "true"
+# "change_stream": follow inserts, updates and deletes. "tail": poll for events after the last copied one.
+NORMALIZER_SYNC = os.getenv("NORMALIZER_SYNC", "change_stream").lower()
+NORMALIZER_REFRESH_SECONDS = float(os.getenv("NORMALIZER_REFRESH_SECONDS", "30"))
+NORMALIZER_BATCH_SIZE = int(os.getenv("NORMALIZER_BATCH_SIZE", "1000"))
+# Processes normalizing the initial copy; each takes NORMALIZER_BATCH_SIZE events at a time. 1 disables the pool.
+NORMALIZER_BACKFILL_WORKERS = int(os.getenv("NORMALIZER_BACKFILL_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Bump when normalize_event() or the sync state changes shape; a stored copy of another version is rebuilt.
+NORMALIZER_VERSION = 3
+
+# Fields that hold BSON dates in the shadow collection, on top of utils.DATE_FIELDS.
+SHADOW_DATE_FIELDS = {"processingStartTime", "processingEndTime", "startedAt", "endedAt"}
+
+_FEATURE_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+
+_source: Optional[str] = None
+_position: Optional[List[Any]] = None
+_resume_token: Any = None
+_synced = False
+_task: Optional[asyncio.Task] = None
+_pool: Optional[ProcessPoolExecutor] = None
+_labels_refreshed = False
+
+
+# --- Normalization ---------------------------------------------------------------
+
+def _date(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        return parse_timestamp(value)
+    return None
+
+
+def _seconds(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or value is None:
+        return None
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    return seconds if math.isfinite(seconds) else None
+
+
+def _dict(value: Any) -> Dict[str, Any]:
+    return value if isinstance(value, dict) else {}
+
+
+def _normalize_log_entry(entry: Dict[str, Any]) -> Dict[str, Any]:
+    entry = dict(entry)
+    for key in ("processingStartTime", "processingEndTime"):
+        parsed = _date(entry.get(key))
+        if parsed is not None:
+            entry[key] = parsed
+    report = _dict(entry.get("report"))
+    document_report = _dict(report.get("documentReport"))
+    inner = _dict(document_report.get("report"))
+    seconds = _seconds(inner.get("MediaProcessingTimeInSeconds"))
+    if seconds is not None:
+        entry["report"] = {
+            **report,
+            "documentReport": {**document_report, "report": {**inner, "MediaProcessingTimeInSeconds": seconds}},
+        }
+    return entry
+
+
+def normalize_event(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """The shadow-collection version of a source event (see module docstring)."""
+    out = dict(doc)
+    for field in ("eventStartTime", "eventEndTime"):
+        parsed = _date(doc.get(field))
+        if parsed is not None:
+            out[field] = parsed
+
+    status = _dict(_dict(doc.get("processStatus")).get("featureStatus"))
+    operations = _dict(doc.get("operationsPerFeature"))
+    event_log = doc.get("eventLog")
+    if isinstance(event_log, dict):
+        event_log = {
+            name: _normalize_log_entry(entry) if isinstance(entry, dict) else entry
+            for name, entry in event_log.items()
+        }
+        out["eventLog"] = event_log
+    else:
+        event_log = {}
+
+    features: Dict[str, Dict[str, Any]] = {}
+    for name in dict.fromkeys([*status, *operations, *event_log]):
+        if not _FEATURE_NAME.match(name):
+            continue
+        entry = _dict(event_log.get(name))
+        started, ended = _date(entry.get("processingStartTime")), _date(entry.get("processingEndTime"))
+        duration = None
+        if started is not None and ended is not None:
+            try:
+                duration = (ended - started).total_seconds()
+            except TypeError:  # naive vs. aware timestamps
+                pass
+        ops = operations.get(name)
+        report = _dict(_dict(_dict(entry.get("report")).get("documentReport")).get("report"))
+        scores = predictions.parse_predictions(report.get("Predictions"))
+        top = max(scores.items(), key=lambda item: item[1]) if scores else (None, None)
+        values = {
+            "flag": status.get(name) if isinstance(status.get(name), bool) else None,
+            "seconds": _seconds(report.get("MediaProcessingTimeInSeconds")),
+            "operations": ops if isinstance(ops, int) and not isinstance(ops, bool) else None,
+            "startedAt": started,
+            "endedAt": ended,
+            "durationSeconds": duration,
+            "scores": scores,
+            "topLabel": top[0],
+            "topScore": top[1],
+        }
+        features[name] = {k: v for k, v in values.items() if v is not None}
+    out["features"] = features
+    return out
+
+
+def normalize_events(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [normalize_event(doc) for doc in docs]
+
+
+def _backfill_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    if _pool is None and NORMALIZER_BACKFILL_WORKERS > 1:
+        # spawn: forking a process that runs an event loop and driver threads is unsafe.
+        _pool = ProcessPoolExecutor(NORMALIZER_BACKFILL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def _normalize(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    pool = None if _synced else _backfill_pool()
+    if pool is None:
+        return await asyncio.to_thread(normalize_events, docs)
+    loop = asyncio.get_running_loop()
+    chunks = [docs[i : i + NORMALIZER_BATCH_SIZE] for i in range(0, len(docs), NORMALIZER_BATCH_SIZE)]
+    results = await asyncio.gather(*(loop.run_in_executor(pool, normalize_events, chunk) for chunk in chunks))
+    return [doc for chunk in results for doc in chunk]
+
+
+# --- Sync ----------------------------------------------------------------------------
+
+async def _save_state() -> None:
+    await get_db()[NORMALIZER_STATE_COLLECTION].replace_one(
+        {"_id": _source},
+        {
+            "_id": _source,
+            "version": NORMALIZER_VERSION,
+            "position": _position,
+            "resume_token": _resume_token,
+            "synced": _synced,
+        },
+        upsert=True,
+    )
+
+
+async def _load_state() -> None:
+    global _position, _resume_token, _synced
+    state = await get_db()[NORMALIZER_STATE_COLLECTION].find_one({"_id": _source})
+    if state is not None and state.get("version") == NORMALIZER_VERSION:
+        _position = state.get("position")
+        _resume_token = state.get("resume_token")
+        _synced = bool(state.get("synced"))
+        return
+    if state is not None:
+        logger.info("Normalized collection was built by another version; copying it again")
+    await get_db()[NORMALIZED_COLLECTION].delete_many({})
+    _position = _resume_token = None
+    _synced = False
+    await _save_state()
+
+
+async def _tail() -> int:
+    """Copies every event after the tailing position."""
+    global _position
+    source = get_db()[_source]
+    shadow = get_db()[NORMALIZED_COLLECTION]
+    added = 0
+    while True:
+        # The backfill reads one batch per worker at a time.
+        batch_size = NORMALIZER_BATCH_SIZE * (max(NORMALIZER_BACKFILL_WORKERS, 1) if not _synced else 1)
+        query = tailing.position_filter(_position)
+        docs = await source.find(query).sort(tailing.sort_spec()).limit(batch_size).to_list(length=batch_size)
+        if not docs:
+            return added
+        ops = [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in await _normalize(docs)]
+        await shadow.bulk_write(ops, ordered=False)
+        _position = tailing.position_of(docs[-1])
+        await _save_state()
+        added += len(docs)
+
+
+async def _copy_missing() -> int:
+    """
+    Copies the events the tail skipped, when the copy holds fewer documents than
+    the source: the tail misses inserts below its position whenever TAIL_FIELD
+    does not follow insertion order.
+    """
+    source = get_db()[_source]
+    shadow = get_db()[NORMALIZED_COLLECTION]
+    if await source.estimated_document_count() <= await shadow.estimated_document_count():
+        return 0
+    added = 0
+    async for ids in tailing.iter_id_batches(source, NORMALIZER_BATCH_SIZE):
+        copied = {doc["_id"] for doc in await shadow.find({"_id": {"$in": ids}}, {"_id": 1}).to_list(length=len(ids))}
+        missing = [doc_id for doc_id in ids if doc_id not in copied]
+        if not missing:
+            continue
+        docs = await source.find({"_id": {"$in": missing}}).to_list(length=len(missing))
+        if docs:
+            ops = [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in await _normalize(docs)]
+            await shadow.bulk_write(ops, ordered=False)
+            added += len(docs)
+    if added:
+        logger.info(f"Normalized copy of '{_source}' picked up {added} events the tail skipped")
+    return added
+
+
+async def _refresh_labels() -> None:
+    global _labels_refreshed
+    _labels_refreshed = True
+    try:
+        await predictions.refresh_top_labels(get_db()[NORMALIZED_COLLECTION])
+    except Exception as e:
+        logger.warning(f"Could not index prediction labels: {e}")
+
+
+async def _catch_up() -> int:
+    global _synced
+    added = await _tail()
+    # Queries only switch over once the count check has filled any gaps the tail left.
+    added += await _copy_missing()
+    if not _synced:
+        _synced = True
+        _shutdown_pool()
+        await _save_state()
+        logger.info(f"Normalized copy of '{_source}' caught up; queries now use '{NORMALIZED_COLLECTION}'")
+    if not _labels_refreshed:
+        await _refresh_labels()
+    return added
+
+
+async def _follow_change_stream() -> None:
+    global _resume_token
+    source = get_db()[_source]
+    shadow = get_db()[NORMALIZED_COLLECTION]
+    kwargs: Dict[str, Any] = {"full_document": "updateLookup"}
+    if _resume_token is not None:
+        kwargs["resume_after"] = _resume_token
+    async with source.watch(**kwargs) as stream:
+        # Catch up on inserts first; events that overlap with the tail are replaced again.
+        await _catch_up()
+        saved_at = time.monotonic()
+        async for change in stream:
+            op = change.get("operationType")
+            if op in ("insert", "update", "replace") and change.get("fullDocument"):
+                doc = change["fullDocument"]
+                await shadow.replace_one({"_id": doc["_id"]}, normalize_event(doc), upsert=True)
+            elif op in ("delete", "update", "replace"):
+                await shadow.delete_one({"_id": change["documentKey"]["_id"]})
+            elif op in ("drop", "rename", "invalidate"):
+                logger.warning(f"Normalizer source '{_source}' was {op}ped; stopping updates")
+                return
+            _resume_token = stream.resume_token
+            # Replaying a few changes after a restart is harmless, so the token is saved lazily.
+            if time.monotonic() - saved_at >= NORMALIZER_REFRESH_SECONDS:
+                await _save_state()
+                saved_at = time.monotonic()
+
+
+async def _refresh_forever() -> None:
+    global _resume_token
+    try:
+        await _load_state()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"Could not load normalizer state: {e}")
+    if NORMALIZER_SYNC == "change_stream":
+        for attempt in range(2):
+            try:
+                await _follow_change_stream()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == 0 and _resume_token is not None:
+                    # The token may have fallen off the oplog; start following from now.
+                    logger.info(f"Normalizer resume token rejected ({e}); reopening change stream")
+                    _resume_token = None
+                    continue
+                logger.warning(f"Change stream unavailable ({e}); normalizer falls back to tailing")
+                break
+    while True:
+        try:
+            added = await _catch_up()
+            if added:
+                logger.info(f"Normalized {added} new events from '{_source}'")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Normalizer refresh failed: {e}")
+        await asyncio.sleep(NORMALIZER_REFRESH_SECONDS)
+
+
+def start(collection: str) -> None:
+    global _source, _task
+    if not NORMALIZER_ENABLED or _task is not None:
+        return
+    _source = collection
+    _task = asyncio.create_task(_refresh_forever())
+
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+        _shutdown_pool()
+        if _source is not None:
+            try:
+                await _save_state()
+            except Exception as e:
+                logger.warning(f"Could not save normalizer state: {e}")
+
+
+def ready() -> bool:
+    """True once the shadow collection holds a complete copy of the source."""
+    return NORMALIZER_ENABLED and _task is not None and _synced
+
+
+def query_collection(collection: str) -> str:
+    """The collection queries against `collection` should run on."""
+    return NORMALIZED_COLLECTION if ready() and collection == _source else collection
+
+
+def date_fields() -> Set[str]:
+    """Keys whose string values convert_dates() turns into datetimes for the current target."""
+    return DATE_FIELDS | SHADOW_DATE_FIELDS if ready() else DATE_FIELDS
+
+
+def status() -> Dict[str, Any]:
+    return {
+        "enabled": NORMALIZER_ENABLED,
+        "sync": NORMALIZER_SYNC,
+        "source": _source,
+        "collection": NORMALIZED_COLLECTION,
+        "ready": ready(),
+        "position": _position,
+    }
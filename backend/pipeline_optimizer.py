@@ -0,0 +1,384 @@
+"""
+Rewrites LLM-generated aggregation pipelines into equivalent, cheaper forms.
+
+Passes, repeated until nothing changes:
+  - $match is moved ahead of $sort / $project / $addFields / $set / $unset when
+    it does not read a field those stages compute or drop; a $match that does
+    is split and only its independent conditions move.
+  - Adjacent $match stages are merged into one.
+  - $limit is moved ahead of 1:1 stages ($project / $addFields / $set / $unset)
+    so it lands next to its $sort (top-k sort), and adjacent limits collapse.
+Then, when every field the rest of the pipeline reads is known, a $project of
+just those fields is inserted after the leading $match stages.
+
+Every rewrite is conservative: anything the optimizer cannot reason about
+($expr on $$ROOT, $lookup, $facet, $text ...) is left where it is.
+"""
+import copy
+import logging
+import os
+from typing import Any, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_OPTIMIZER_ENABLED = os.getenv("PIPELINE_OPTIMIZER_ENABLED", "true").lower() == "true"
+
+_ONE_TO_ONE_STAGES = {"$project", "$addFields", "$set", "$unset"}
+_MATCH_BARRIER_OPS = {"$text", "$where", "$jsonSchema", "$near", "$nearSphere"}
+_WHOLE_DOCUMENT_VARS = {"ROOT", "CURRENT"}
+_MAX_PASSES = 50
+
+
+def _stage_name(stage: Any) -> Optional[str]:
+    if isinstance(stage, dict) and len(stage) == 1:
+        return next(iter(stage))
+    return None
+
+
+def _overlaps(a: str, b: str) -> bool:
+    """True when one dotted path is the other or one of its ancestors."""
+    return a == b or a.startswith(b + ".") or b.startswith(a + ".")
+
+
+def _same_root(a: str, b: str) -> bool:
+    # Writing "a.b" can reshape a scalar or array "a", so writes are compared by top-level field.
+    return a.split(".", 1)[0] == b.split(".", 1)[0]
+
+
+def _projectable(path: str) -> str:
+    """Cuts a path at its first array index: {"tags.0": 1} would not keep tags[0]."""
+    parts = path.split(".")
+    for i, part in enumerate(parts):
+        if part.isdigit():
+            return ".".join(parts[:i])
+    return path
+
+
+def _expression_fields(expr: Any, out: Set[str]) -> bool:
+    """
+    Collects "$field.path" references from an aggregation expression.
+    Returns False when the expression reads the whole document.
+    """
+    if isinstance(expr, str):
+        if expr.startswith("$$"):
+            return expr[2:].split(".", 1)[0] not in _WHOLE_DOCUMENT_VARS
+        if expr.startswith("$") and len(expr) > 1:
+            out.add(expr[1:])
+        return True
+    if isinstance(expr, dict):
+        return all(_expression_fields(v, out) for k, v in expr.items() if k != "$literal")
+    if isinstance(expr, list):
+        return all(_expression_fields(v, out) for v in expr)
+    return True
+
+
+def _match_fields(match: Any, out: Set[str]) -> bool:
+    """
+    Collects the fields a $match filter reads. Returns False for filters whose
+    dependencies cannot be determined (or which must stay first, like $text).
+    """
+    if not isinstance(match, dict):
+        return False
+    for key, value in match.items():
+        if key in ("$and", "$or", "$nor"):
+            if not isinstance(value, list) or not all(_match_fields(v, out) for v in value):
+                return False
+        elif key == "$expr":
+            if not _expression_fields(value, out):
+                return False
+        elif key == "$comment":
+            continue
+        elif key.startswith("$"):
+            return False
+        else:
+            if isinstance(value, dict) and any(k in _MATCH_BARRIER_OPS for k in value):
+                return False
+            out.add(key)
+    return True
+
+
+def _is_subdocument(value: Any) -> bool:
+    """A nested $project spec such as {"featureStatus": 1}, as opposed to an operator expression."""
+    return isinstance(value, dict) and bool(value) and not any(str(k).startswith("$") for k in value)
+
+
+def _projection_kind(spec: Dict[str, Any]) -> str:
+    """"inclusion" or "exclusion" ($project semantics, _id aside)."""
+    for key, value in spec.items():
+        if key == "_id":
+            continue
+        if _is_subdocument(value):
+            return _projection_kind(value)
+        if value in (0, False):
+            return "exclusion"
+        return "inclusion"
+    return "exclusion" if spec.get("_id") in (0, False) else "inclusion"
+
+
+def _is_passthrough(value: Any) -> bool:
+    return value is True or (isinstance(value, (int, float)) and not isinstance(value, bool) and value == 1)
+
+
+def _inclusion_paths(key: str, value: Any) -> Optional[List[str]]:
+    """
+    Dotted paths an inclusion $project entry passes through unchanged:
+    processStatus: {featureStatus: 1} -> ["processStatus.featureStatus"].
+    None when the entry computes a value.
+    """
+    if _is_passthrough(value):
+        return [key]
+    if not _is_subdocument(value):
+        return None
+    paths: List[str] = []
+    for sub_key, sub_value in value.items():
+        sub_paths = _inclusion_paths(f"{key}.{sub_key}", sub_value)
+        if sub_paths is None:
+            return None
+        paths.extend(sub_paths)
+    return paths
+
+
+def _exclusion_paths(key: str, value: Any) -> Optional[List[str]]:
+    """
+    Dotted paths an exclusion $project entry removes:
+    a: {b: 0} -> ["a.b"]. None for anything but (nested) 0/false.
+    """
+    if value in (0, False):
+        return [key]
+    if not _is_subdocument(value):
+        return None
+    paths: List[str] = []
+    for sub_key, sub_value in value.items():
+        sub_paths = _exclusion_paths(f"{key}.{sub_key}", sub_value)
+        if sub_paths is None:
+            return None
+        paths.extend(sub_paths)
+    return paths
+
+
+def _match_can_precede(match_fields: Set[str], stage: Dict[str, Any]) -> bool:
+    name = _stage_name(stage)
+    spec = stage[name]
+    if name == "$sort":
+        return True
+    if name in ("$addFields", "$set"):
+        return isinstance(spec, dict) and not any(_same_root(f, k) for f in match_fields for k in spec)
+    if name == "$unset":
+        dropped = [spec] if isinstance(spec, str) else spec
+        return isinstance(dropped, list) and not any(_same_root(f, k) for f in match_fields for k in dropped)
+    if name == "$project" and isinstance(spec, dict):
+        if _projection_kind(spec) == "exclusion":
+            excluded: List[str] = []
+            for k, v in spec.items():
+                if k == "_id" and _is_passthrough(v):
+                    continue
+                paths = _exclusion_paths(k, v)
+                if paths is None:
+                    return False
+                excluded.extend(paths)
+            return not any(_same_root(f, k) for f in match_fields for k in excluded)
+        included: Set[str] = set()
+        computed: Set[str] = set()
+        for k, v in spec.items():
+            if v in (0, False):
+                continue
+            paths = _inclusion_paths(k, v)
+            if paths is None:
+                computed.add(k)
+            else:
+                included.update(paths)
+        if spec.get("_id", 1) not in (0, False):
+            included.add("_id")
+        for field in match_fields:
+            if any(_overlaps(field, k) for k in computed):
+                return False
+            if not any(field == k or field.startswith(k + ".") for k in included):
+                return False
+        return True
+    return False
+
+
+def _merge_matches(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    if not set(a) & set(b):
+        return {**a, **b}
+    return {"$and": [a, b]}
+
+
+def _movable_conditions(match: Dict[str, Any], stage: Dict[str, Any]) -> Dict[str, Any]:
+    """Top-level conditions of `match` that could run before `stage`."""
+    movable = {}
+    for key, value in match.items():
+        fields: Set[str] = set()
+        if _match_fields({key: value}, fields) and _match_can_precede(fields, stage):
+            movable[key] = value
+    return movable
+
+
+def _push_matches_forward(pipeline: List[Dict[str, Any]]) -> bool:
+    changed = False
+    i = 1
+    while i < len(pipeline):
+        if _stage_name(pipeline[i]) != "$match" or _stage_name(pipeline[i - 1]) not in _ONE_TO_ONE_STAGES | {"$sort"}:
+            i += 1
+            continue
+        match = pipeline[i]["$match"]
+        fields: Set[str] = set()
+        if _match_fields(match, fields) and _match_can_precede(fields, pipeline[i - 1]):
+            pipeline[i - 1], pipeline[i] = pipeline[i], pipeline[i - 1]
+            changed = True
+        elif isinstance(match, dict) and len(match) > 1:
+            # Top-level conditions are ANDed, so the independent ones can run earlier,
+            # e.g. an orgId filter ahead of a $toDouble over every document.
+            movable = _movable_conditions(match, pipeline[i - 1])
+            if movable:
+                rest = {k: v for k, v in match.items() if k not in movable}
+                pipeline[i - 1:i + 1] = [{"$match": movable}, pipeline[i - 1], {"$match": rest}]
+                changed = True
+                i += 1
+        i += 1
+    return changed
+
+
+def _merge_adjacent_matches(pipeline: List[Dict[str, Any]]) -> bool:
+    for i in range(1, len(pipeline)):
+        if _stage_name(pipeline[i - 1]) == "$match" and _stage_name(pipeline[i]) == "$match":
+            first, second = pipeline[i - 1]["$match"], pipeline[i]["$match"]
+            fields: Set[str] = set()
+            # Filters the optimizer cannot read ($text, $where ...) are left as written.
+            if not (_match_fields(first, fields) and _match_fields(second, fields)):
+                continue
+            pipeline[i - 1] = {"$match": _merge_matches(first, second)}
+            del pipeline[i]
+            return True
+    return False
+
+
+def _push_limits_down(pipeline: List[Dict[str, Any]]) -> bool:
+    changed = False
+    i = 1
+    while i < len(pipeline):
+        if _stage_name(pipeline[i]) == "$limit":
+            previous = _stage_name(pipeline[i - 1])
+            if previous == "$limit":
+                pipeline[i - 1] = {"$limit": min(pipeline[i - 1]["$limit"], pipeline[i]["$limit"])}
+                del pipeline[i]
+                changed = True
+                continue
+            if previous in _ONE_TO_ONE_STAGES:
+                pipeline[i - 1], pipeline[i] = pipeline[i], pipeline[i - 1]
+                changed = True
+        i += 1
+    return changed
+
+
+def _append_result_limit(pipeline: List[Dict[str, Any]], result_limit: int) -> None:
+    """
+    Only the first `result_limit` documents are ever read, so a $sort with no
+    $limit after it can be capped; _push_limits_down then turns it into a top-k sort.
+    """
+    names = [_stage_name(s) for s in pipeline]
+    if "$sort" not in names:
+        return
+    last_sort = len(names) - 1 - names[::-1].index("$sort")
+    if "$limit" not in names[last_sort:]:
+        pipeline.append({"$limit": result_limit})
+
+
+def _stage_dependencies(stage: Dict[str, Any], deps: Set[str]) -> Optional[bool]:
+    """
+    Adds the fields `stage` reads to `deps`. Returns True when the stage ends
+    the dependency chain (its output no longer carries the input document),
+    False to keep walking, None when dependencies cannot be determined.
+    """
+    name = _stage_name(stage)
+    spec = stage[name] if name else None
+    if name == "$match":
+        return False if _match_fields(spec, deps) else None
+    if name == "$sort" and isinstance(spec, dict):
+        deps.update(spec)
+        return False
+    if name in ("$addFields", "$set") and isinstance(spec, dict):
+        return False if _expression_fields(list(spec.values()), deps) else None
+    if name in ("$limit", "$skip", "$unset"):
+        return False
+    if name == "$unwind":
+        path = spec.get("path") if isinstance(spec, dict) else spec
+        if not isinstance(path, str) or not path.startswith("$"):
+            return None
+        deps.add(path[1:])
+        return False
+    if name in ("$group", "$bucket", "$bucketAuto", "$sortByCount"):
+        return True if _expression_fields(spec, deps) else None
+    if name == "$count":
+        return True
+    if name == "$project" and isinstance(spec, dict) and _projection_kind(spec) == "inclusion":
+        for key, value in spec.items():
+            paths = _inclusion_paths(key, value)
+            if paths is not None:
+                deps.update(paths)
+            elif _is_subdocument(value) or (value not in (0, False) and not _expression_fields(value, deps)):
+                # Nested specs mixing inclusions and expressions are not analysed.
+                return None
+        return True
+    return None
+
+
+def _insert_projection(pipeline: List[Dict[str, Any]]) -> None:
+    # Keep the leading $match/$sort/$limit run intact so it can still use an index.
+    start = 0
+    while start < len(pipeline) and _stage_name(pipeline[start]) in ("$match", "$sort", "$limit", "$skip"):
+        start += 1
+    rest = pipeline[start:]
+    if not rest or _stage_name(rest[0]) == "$project":
+        return
+
+    deps: Set[str] = set()
+    computed: Set[str] = set()
+    for stage in rest:
+        reads: Set[str] = set()
+        done = _stage_dependencies(stage, reads)
+        if done is None:
+            return
+        # Fields set by an earlier $addFields do not have to come from the collection.
+        deps.update(r for r in reads if not any(r == c or r.startswith(c + ".") for c in computed))
+        if _stage_name(stage) in ("$addFields", "$set"):
+            computed.update(stage[_stage_name(stage)])
+        if done:
+            break
+    else:
+        return  # the full documents reach the client
+
+    deps = {_projectable(d) for d in deps if "$" not in d}
+    if "" in deps:
+        return
+    kept = sorted(d for d in deps if not any(d.startswith(other + ".") for other in deps))
+    projection: Dict[str, Any] = {field: 1 for field in kept} or {"_id": 1}
+    pipeline.insert(start, {"$project": projection})
+
+
+def optimize_pipeline(pipeline: List[Dict[str, Any]], result_limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Returns an equivalent pipeline that is cheaper to run. `result_limit` is the
+    number of documents the caller will read; a trailing unbounded $sort is capped
+    to it. The input is never modified, and any failure returns it unchanged.
+    """
+    if not PIPELINE_OPTIMIZER_ENABLED or not pipeline:
+        return pipeline
+    try:
+        optimized = copy.deepcopy(pipeline)
+        if result_limit:
+            _append_result_limit(optimized, result_limit)
+        for _ in range(_MAX_PASSES):
+            changed = _push_matches_forward(optimized)
+            changed = _merge_adjacent_matches(optimized) or changed
+            changed = _push_limits_down(optimized) or changed
+            if not changed:
+                break
+        _insert_projection(optimized)
+    except Exception as e:
+        logger.warning(f"Pipeline optimizer skipped: {e}")
+        return pipeline
+
+    if optimized != pipeline:
+        logger.info(f"Optimized pipeline: {optimized}")
+    return optimized
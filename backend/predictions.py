@@ -0,0 +1,118 @@
+"""
+Structured model scores from eventLog.<Feature>...Predictions.
+
+Predictions are stored as strings, usually a Python dict repr such as
+"{'na/selfie': 0.58, 'na/document': 0.12}", so Mongo cannot filter on them.
+The normalizer stores the parsed scores as features.<Feature>.scores.<label>
+(doubles) plus topLabel / topScore, and refresh_top_labels() indexes the most
+common labels of each feature and remembers them for the schema prompt.
+"""
+import ast
+import json
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Score fields indexed per collection (Mongo allows 64 indexes in total).
+PREDICTIONS_INDEXED_LABELS = int(os.getenv("PREDICTIONS_INDEXED_LABELS", "8"))
+# Documents sampled to find the most common labels.
+PREDICTIONS_LABEL_SAMPLE = int(os.getenv("PREDICTIONS_LABEL_SAMPLE", "10000"))
+
+# Labels per feature listed in the schema prompt.
+_SCHEMA_LABELS = 20
+
+# feature -> labels, most common first
+_top_labels: Dict[str, List[str]] = {}
+
+
+def label_key(label: Any) -> Optional[str]:
+    """A label usable as a field name: no dots, no leading $."""
+    key = str(label).strip().replace(".", "_").lstrip("$")
+    return key or None
+
+
+def _score(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return None
+    try:
+        score = float(value)
+    except ValueError:
+        return None
+    return score if math.isfinite(score) else None
+
+
+def _load(text: str) -> Any:
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    # Python reprs with plain single-quoted labels are valid JSON once requoted,
+    # which is far cheaper than literal_eval.
+    if '"' not in text and "\\" not in text:
+        try:
+            return json.loads(text.replace("'", '"'))
+        except ValueError:
+            pass
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+def parse_predictions(value: Any) -> Optional[Dict[str, float]]:
+    """label -> score of a Predictions value (string or dict); None when nothing numeric is in it."""
+    if isinstance(value, str):
+        text = value.strip()
+        if not text.startswith("{"):
+            return None
+        value = _load(text)
+    if not isinstance(value, dict):
+        return None
+    scores = {}
+    for label, raw in value.items():
+        key, score = label_key(label), _score(raw)
+        if key is not None and score is not None:
+            scores[key] = score
+    return scores or None
+
+
+def top_labels() -> Dict[str, List[str]]:
+    return dict(_top_labels)
+
+
+async def refresh_top_labels(collection) -> Dict[str, List[str]]:
+    """
+    Finds the most common score labels per feature in a sample of `collection`
+    (the normalized copy) and makes sure the top PREDICTIONS_INDEXED_LABELS have
+    an index.
+    """
+    global _top_labels
+    counts = await collection.aggregate([
+        {"$sample": {"size": PREDICTIONS_LABEL_SAMPLE}},
+        {"$project": {"features": {"$objectToArray": {"$ifNull": ["$features", {}]}}}},
+        {"$unwind": "$features"},
+        {"$project": {
+            "feature": "$features.k",
+            "labels": {"$objectToArray": {"$ifNull": ["$features.v.scores", {}]}},
+        }},
+        {"$unwind": "$labels"},
+        {"$group": {"_id": {"feature": "$feature", "label": "$labels.k"}, "n": {"$sum": 1}}},
+        {"$sort": {"n": -1, "_id.feature": 1, "_id.label": 1}},
+    ], allowDiskUse=True).to_list(length=None)
+
+    labels: Dict[str, List[str]] = {}
+    for row in counts:
+        names = labels.setdefault(row["_id"]["feature"], [])
+        if len(names) < _SCHEMA_LABELS:
+            names.append(row["_id"]["label"])
+    _top_labels = labels
+
+    indexed = [(row["_id"]["feature"], row["_id"]["label"]) for row in counts[:PREDICTIONS_INDEXED_LABELS]]
+    for feature, label in indexed:
+        await collection.create_index(f"features.{feature}.scores.{label}")
+    if indexed:
+        logger.info(f"Indexed prediction scores: {', '.join(f'{f}.{l}' for f, l in indexed)}")
+    return top_labels()
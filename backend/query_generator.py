@@ -1,20 +1,73 @@
 
+import copy
+import hashlib
 import json
 import logging
+import os
 import re
-from typing import Any, Dict, List, Optional
-from db import get_db, resolve_knowledge_collection
-from schema import get_collection_schema
+from datetime import date
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+from pymongo.errors import ExecutionTimeout
+import index_advisor
+import metrics
+import normalizer
+import rollups
+import schema_profiler
+from cache import LRUCache
+from cost_guard import AGGREGATION_MAX_TIME_MS, QueryTooExpensive, admit, timeout_error
+from database import normalize_question
+from pipeline_optimizer import optimize_pipeline
+from query_templates import build_template, extract_literals, fill_template
+from result_cache import pipeline_key, result_cache, result_size
+from db import NORMALIZED_COLLECTION, ROLLUP_COLLECTION, get_db, resolve_knowledge_collection
+from llm_gateway import LLMOverloaded, chat_completion, stream_chat_completion
+from result_compactor import compact_for_prompt
+from schema import get_collection_schema, prediction_labels
+from schema_slicer import slice_schema
 
 logger = logging.getLogger(__name__)
 
-QUERY_GENERATION_PROMPT = """
-You are a MongoDB Expert. Your task is to generate a MongoDB Aggregation Pipeline to answer the user's question based on the provided schema.
+# execute_aggregation only ever returns this many documents to the caller.
+AGGREGATION_RESULT_LIMIT = 100
 
-Schema:
-{schema}
+# Pipeline cache: identical (normalized) questions against the same schema reuse
+# the previously generated pipeline instead of paying another LLM round trip.
+PIPELINE_CACHE_MAX_ENTRIES = int(os.getenv("PIPELINE_CACHE_MAX_ENTRIES", "512"))
+PIPELINE_CACHE_TTL_SECONDS = float(os.getenv("PIPELINE_CACHE_TTL_SECONDS", "86400"))
+PIPELINE_CACHE_PATH = os.getenv("PIPELINE_CACHE_PATH") or None
 
-User Question: "{question}"
+pipeline_cache = LRUCache(
+    max_entries=PIPELINE_CACHE_MAX_ENTRIES,
+    ttl_seconds=PIPELINE_CACHE_TTL_SECONDS,
+    path=PIPELINE_CACHE_PATH,
+)
+
+
+def _schema_hash(schema_desc: str) -> str:
+    return hashlib.sha1(schema_desc.encode("utf-8")).hexdigest()[:16]
+
+
+# Questions relative to "now" get a generated pipeline with literal dates baked in,
+# so their cache entries are only valid for the day they were created.
+_RELATIVE_TIME_WORDS = {
+    "today", "yesterday", "tomorrow", "tonight", "now", "current", "currently",
+    "recent", "recently", "latest", "last", "past", "hour", "hours", "day",
+    "days", "week", "weeks", "month", "months", "year", "years",
+}
+
+
+def _pipeline_cache_key(question: str, schema_desc: str) -> str:
+    normalized = normalize_question(question)
+    key = f"{_schema_hash(schema_desc)}:{normalized}"
+    if _RELATIVE_TIME_WORDS.intersection(normalized.split()):
+        key = f"{key}@{date.today().isoformat()}"
+    return key
+
+# Only the rules: identical for every question and collection and sent first, so the
+# provider can cache it. The schema (the sampled profile sliced for the question, or the
+# hand-written structure), the prediction labels and the question go in the user message.
+QUERY_GENERATION_SYSTEM_PROMPT = """
+You are a MongoDB Expert. Your task is to generate a MongoDB Aggregation Pipeline to answer the user's question based on the provided schema.
 
 Rules:
 1. Return ONLY a valid JSON array representing the aggregation pipeline.
@@ -25,36 +78,80 @@ Rules:
 6. Handle type conversions if necessary (e.g., converting "MediaProcessingTimeInSeconds" from string to double using $toDouble).
 7. Ensure the pipeline is read-only. No $out, $merge, or $update.
 8. **Feature Mapping Rule**: If the user asks about "Nudity", "Minor", "ImageSearch", "Violence", etc., being true/false, you MUST use the `processStatus.featureStatus.<FeatureName>` field.
-   - Example: "count of nudity is true" -> `{{ "processStatus.featureStatus.Nudity": true }}`
-   - Example: "nudity is false" -> `{{ "processStatus.featureStatus.Nudity": false }}`
+   - Example: "count of nudity is true" -> `{ "processStatus.featureStatus.Nudity": true }`
+   - Example: "nudity is false" -> `{ "processStatus.featureStatus.Nudity": false }`
    - Do NOT query `eventLog` or check for `$exists` unless explicitly asked.
 9. For "exact" date/time queries (e.g., "exactly at 2023...", "document exactly eventStartTime..."), INDEPENDENT of whether the user asks to "count", "find", or "generate csv/report", you MUST use strict equality (`$eq`) for that specific field. Do NOT use `$gte`/`$lte` ranges for exact timestamps. This is critical for report consistency.
 
 Example Output:
 [
-  {{ "$match": {{ "safe": false }} }},
-  {{ "$count": "unsafe_count" }}
+  { "$match": { "safe": false } },
+  { "$count": "unsafe_count" }
 ]
 """
 
-async def generate_pipeline_from_llm(client, model: str, question: str) -> List[Dict[str, Any]]:
+QUERY_GENERATION_PROMPT = """
+Schema:
+{schema}
+{labels}
+User Question: "{question}"
+"""
+
+
+def pipeline_messages(question: str, normalized: bool, profile: Optional[str] = None) -> List[Dict[str, str]]:
+    """The pipeline-generation chat; `profile` is the schema_profiler description, sliced for the question."""
+    schema_desc = get_collection_schema(normalized=normalized, profile=profile)
+    labels = prediction_labels() if normalized else ""
+    return [
+        {"role": "system", "content": QUERY_GENERATION_SYSTEM_PROMPT},
+        {"role": "user", "content": QUERY_GENERATION_PROMPT.format(schema=schema_desc, labels=labels, question=question)},
+    ]
+
+
+@metrics.timed("pipeline_generation")
+async def generate_pipeline_from_llm(model: str, question: str) -> List[Dict[str, Any]]:
     """
     Generates a MongoDB aggregation pipeline using the LLM.
     """
-    schema_desc = get_collection_schema()
-    prompt = QUERY_GENERATION_PROMPT.format(schema=schema_desc, question=question)
+    collection_name = normalizer.query_collection(await resolve_knowledge_collection())
+    normalized = collection_name == NORMALIZED_COLLECTION
+    with metrics.span("schema_profile"):
+        profile = await schema_profiler.describe(get_db()[collection_name])
+    schema_key = get_collection_schema(normalized=normalized)
+    if profile is not None:
+        # Keyed on the field layout, not the sampled statistics, so cached pipelines survive refreshes.
+        schema_key = f"{schema_key}\n{profile[1]}"
+    cache_key = _pipeline_cache_key(question, schema_key)
+    cached = pipeline_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Pipeline cache hit")
+        return json.loads(cached)
 
-    messages = [
-        {"role": "system", "content": "You are a helpful assistant that generates MongoDB aggregation pipelines."},
-        {"role": "user", "content": prompt}
-    ]
+    # Questions that only differ in literals (dates, IDs, features, orgIds) share a template.
+    # tpl2: templates from before placeholders kept the case of each occurrence are not reused.
+    template_question, literals = extract_literals(question)
+    template_key = f"tpl2:{_pipeline_cache_key(template_question, schema_key)}" if literals else None
+    if template_key:
+        template = pipeline_cache.get(template_key)
+        if template is not None:
+            logger.info("Pipeline template hit")
+            pipeline = fill_template(json.loads(template), literals)
+            pipeline_cache.set(cache_key, json.dumps(pipeline))
+            return pipeline
+
+    sliced = None
+    if profile is not None:
+        with metrics.span("schema_slice"):
+            sliced = slice_schema(profile[0], question)
+    messages = pipeline_messages(question, normalized, sliced)
 
     try:
-        completion = await client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.0, # Deterministic output
-        )
+        with metrics.span("pipeline_llm"):
+            completion = await chat_completion(
+                model,
+                messages,
+                temperature=0.0, # Deterministic output
+            )
         response_text = completion.choices[0].message.content.strip()
         
         # Clean up potential markdown formatting
@@ -65,24 +162,39 @@ async def generate_pipeline_from_llm(client, model: str, question: str) -> List[
         pipeline = json.loads(response_text)
         if not isinstance(pipeline, list):
             raise ValueError("Output is not a list")
-            
+
+        if pipeline:
+            pipeline_cache.set(cache_key, json.dumps(pipeline))
+            template = build_template(pipeline, literals) if template_key else None
+            if template is not None:
+                pipeline_cache.set(template_key, json.dumps(template))
         return pipeline
 
+    except LLMOverloaded:
+        raise
     except Exception as e:
         logger.error(f"Error generating pipeline: {e}")
         return []
 
 from utils import convert_dates
 
-async def execute_aggregation(pipeline: List[Dict[str, Any]]) -> Any:
+@metrics.timed("execute_aggregation")
+async def execute_aggregation(
+    pipeline: List[Dict[str, Any]],
+    on_downgrade: Optional[Callable[[str], None]] = None,
+) -> Any:
     """
     Executes the aggregation pipeline against the database.
+
+    Over-budget pipelines are rejected with QueryTooExpensive, or run on a sample;
+    in that case `on_downgrade` receives a note to show the user.
     """
     if not pipeline:
         return None
         
     try:
-        collection_name = await resolve_knowledge_collection()
+        with metrics.span("resolve_collection"):
+            collection_name = await resolve_knowledge_collection()
         db = get_db()
         collection = db[collection_name]
         
@@ -92,29 +204,101 @@ async def execute_aggregation(pipeline: List[Dict[str, Any]]) -> Any:
                  raise ValueError("Unsafe aggregation stage detected.")
 
         # Convert date strings to datetime objects
-        pipeline = convert_dates(pipeline)
+        with metrics.span("convert_dates"):
+            pipeline = convert_dates(pipeline, normalizer.date_fields())
+        # Counts and processing-time stats per org/hour are served from pre-aggregated buckets,
+        # everything else from the normalized copy once it has caught up.
+        with metrics.span("rollup_rewrite"):
+            rollup_pipeline = rollups.rewrite(collection_name, pipeline)
+        if rollup_pipeline is not None:
+            logger.info("Answering from rollups")
+            collection_name, pipeline = ROLLUP_COLLECTION, rollup_pipeline
+        else:
+            collection_name = normalizer.query_collection(collection_name)
+        collection = db[collection_name]
+        with metrics.span("optimize_pipeline"):
+            pipeline = optimize_pipeline(pipeline, result_limit=AGGREGATION_RESULT_LIMIT)
+
+        index_advisor.observe(collection_name, pipeline)
 
-        results = await collection.aggregate(pipeline).to_list(length=100) # Limit results for safety
+        cache_key = pipeline_key(collection_name, pipeline)
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Result cache hit")
+            # Callers may reshape the results; never hand out the cached object itself.
+            return copy.deepcopy(cached)
+
+        with metrics.span("cost_guard"):
+            pipeline, note = await admit(collection, pipeline)
+        with metrics.span("mongo_execute"):
+            results = await collection.aggregate(pipeline, maxTimeMS=AGGREGATION_MAX_TIME_MS).to_list(length=AGGREGATION_RESULT_LIMIT) # Limit results for safety
+        if note is None:
+            result_cache.set(cache_key, copy.deepcopy(results), size=result_size(results))
+        elif on_downgrade is not None:
+            on_downgrade(note)
         return results
+    except QueryTooExpensive:
+        raise
+    except ExecutionTimeout:
+        raise timeout_error()
     except Exception as e:
         logger.error(f"Error executing aggregation: {e}")
         return str(e)
 
-async def generate_natural_response(client, model: str, question: str, data: Any) -> str:
+def _answer_messages(question: str, data: Any, pipeline: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, str]]:
+    # Large result sets are projected, tabulated and summarized to fit ANSWER_TOKEN_BUDGET.
+    payload = compact_for_prompt(question, data, pipeline)
+    return [
+        {"role": "system", "content": "You are a helpful data analyst. Answer the user's question based on the provided data."},
+        {"role": "user", "content": f"User Questions: {question}\n\nData Retrieved from Database: {payload}\n\nProvide a concise and accurate answer."}
+    ]
+
+@metrics.timed("answer_generation")
+async def generate_natural_response(
+    model: str,
+    question: str,
+    data: Any,
+    pipeline: Optional[List[Dict[str, Any]]] = None,
+) -> str:
     """
     Generates a natural language response based on the query results.
+    `pipeline` (when the data came from one) guides which fields are kept.
     """
-    messages = [
-        {"role": "system", "content": "You are a helpful data analyst. Answer the user's question based on the provided data."},
-        {"role": "user", "content": f"User Questions: {question}\n\nData Retrieved from Database: {json.dumps(data, default=str)}\n\nProvide a concise and accurate answer."}
-    ]
+    messages = _answer_messages(question, data, pipeline)
     
     try:
-        completion = await client.chat.completions.create(
-            model=model,
-            messages=messages
-        )
+        completion = await chat_completion(model, messages)
         return completion.choices[0].message.content
+    except LLMOverloaded:
+        raise
     except Exception as e:
         logger.error(f"Error generating response: {e}")
         return "I was unable to generate a response."
+
+@metrics.timed("answer_generation")
+async def stream_natural_response(
+    model: str,
+    question: str,
+    data: Any,
+    pipeline: Optional[List[Dict[str, Any]]] = None,
+) -> AsyncIterator[str]:
+    """
+    Same as generate_natural_response, but yields the answer token by token.
+    """
+    messages = _answer_messages(question, data, pipeline)
+    emitted = False
+
+    try:
+        async for chunk in stream_chat_completion(model, messages):
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                emitted = True
+                yield delta
+    except LLMOverloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Error streaming response: {e}")
+        if not emitted:
+            yield "I was unable to generate a response."
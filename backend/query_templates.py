@@ -0,0 +1,187 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# Literal kinds that commonly vary between otherwise identical questions.
+# Order matters: more specific patterns are matched first.
+_LITERAL_PATTERNS: List[Tuple[str, "re.Pattern[str]"]] = [
+    ("event_id", re.compile(r"\bV\d+_\d+_[A-Z]+_\d+\b")),
+    (
+        "datetime",
+        re.compile(r"\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:[:.]\d+)?)?(?:Z|[+-]\d{2}:\d{2})?(?![\w:.])"),
+    ),
+    ("date", re.compile(r"\b\d{4}-\d{2}-\d{2}\b")),
+    ("org_id", re.compile(r"\borg\s*_?\s*id\b\s*(?:is|=|:)?\s*['\"]?([A-Za-z0-9][\w-]*)", re.IGNORECASE)),
+    ("feature", re.compile(r"\b(nudity|minor|scamster|image\s*search)\b", re.IGNORECASE)),
+]
+
+_FEATURE_NAMES = {
+    "nudity": "Nudity",
+    "minor": "Minor",
+    "scamster": "Scamster",
+    "imagesearch": "ImageSearch",
+}
+
+_ANY_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+# Kinds whose values are only substituted when they are a whole string value in
+# the pipeline (short IDs could otherwise collide with field names).
+_WHOLE_VALUE_KINDS = {"event_id", "org_id"}
+# Kinds that can also appear inside field paths, e.g. processStatus.featureStatus.Nudity.
+_KEY_KINDS = {"feature"}
+
+
+def _canonical(kind: str, value: str) -> str:
+    if kind == "feature":
+        return _FEATURE_NAMES[re.sub(r"\s+", "", value.lower())]
+    if kind == "datetime":
+        return value.replace(" ", "T", 1)
+    return value
+
+
+def extract_literals(question: str) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Replaces literals in the question with `<litkind>` markers (chosen so they
+    survive normalize_question and cannot collide with ordinary words).
+
+    Returns the template question and the literals in order of appearance as
+    (kind, canonical value) pairs.
+    """
+    spans: List[Tuple[int, int, str, str]] = []
+
+    def overlaps(start: int, end: int) -> bool:
+        return any(start < e and s < end for s, e, _, _ in spans)
+
+    for kind, pattern in _LITERAL_PATTERNS:
+        for m in pattern.finditer(question):
+            group = 1 if pattern.groups else 0
+            start, end = m.span(group)
+            if overlaps(start, end):
+                continue
+            spans.append((start, end, kind, _canonical(kind, m.group(group))))
+
+    spans.sort()
+    parts: List[str] = []
+    literals: List[Tuple[str, str]] = []
+    cursor = 0
+    for start, end, kind, value in spans:
+        parts.append(question[cursor:start])
+        parts.append(f"<lit{kind.replace('_', '')}>")
+        literals.append((kind, value))
+        cursor = end
+    parts.append(question[cursor:])
+    return "".join(parts), literals
+
+
+def _placeholders(literals: List[Tuple[str, str]]) -> List[Tuple[str, str, str]]:
+    counters: Dict[str, int] = {}
+    out: List[Tuple[str, str, str]] = []
+    for kind, value in literals:
+        idx = counters.get(kind, 0)
+        counters[kind] = idx + 1
+        out.append((kind, value, f"__{kind}{idx}__"))
+    return out
+
+
+# How an occurrence of a literal is cased in the pipeline, e.g. "nudity_true_count"
+# for the feature "Nudity"; the template keeps the case for the filled-in value.
+_CASES = {"": lambda v: v, "lower": str.lower, "upper": str.upper}
+
+
+def _case_of(text: str, value: str) -> Optional[str]:
+    return next((case for case, fn in _CASES.items() if fn(value) == text), None)
+
+
+def _replace_all(obj: Any, fn) -> Any:
+    if isinstance(obj, list):
+        return [_replace_all(item, fn) for item in obj]
+    if isinstance(obj, dict):
+        return {fn(k, True): _replace_all(v, fn) for k, v in obj.items()}
+    if isinstance(obj, str):
+        return fn(obj, False)
+    return obj
+
+
+def _walk_strings(obj: Any):
+    if isinstance(obj, list):
+        for item in obj:
+            yield from _walk_strings(item)
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            yield k
+            yield from _walk_strings(v)
+    elif isinstance(obj, str):
+        yield obj
+
+
+def build_template(
+    pipeline: List[Dict[str, Any]], literals: List[Tuple[str, str]]
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Abstracts the question's literals out of a generated pipeline.
+
+    Returns None when the pipeline cannot be safely parameterized: a literal is
+    ambiguous or missing, occurs in a case other than as written, lower or upper
+    case, or the LLM derived extra dates from it (for example the end of a day
+    range), which a plain substitution would not update.
+    """
+    if not literals:
+        return None
+    values = [value for _, value in literals]
+    if len(set(values)) != len(values):
+        return None
+
+    slots = _placeholders(literals)
+    # Longest first so "2025-06-10T00:00" is substituted before "2025-06-10".
+    slots_by_length = sorted(slots, key=lambda s: len(s[1]), reverse=True)
+    patterns = {value: re.compile(re.escape(value), re.IGNORECASE) for _, value, _ in slots}
+    found = set()
+    odd_case = []
+
+    def substitute(text: str, is_key: bool) -> str:
+        for kind, value, placeholder in slots_by_length:
+            if is_key and kind not in _KEY_KINDS:
+                continue
+            if kind in _WHOLE_VALUE_KINDS:
+                if text == value:
+                    found.add(placeholder)
+                    return placeholder
+                continue
+
+            def mark(m: "re.Match[str]") -> str:
+                case = _case_of(m.group(0), value)
+                if case is None:
+                    odd_case.append(m.group(0))
+                    return m.group(0)
+                found.add(placeholder)
+                return placeholder if not case else f"{placeholder[:-2]}_{case}__"
+
+            text = patterns[value].sub(mark, text)
+        return text
+
+    template = _replace_all(pipeline, substitute)
+    if odd_case or len(found) != len(slots):
+        return None
+
+    has_dates = any(kind in ("date", "datetime") for kind, _ in literals)
+    if has_dates and any(_ANY_DATE.search(s) for s in _walk_strings(template)):
+        return None
+    return template
+
+
+def fill_template(
+    template: List[Dict[str, Any]], literals: List[Tuple[str, str]]
+) -> List[Dict[str, Any]]:
+    """
+    Substitutes new literal values into a template built by build_template.
+    """
+    slots = _placeholders(literals)
+
+    def substitute(text: str, is_key: bool) -> str:
+        for _, value, placeholder in slots:
+            for case, fn in _CASES.items():
+                cased = placeholder if not case else f"{placeholder[:-2]}_{case}__"
+                if cased in text:
+                    text = text.replace(cased, fn(value))
+        return text
+
+    return _replace_all(template, substitute)
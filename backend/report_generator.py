@@ -1,9 +1,13 @@
 
+import asyncio
 import os
 import logging
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+from uuid import uuid4
 import openpyxl
+import metrics
+import normalizer
 from db import get_db, resolve_knowledge_collection
 
 logger = logging.getLogger(__name__)
@@ -50,72 +54,151 @@ def _clean_pipeline_for_report(pipeline: List[Dict[str, Any]]) -> List[Dict[str,
         cleaned.append(stage)
     return cleaned
 
+from pipeline_optimizer import optimize_pipeline
 from utils import convert_dates
 
-async def generate_report(pipeline: List[Dict[str, Any]], filename_prefix: str = "report", format: str = "xlsx") -> Optional[str]:
+# Documents fetched per cursor round trip and rows written per file flush.
+# Together they bound peak memory independently of the report size.
+REPORT_BATCH_SIZE = int(os.getenv("REPORT_BATCH_SIZE", "1000"))
+
+
+ProgressCallback = Callable[[int], None]
+
+
+async def _iter_batches(docs: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Groups documents into lists of at most REPORT_BATCH_SIZE items.
+    """
+    batch: List[Dict[str, Any]] = []
+    async for doc in docs:
+        batch.append(doc)
+        if len(batch) >= REPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _write_csv(
+    docs: AsyncIterator[Dict[str, Any]],
+    filepath: str,
+    progress: Optional[ProgressCallback] = None,
+) -> int:
+    rows_written = 0
+    with open(filepath, mode='w', newline='', encoding='utf-8') as f:
+        writer = None
+
+        def write_batch(batch: List[Dict[str, Any]]) -> None:
+            nonlocal writer
+            rows = [_flatten_event_log(doc) for doc in batch]
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+            writer.writerows(rows)
+
+        async for batch in _iter_batches(docs):
+            # Flattening and writing are CPU/disk bound; keep them off the event loop.
+            await asyncio.to_thread(write_batch, batch)
+            rows_written += len(batch)
+            if progress:
+                progress(rows_written)
+    return rows_written
+
+
+async def _write_xlsx(
+    docs: AsyncIterator[Dict[str, Any]],
+    filepath: str,
+    progress: Optional[ProgressCallback] = None,
+) -> int:
+    # Write-only mode streams rows to disk instead of keeping every cell in memory.
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(title="Report")
+    rows_written = 0
+    headers: Optional[List[str]] = None
+
+    def write_batch(batch: List[Dict[str, Any]]) -> None:
+        nonlocal headers
+        rows = [_flatten_event_log(doc) for doc in batch]
+        if headers is None:
+            headers = list(rows[0].keys())
+            ws.append(headers)
+        for item in rows:
+            ws.append([str(item.get(h, "")) for h in headers])
+
+    async for batch in _iter_batches(docs):
+        await asyncio.to_thread(write_batch, batch)
+        rows_written += len(batch)
+        if progress:
+            progress(rows_written)
+
+    if rows_written:
+        await asyncio.to_thread(wb.save, filepath)
+    return rows_written
+
+
+def prepare_report_pipeline(pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Returns the pipeline actually executed for a report: no counts/limits/projections,
+    date strings converted, then optimized. On the normalized copy the flattened
+    `features` are dropped again so exports keep the source's columns.
+    """
+    pipeline = convert_dates(_clean_pipeline_for_report(pipeline), normalizer.date_fields())
+    if normalizer.ready():
+        pipeline = pipeline + [{"$project": {"features": 0}}]
+    return optimize_pipeline(pipeline)
+
+
+@metrics.timed("report_generation")
+async def generate_report(
+    pipeline: List[Dict[str, Any]],
+    filename_prefix: str = "report",
+    format: str = "xlsx",
+    db=None,
+    progress: Optional[ProgressCallback] = None,
+) -> Optional[str]:
     """
     Executes the pipeline, flattens results, saves to Excel or CSV, and returns the filename.
+
+    Results are streamed from the cursor in batches and written incrementally, so
+    memory use stays flat regardless of how many documents match. `db` selects the
+    database handle (defaults to the shared client) and `progress` is called with
+    the running row count after every batch.
     """
+    filepath = None
     try:
-        collection_name = await resolve_knowledge_collection()
-        db = get_db()
+        collection_name = normalizer.query_collection(await resolve_knowledge_collection())
+        db = db if db is not None else get_db()
         collection = db[collection_name]
         
-        # Clean pipeline to ensure we get docs, not counts, and no limits
-        pipeline = _clean_pipeline_for_report(pipeline)
-
-        # Convert date strings to datetime objects (CRITICAL FIX)
-        pipeline = convert_dates(pipeline)
-        
-        # Execute aggregation without limit
-        cursor = collection.aggregate(pipeline)
+        # Clean pipeline to ensure we get docs, not counts, and no limits,
+        # and convert date strings to datetime objects (CRITICAL FIX)
+        pipeline = prepare_report_pipeline(pipeline)
         
-        # Fetch all documents (warning: memory intensive for huge datasets, but requested)
-        docs = await cursor.to_list(length=None)
-        
-        if not docs:
-            return None
+        # Execute aggregation without limit, fetching documents batch by batch
+        cursor = collection.aggregate(pipeline, allowDiskUse=True, batchSize=REPORT_BATCH_SIZE)
 
-        # Flatten data
-        flattened_docs = [_flatten_event_log(doc) for doc in docs]
-        
-        if not flattened_docs:
-            return None
-            
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        headers = list(flattened_docs[0].keys())
-
-        if format == "csv":
-            filename = f"{filename_prefix}_{timestamp}.csv"
-            filepath = os.path.join(REPORTS_DIR, filename)
-            
-            with open(filepath, mode='w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=headers)
-                writer.writeheader()
-                writer.writerows(flattened_docs)
-                
-            logger.info(f"CSV Report generated: {filepath}")
-            return filename
-            
-        else:
-            # Default to Excel
-            wb = openpyxl.Workbook()
-            ws = wb.active
-            ws.title = "Report"
-            
-            ws.append(headers)
-            
-            for item in flattened_docs:
-                row = [str(item.get(h, "")) for h in headers]
-                ws.append(row)
-                
-            filename = f"{filename_prefix}_{timestamp}.xlsx"
-            filepath = os.path.join(REPORTS_DIR, filename)
-            
-            wb.save(filepath)
-            logger.info(f"Excel Report generated: {filepath}")
-            return filename
+        extension = "csv" if format == "csv" else "xlsx"
+        filename = f"{filename_prefix}_{timestamp}_{uuid4().hex[:6]}.{extension}"
+        filepath = os.path.join(REPORTS_DIR, filename)
+
+        with metrics.span("report_write"):
+            if format == "csv":
+                rows_written = await _write_csv(cursor, filepath, progress)
+            else:
+                # Default to Excel
+                rows_written = await _write_xlsx(cursor, filepath, progress)
+
+        if not rows_written:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return None
+
+        logger.info(f"{extension.upper()} Report generated: {filepath} ({rows_written} rows)")
+        return filename
         
     except Exception as e:
         logger.error(f"Error generating report: {e}")
+        if filepath and os.path.exists(filepath):
+            os.remove(filepath)
         return None
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set
+from uuid import uuid4
+
+import normalizer
+from db import REPORT_JOBS_COLLECTION, get_db, get_report_db, resolve_knowledge_collection
+from report_generator import generate_report, prepare_report_pipeline
+
+logger = logging.getLogger(__name__)
+
+# Number of reports generated at the same time; further jobs wait in the queue.
+REPORT_JOB_CONCURRENCY = int(os.getenv("REPORT_JOB_CONCURRENCY", "2"))
+# Jobs allowed to wait before new submissions are rejected.
+REPORT_JOB_QUEUE_SIZE = int(os.getenv("REPORT_JOB_QUEUE_SIZE", "20"))
+# Finished jobs kept around for status lookups.
+REPORT_JOB_HISTORY = int(os.getenv("REPORT_JOB_HISTORY", "200"))
+# Time budget for the up-front row count used to compute the ETA.
+REPORT_JOB_COUNT_TIMEOUT_MS = int(os.getenv("REPORT_JOB_COUNT_TIMEOUT_MS", "2000"))
+# Job records are mirrored to REPORT_JOBS_COLLECTION so any uvicorn worker can
+# answer /reports/jobs/{id}; progress is written at most this often.
+REPORT_JOB_PERSIST_SECONDS = float(os.getenv("REPORT_JOB_PERSIST_SECONDS", "2"))
+# How long job records stay in Mongo (TTL index on expires_at).
+REPORT_JOB_RETENTION_SECONDS = int(os.getenv("REPORT_JOB_RETENTION_SECONDS", "86400"))
+
+# Jobs of this process; other workers' jobs are read from Mongo.
+JOBS: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+_persisting: Set[asyncio.Task] = set()
+
+
+class ReportQueueFull(Exception):
+    pass
+
+
+def _ensure_workers() -> asyncio.Queue:
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=REPORT_JOB_QUEUE_SIZE)
+    if not _workers:
+        for _ in range(max(1, REPORT_JOB_CONCURRENCY)):
+            _workers.append(asyncio.create_task(_worker()))
+    return _queue
+
+
+def _forget_old_jobs() -> None:
+    while len(JOBS) > REPORT_JOB_HISTORY:
+        oldest_id = next((jid for jid, j in JOBS.items() if j["status"] in ("done", "failed")), None)
+        if oldest_id is None:
+            return
+        JOBS.pop(oldest_id, None)
+
+
+async def _persist(job: Dict[str, Any]) -> None:
+    job["persisted_at"] = time.time()
+    record = {k: v for k, v in job.items() if k not in ("id", "persisted_at")}
+    record["expires_at"] = datetime.now(timezone.utc) + timedelta(seconds=REPORT_JOB_RETENTION_SECONDS)
+    try:
+        await get_db()[REPORT_JOBS_COLLECTION].replace_one({"_id": job["id"]}, record, upsert=True)
+    except Exception as e:
+        logger.warning(f"Could not persist report job {job['id']}: {e}")
+
+
+def _persist_soon(job: Dict[str, Any]) -> None:
+    if time.time() - job.get("persisted_at", 0) < REPORT_JOB_PERSIST_SECONDS:
+        return
+    job["persisted_at"] = time.time()
+    task = asyncio.create_task(_persist(job))
+    _persisting.add(task)
+    task.add_done_callback(_persisting.discard)
+
+
+async def submit_report_job(pipeline: List[Dict[str, Any]], format: str = "xlsx") -> Dict[str, Any]:
+    """
+    Queues a report export and returns the job record immediately.
+    Raises ReportQueueFull when the queue is at capacity.
+    """
+    queue = _ensure_workers()
+    job = {
+        "id": uuid4().hex,
+        "status": "queued",
+        "format": format,
+        "rows_written": 0,
+        "total_estimate": None,
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "filename": None,
+        "error": None,
+    }
+    try:
+        queue.put_nowait((job, pipeline))
+    except asyncio.QueueFull:
+        raise ReportQueueFull("Too many reports are being generated right now. Please try again shortly.")
+    JOBS[job["id"]] = job
+    _forget_old_jobs()
+    await _persist(job)
+    return job
+
+
+async def _load_job(job_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        record = await get_db()[REPORT_JOBS_COLLECTION].find_one({"_id": job_id})
+    except Exception as e:
+        logger.warning(f"Could not load report job {job_id}: {e}")
+        return None
+    if not record:
+        return None
+    record["id"] = record.pop("_id")
+    return record
+
+
+async def get_job_status(job_id: str) -> Optional[Dict[str, Any]]:
+    job = JOBS.get(job_id) or await _load_job(job_id)
+    if not job:
+        return None
+
+    now = job["finished_at"] or time.time()
+    elapsed = (now - job["started_at"]) if job["started_at"] else 0.0
+    rate = (job["rows_written"] / elapsed) if elapsed > 0 else None
+    eta = None
+    if job["status"] == "running" and rate and job["total_estimate"]:
+        eta = max(0.0, (job["total_estimate"] - job["rows_written"]) / rate)
+    elif job["status"] in ("done", "failed"):
+        eta = 0.0
+
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "format": job["format"],
+        "rows_written": job["rows_written"],
+        "total_estimate": job["total_estimate"],
+        "rows_per_second": round(rate, 1) if rate else None,
+        "eta_seconds": round(eta, 1) if eta is not None else None,
+        "download_url": f"/reports/{job['filename']}" if job["filename"] else None,
+        "error": job["error"],
+    }
+
+
+async def _estimate_total(pipeline: List[Dict[str, Any]]) -> Optional[int]:
+    try:
+        collection_name = normalizer.query_collection(await resolve_knowledge_collection())
+        counted = prepare_report_pipeline(pipeline) + [{"$count": "n"}]
+        cursor = get_report_db()[collection_name].aggregate(counted, maxTimeMS=REPORT_JOB_COUNT_TIMEOUT_MS)
+        docs = await cursor.to_list(length=1)
+        return int(docs[0]["n"]) if docs else 0
+    except Exception as e:
+        logger.info(f"Report row estimate unavailable: {e}")
+        return None
+
+
+async def _run_job(job: Dict[str, Any], pipeline: List[Dict[str, Any]]) -> None:
+    job["status"] = "running"
+    job["started_at"] = time.time()
+    job["total_estimate"] = await _estimate_total(pipeline)
+    await _persist(job)
+
+    def progress(rows_written: int) -> None:
+        job["rows_written"] = rows_written
+        _persist_soon(job)
+
+    filename = await generate_report(
+        pipeline,
+        format=job["format"],
+        db=get_report_db(),
+        progress=progress,
+    )
+    job["finished_at"] = time.time()
+    if filename:
+        job["filename"] = filename
+        job["status"] = "done"
+    else:
+        job["status"] = "failed"
+        job["error"] = "The query returned no rows (or only a count), or the export failed."
+
+
+async def _worker() -> None:
+    assert _queue is not None
+    while True:
+        job, pipeline = await _queue.get()
+        try:
+            await _run_job(job, pipeline)
+        except Exception as e:
+            logger.exception(f"Report job {job['id']} failed")
+            job["status"] = "failed"
+            job["error"] = str(e)
+            job["finished_at"] = time.time()
+        finally:
+            _queue.task_done()
+        # Let in-flight progress writes land before the final record.
+        await asyncio.gather(*_persisting, return_exceptions=True)
+        await _persist(job)
+
+
+async def shutdown_workers() -> None:
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
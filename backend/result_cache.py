@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+
+from cache import LRUCache
+from db import get_db
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+# Result-set cache for execute_aggregation. Different phrasings often produce the
+# same pipeline and dashboards re-run it every few seconds.
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1024"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "30"))
+# "ttl": entries simply expire. "change_stream": additionally clear the cache
+# whenever the knowledge collection changes (requires a replica set).
+RESULT_CACHE_INVALIDATION = os.getenv("RESULT_CACHE_INVALIDATION", "ttl").lower()
+
+result_cache = LRUCache(
+    max_entries=RESULT_CACHE_MAX_ENTRIES,
+    ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+    max_bytes=RESULT_CACHE_MAX_BYTES,
+)
+
+_watcher: Optional[asyncio.Task] = None
+
+
+# Keys whose value is a query filter (or a list of them): its top-level fields are ANDed.
+_FILTER_KEYS = {"$match", "$and", "$or", "$nor", "$elemMatch"}
+
+
+def _canonical(value: Any, is_filter: bool = False) -> Any:
+    if isinstance(value, dict):
+        # Only operator documents ({"$gte": .., "$lt": ..}) and filters are order-insensitive.
+        # Embedded documents compare field by field in order, and $sort, $project or
+        # $group specs shape the output, so their key order is kept.
+        unordered = is_filter or (value and all(str(k).startswith("$") for k in value))
+        items = sorted(value.items()) if unordered else value.items()
+        return {k: _canonical(v, k in _FILTER_KEYS) for k, v in items}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v, is_filter) for v in value]
+    if isinstance(value, (datetime, date)):
+        return {"$date": value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    return value
+
+
+def pipeline_key(collection: str, pipeline: List[Dict[str, Any]]) -> str:
+    """
+    Stable hash of a pipeline after convert_dates: keys of filters and operator
+    documents sorted, other documents kept in order, dates normalized to ISO strings.
+    """
+    canonical = json.dumps(_canonical(pipeline), sort_keys=False, separators=(",", ":"), default=str)
+    digest = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    return f"{collection}:{digest}"
+
+
+def result_size(results: Any) -> int:
+    return len(dumps(results))
+
+
+async def _watch_collection(collection: str) -> None:
+    try:
+        async with get_db()[collection].watch() as stream:
+            logger.info(f"Result cache invalidation watching '{collection}'")
+            async for _ in stream:
+                result_cache.clear()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"Change stream unavailable ({e}); result cache falls back to TTL expiry")
+
+
+def start_invalidation(collection: str) -> None:
+    global _watcher
+    if RESULT_CACHE_INVALIDATION != "change_stream":
+        return
+    if _watcher is None or _watcher.done():
+        _watcher = asyncio.create_task(_watch_collection(collection))
+
+
+async def stop_invalidation() -> None:
+    global _watcher
+    if _watcher is not None:
+        _watcher.cancel()
+        await asyncio.gather(_watcher, return_exceptions=True)
+        _watcher = None
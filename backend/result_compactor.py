@@ -0,0 +1,218 @@
+"""
+Fits query results into a token budget before they go into the answer prompt.
+
+Results that already fit are passed through untouched. Larger ones are, in order:
+  1. flattened to dotted paths and projected to the fields the pipeline or the
+     question refers to (plus _id),
+  2. collapsed into a table: shared values go to "common", the remaining columns
+     are listed once and rows become value arrays,
+  3. summarized per column (count, min/max/mean, true/false counts, top values)
+     over all rows, with only as many leading rows kept as the budget allows.
+Tokens are counted with tiktoken when it is installed, otherwise with a local
+approximation of BPE pre-tokenization.
+"""
+import functools
+import logging
+import math
+import os
+import re
+from collections import Counter
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Set
+
+from database import tokenize_query
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+ANSWER_TOKEN_BUDGET = int(os.getenv("ANSWER_TOKEN_BUDGET", "3000"))
+COMPACT_SAMPLE_ROWS = int(os.getenv("COMPACT_SAMPLE_ROWS", "20"))
+_MAX_VALUE_CHARS = 200
+_TOP_VALUES = 5
+_TRUNCATED = " ...[truncated]"
+
+# Word pieces, single punctuation marks: roughly what a BPE pre-tokenizer splits on.
+_APPROX_TOKEN_RE = re.compile(r"[^\W_]+|[^\w\s]|_")
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Long words cost about one token per four characters.
+    return sum((len(piece) + 3) // 4 for piece in _APPROX_TOKEN_RE.findall(text))
+
+
+def _flatten(doc: Dict[str, Any], prefix: str = "", out: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    out = {} if out is None else out
+    for key, value in doc.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            _flatten(value, f"{path}.", out)
+        else:
+            out[path] = value
+    return out
+
+
+def _pipeline_refs(value: Any, out: Set[str]) -> Set[str]:
+    """Field names a pipeline mentions: $field paths, filter keys and output names."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not key.startswith("$"):
+                out.add(key)
+            elif key == "$count" and isinstance(item, str):
+                out.add(item)
+            _pipeline_refs(item, out)
+    elif isinstance(value, list):
+        for item in value:
+            _pipeline_refs(item, out)
+    elif isinstance(value, str) and value.startswith("$") and not value.startswith("$$"):
+        out.add(value[1:])
+    return out
+
+
+def _relevant(paths: List[str], pipeline: Optional[List[Dict[str, Any]]], question: str) -> List[str]:
+    refs = _pipeline_refs(pipeline or [], set())
+    tokens = tokenize_query(question)
+
+    def wanted(path: str) -> bool:
+        if any(path == r or path.startswith(r + ".") or r.startswith(path + ".") for r in refs):
+            return True
+        segments = path.lower().split(".")
+        return any(token in segment for token in tokens for segment in segments)
+
+    kept = [p for p in paths if p == "_id" or wanted(p)]
+    # Nothing identifiable beyond the _id: keep the shallow fields rather than guess.
+    if len(kept) <= 1:
+        kept = [p for p in paths if p.count(".") <= 1]
+    return kept
+
+
+def _shorten(value: Any) -> Any:
+    if isinstance(value, str) and len(value) > _MAX_VALUE_CHARS:
+        return value[:_MAX_VALUE_CHARS] + "..."
+    if isinstance(value, list) and len(value) > 10:
+        return value[:10] + [f"... {len(value) - 10} more"]
+    return value
+
+
+def _as_number(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+        return number if math.isfinite(number) else None
+    return None
+
+
+def _summarize_column(values: List[Any]) -> Dict[str, Any]:
+    present = [v for v in values if v is not None]
+    summary: Dict[str, Any] = {"count": len(present)}
+    if not present:
+        return summary
+    if all(isinstance(v, bool) for v in present):
+        trues = sum(1 for v in present if v)
+        summary.update({"true": trues, "false": len(present) - trues})
+        return summary
+    if all(isinstance(v, (datetime, date)) for v in present):
+        summary.update({"min": min(present), "max": max(present)})
+        return summary
+    numbers = [_as_number(v) for v in present]
+    if all(n is not None for n in numbers):
+        summary.update({
+            "min": min(numbers),
+            "max": max(numbers),
+            "mean": round(sum(numbers) / len(numbers), 6),
+        })
+        return summary
+    counts = Counter(dumps(v) if isinstance(v, (list, dict)) else v for v in present)
+    summary["distinct"] = len(counts)
+    if len(counts) < len(present):
+        summary["top"] = [[_shorten(v), n] for v, n in counts.most_common(_TOP_VALUES)]
+    return summary
+
+
+def _fits(payload: Any, budget: int) -> Optional[str]:
+    text = dumps(payload)
+    return text if count_tokens(text) <= budget else None
+
+
+def _truncate(text: str, budget: int) -> str:
+    budget -= count_tokens(_TRUNCATED)
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + _TRUNCATED
+
+
+def compact_for_prompt(
+    question: str,
+    data: Any,
+    pipeline: Optional[List[Dict[str, Any]]] = None,
+    budget: int = ANSWER_TOKEN_BUDGET,
+) -> str:
+    """JSON text of `data` for the answer prompt, compacted to at most ~`budget` tokens."""
+    text = dumps(data)
+    original_tokens = count_tokens(text)
+    if original_tokens <= budget:
+        return text
+
+    docs = [data] if isinstance(data, dict) else data
+    if not isinstance(docs, list) or not docs or not all(isinstance(d, dict) for d in docs):
+        return _truncate(text, budget)
+
+    flat = [_flatten(d) for d in docs]
+    paths = list(dict.fromkeys(p for row in flat for p in row))
+    columns = _relevant(paths, pipeline, question)
+    rows = [{c: _shorten(row.get(c)) for c in columns} for row in flat]
+    if len(rows) == 1:
+        single = dumps(rows[0])
+        result = single if count_tokens(single) <= budget else _truncate(single, budget)
+        logger.info(f"Compacted answer data from {original_tokens} to {count_tokens(result)} tokens")
+        return result
+
+    common = {c: rows[0][c] for c in columns if all(row[c] == rows[0][c] for row in rows)}
+    varying = [c for c in columns if c not in common]
+    table: Dict[str, Any] = {
+        "row_count": len(rows),
+        "common": common,
+        "columns": varying,
+        "rows": [[row[c] for c in varying] for row in rows],
+    }
+    result = _fits(table, budget)
+
+    if result is None:
+        table["summary"] = {c: _summarize_column([row[c] for row in rows]) for c in varying}
+        shown = min(len(rows), COMPACT_SAMPLE_ROWS)
+        while result is None and shown >= 0:
+            table["rows"] = table["rows"][:shown]
+            table["note"] = (
+                f"Showing the first {shown} of {len(rows)} rows; 'summary' covers all rows "
+                "and 'common' holds values shared by every row."
+            )
+            result = _fits(table, budget)
+            shown = shown // 2 if shown > 1 else shown - 1
+        if result is None:
+            result = _truncate(dumps(table), budget)
+
+    logger.info(f"Compacted answer data from {original_tokens} to {count_tokens(result)} tokens")
+    return result
@@ -0,0 +1,728 @@
+"""
+Materialized rollups of the knowledge collection for counts and processing times.
+
+One bucket per (hour of eventStartTime, orgId) in ROLLUP_COLLECTION:
+
+  {_id: {orgId, hour}, orgId, hour,
+   events: n, safe: {true: n, false: n},
+   features: {<Feature>: {true: n, false: n,
+                          time_count: n, time_sum: s, time_min: s, time_max: s,
+                          time_hist: {h0: n, h1: n, ...}}}}
+
+Times are eventLog.<Feature>...MediaProcessingTimeInSeconds parsed once at
+ingestion; time_hist slot i counts times <= ROLLUP_TIME_BUCKETS[i], the last
+slot the rest. Events whose eventStartTime is neither a date nor a parseable
+string land in an hour=null bucket; while one exists, date filters and date
+group keys are not answered from buckets.
+
+Every counted event is kept in ROLLUP_SEEN_COLLECTION as what it contributed
+(orgId, hour, safe, feature flags and times), so each change is applied as a
+delta: the previous version's counts are taken out of its bucket and the new
+one's added, and replaying a change the buckets already reflect does nothing.
+time_min/time_max cannot be taken back out; when an event that had a time
+changes or goes away, they are recomputed for that bucket and feature from the
+counted events. Changes arrive through a change stream (ROLLUP_SYNC, the
+default: inserts, updates and deletes) or by tailing in TAIL_FIELD order with a
+count check against the source (inserts only, see tailing.py; rebuild after
+edits with POST /admin/rollups/rebuild). A batch is marked pending in
+ROLLUP_STATE_COLLECTION while it is applied; a pending batch found at startup
+(a crash mid-batch) triggers a rebuild.
+
+rewrite() maps eligible chat pipelines onto the buckets: an optional leading
+$match on orgId, hour-aligned eventStartTime ranges and at most one of `safe`
+or a single feature flag, followed by $count or by a $group on
+null/orgId/date parts of eventStartTime with $sum: 1 counts (and, without a
+safe/feature filter, $sum/$avg/$min/$max of processing times). Pipelines
+written for the normalized copy (features.<F>.flag / .seconds) qualify too.
+Anything else runs on the raw events as before.
+"""
+import asyncio
+import logging
+import math
+import os
+import re
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+
+import tailing
+from db import ROLLUP_COLLECTION, ROLLUP_SEEN_COLLECTION, ROLLUP_STATE_COLLECTION, get_db
+from utils import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+ROLLUPS_ENABLED = os.getenv("ROLLUPS_ENABLED", "true").lower() == "true"
+ROLLUP_SYNC = os.getenv("ROLLUP_SYNC", "change_stream")  # change_stream | tail
+ROLLUP_REFRESH_SECONDS = float(os.getenv("ROLLUP_REFRESH_SECONDS", "30"))
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", "5000"))
+ROLLUP_TIME_BUCKETS = [
+    float(b) for b in os.getenv("ROLLUP_TIME_BUCKETS", "0.1,0.25,0.5,1,2,5,10,30").split(",") if b.strip()
+]
+
+# Bumped when the state document changes meaning; older state triggers a rebuild.
+_STATE_VERSION = 3
+
+_FEATURE_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+# Raw field names, or the flattened ones of the normalized copy (see normalizer.py).
+_FEATURE_FLAG = re.compile(r"^(?:processStatus\.featureStatus\.([A-Za-z0-9_]+)|features\.([A-Za-z0-9_]+)\.flag)$")
+_TIME_FIELD = re.compile(
+    r"^\$(?:eventLog\.([A-Za-z0-9_]+)\.report\.documentReport\.report\.MediaProcessingTimeInSeconds"
+    r"|features\.([A-Za-z0-9_]+)\.seconds)$"
+)
+_TIME_PATH = ("report", "documentReport", "report", "MediaProcessingTimeInSeconds")
+# $dateToString specifiers that only depend on the hour an event falls in.
+_HOUR_FORMAT = re.compile(r"%[^YmdHjwuUVG%]")
+_DATE_PARTS = {"$year", "$month", "$dayOfMonth", "$hour", "$dayOfWeek", "$dayOfYear", "$week", "$isoWeek", "$isoWeekYear", "$isoDayOfWeek"}
+_TRUNC_UNITS = {"hour", "day", "week", "month", "quarter", "year"}
+_ROWS = "__rollup_rows"
+_UNSUPPORTED = object()
+
+# Projection of the source: only what the buckets need, not the eventLog reports.
+_SLIM_STAGE = {"$project": {
+    "orgId": 1,
+    "eventStartTime": 1,
+    "safe": 1,
+    "featureStatus": "$processStatus.featureStatus",
+    "times": {"$map": {
+        "input": {"$objectToArray": {"$cond": [{"$eq": [{"$type": "$eventLog"}, "object"]}, "$eventLog", {}]}},
+        "in": {"k": "$$this.k", "v": "$$this.v.report.documentReport.report.MediaProcessingTimeInSeconds"},
+    }},
+}}
+if tailing.TAIL_FIELD != "_id":
+    _SLIM_STAGE["$project"][tailing.TAIL_FIELD] = 1
+# What a counted event contributes, kept per event in ROLLUP_SEEN_COLLECTION (plus its hour).
+_SLIM_KEYS = ("orgId", "safe", "featureStatus", "times")
+
+_source: Optional[str] = None
+_position: Optional[List[Any]] = None
+_resume_token: Any = None
+_events = 0          # events counted into the buckets
+_undated = False     # some bucket has hour=null
+_stale = False       # edits since the last resume token are unknown (it was rejected)
+_ready = False
+_lock: Optional[asyncio.Lock] = None
+_task: Optional[asyncio.Task] = None
+
+
+# --- Maintenance ---------------------------------------------------------------
+
+def _hour(value: Any) -> Optional[datetime]:
+    if isinstance(value, str):
+        value = parse_timestamp(value)
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _seconds(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or value is None:
+        return None
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    return seconds if math.isfinite(seconds) else None
+
+
+def _hist_slot(seconds: float) -> str:
+    for i, bound in enumerate(ROLLUP_TIME_BUCKETS):
+        if seconds <= bound:
+            return f"h{i}"
+    return f"h{len(ROLLUP_TIME_BUCKETS)}"
+
+
+def _slim(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """_SLIM_STAGE applied to a full document from the change stream."""
+    status = doc.get("processStatus")
+    event_log = doc.get("eventLog")
+    times = []
+    for feature, entry in (event_log.items() if isinstance(event_log, dict) else ()):
+        for part in _TIME_PATH:
+            entry = entry.get(part) if isinstance(entry, dict) else None
+        times.append({"k": feature, "v": entry})
+    return {
+        "_id": doc["_id"],
+        "orgId": doc.get("orgId"),
+        "eventStartTime": doc.get("eventStartTime"),
+        "safe": doc.get("safe"),
+        "featureStatus": status.get("featureStatus") if isinstance(status, dict) else None,
+        "times": times,
+    }
+
+
+def bucket_updates(events: List[Dict[str, Any]]) -> Dict[Tuple[Any, Optional[datetime]], Dict[str, Dict[str, Any]]]:
+    """(orgId, hour) -> {"$inc": ..., "$min": ..., "$max": ...} for slim events (see _SLIM_STAGE) or seen documents."""
+    buckets: Dict[Tuple[Any, Optional[datetime]], Dict[str, Dict[str, Any]]] = {}
+    for event in events:
+        key = (event.get("orgId"), event["hour"] if "hour" in event else _hour(event.get("eventStartTime")))
+        update = buckets.setdefault(key, {"$inc": {}, "$min": {}, "$max": {}})
+        inc, low, high = update["$inc"], update["$min"], update["$max"]
+
+        inc["events"] = inc.get("events", 0) + 1
+        safe = event.get("safe")
+        if isinstance(safe, bool):
+            path = f"safe.{'true' if safe else 'false'}"
+            inc[path] = inc.get(path, 0) + 1
+
+        status = event.get("featureStatus")
+        for feature, flag in (status.items() if isinstance(status, dict) else ()):
+            if isinstance(flag, bool) and _FEATURE_NAME.match(feature):
+                path = f"features.{feature}.{'true' if flag else 'false'}"
+                inc[path] = inc.get(path, 0) + 1
+
+        for item in event.get("times") or ():
+            feature = item.get("k")
+            seconds = _seconds(item.get("v"))
+            if seconds is None or not isinstance(feature, str) or not _FEATURE_NAME.match(feature):
+                continue
+            prefix = f"features.{feature}"
+            for path, amount in (
+                (f"{prefix}.time_count", 1),
+                (f"{prefix}.time_sum", seconds),
+                (f"{prefix}.time_hist.{_hist_slot(seconds)}", 1),
+            ):
+                inc[path] = inc.get(path, 0) + amount
+            low[f"{prefix}.time_min"] = min(seconds, low.get(f"{prefix}.time_min", seconds))
+            high[f"{prefix}.time_max"] = max(seconds, high.get(f"{prefix}.time_max", seconds))
+    return buckets
+
+
+async def _save_state(pending: bool = False) -> None:
+    await get_db()[ROLLUP_STATE_COLLECTION].replace_one({"_id": _source}, {
+        "_id": _source,
+        "version": _STATE_VERSION,
+        "position": _position,
+        "resume_token": _resume_token,
+        "events": _events,
+        "undated": _undated,
+        "pending": pending,
+    }, upsert=True)
+
+
+def _seen_doc(event: Dict[str, Any]) -> Dict[str, Any]:
+    """What ROLLUP_SEEN_COLLECTION keeps of a counted slim event: enough to take its counts back out."""
+    doc = {key: event.get(key) for key in _SLIM_KEYS}
+    doc["hour"] = event["hour"] if "hour" in event else _hour(event.get("eventStartTime"))
+    return doc
+
+
+def _merge_updates(into: Dict[Tuple[Any, Any], Dict[str, Dict[str, Any]]], events: List[Dict[str, Any]], sign: int) -> None:
+    for key, update in bucket_updates(events).items():
+        target = into.setdefault(key, {"$inc": {}, "$min": {}, "$max": {}})
+        for path, amount in update["$inc"].items():
+            target["$inc"][path] = target["$inc"].get(path, 0) + sign * amount
+        if sign > 0:
+            for path, seconds in update["$min"].items():
+                target["$min"][path] = min(seconds, target["$min"].get(path, seconds))
+            for path, seconds in update["$max"].items():
+                target["$max"][path] = max(seconds, target["$max"].get(path, seconds))
+
+
+def _timed_features(event: Dict[str, Any]) -> List[str]:
+    return [
+        item.get("k") for item in event.get("times") or ()
+        if isinstance(item.get("k"), str) and _FEATURE_NAME.match(item["k"]) and _seconds(item.get("v")) is not None
+    ]
+
+
+async def _apply(updates: Dict[Tuple[Any, Any], Dict[str, Dict[str, Any]]]) -> None:
+    ops = []
+    for (org_id, hour), update in updates.items():
+        body = {op: fields for op, fields in update.items() if fields}
+        body["$inc"] = {path: amount for path, amount in body.get("$inc", {}).items() if amount}
+        body = {op: fields for op, fields in body.items() if fields}
+        if not body:
+            continue
+        body["$setOnInsert"] = {"orgId": org_id, "hour": hour}
+        ops.append(UpdateOne({"_id": {"orgId": org_id, "hour": hour}}, body, upsert=True))
+    if ops:
+        await get_db()[ROLLUP_COLLECTION].bulk_write(ops, ordered=False)
+
+
+async def _recompute_extremes(targets: Dict[Tuple[Any, Any], Set[str]]) -> None:
+    """time_min / time_max of the given bucket features from the counted events, after some were taken out."""
+    seen = get_db()[ROLLUP_SEEN_COLLECTION]
+    buckets = get_db()[ROLLUP_COLLECTION]
+    for (org_id, hour), features in targets.items():
+        low: Dict[str, float] = {}
+        high: Dict[str, float] = {}
+        async for doc in seen.find({"orgId": org_id, "hour": hour}, {"times": 1}):
+            for item in doc.get("times") or ():
+                feature, seconds = item.get("k"), _seconds(item.get("v"))
+                if feature in features and seconds is not None:
+                    low[feature] = min(seconds, low.get(feature, seconds))
+                    high[feature] = max(seconds, high.get(feature, seconds))
+        update: Dict[str, Dict[str, Any]] = {"$set": {}, "$unset": {}}
+        for feature in features:
+            prefix = f"features.{feature}"
+            if feature in low:
+                update["$set"][f"{prefix}.time_min"] = low[feature]
+                update["$set"][f"{prefix}.time_max"] = high[feature]
+            else:
+                update["$unset"][f"{prefix}.time_min"] = ""
+                update["$unset"][f"{prefix}.time_max"] = ""
+        await buckets.update_one({"_id": {"orgId": org_id, "hour": hour}}, {op: f for op, f in update.items() if f})
+
+
+async def _sync(changes: List[Tuple[Any, Optional[Dict[str, Any]]]], position: Optional[List[Any]] = None,
+                resume_token: Any = None) -> int:
+    """
+    Brings the buckets in line with `changes`, (event _id, slim event or None when
+    deleted) in order: the counts of an event's previous version are taken out and
+    those of the new one added. Returns how many events were not counted before.
+    """
+    global _position, _resume_token, _events, _undated
+    if not changes:
+        return 0
+    seen = get_db()[ROLLUP_SEEN_COLLECTION]
+    ids = list({doc_id: None for doc_id, _ in changes})
+    current: Dict[Any, Optional[Dict[str, Any]]] = {doc_id: None for doc_id in ids}
+    for doc in await seen.find({"_id": {"$in": ids}}).to_list(length=len(ids)):
+        current[doc.pop("_id")] = doc
+
+    updates: Dict[Tuple[Any, Any], Dict[str, Dict[str, Any]]] = {}
+    extremes: Dict[Tuple[Any, Any], Set[str]] = {}
+    touched: Set[Any] = set()
+    added = removed = 0
+    for doc_id, event in changes:
+        old = current[doc_id]
+        new = _seen_doc(event) if event is not None else None
+        if old == new:
+            continue  # replayed, or an edit of fields the buckets do not count
+        if old is not None:
+            _merge_updates(updates, [old], -1)
+            for feature in _timed_features(old):
+                extremes.setdefault((old.get("orgId"), old.get("hour")), set()).add(feature)
+        if new is not None:
+            _merge_updates(updates, [new], 1)
+            _undated = _undated or new["hour"] is None
+        added += old is None and new is not None
+        removed += old is not None and new is None
+        current[doc_id] = new
+        touched.add(doc_id)
+
+    if touched:
+        # Taking counts out is not idempotent: a crash in between triggers a rebuild.
+        await _save_state(pending=True)
+        await seen.bulk_write([
+            ReplaceOne({"_id": doc_id}, current[doc_id], upsert=True) if current[doc_id] is not None
+            else DeleteOne({"_id": doc_id})
+            for doc_id in touched
+        ], ordered=False)
+        await _apply(updates)
+        if extremes:
+            await _recompute_extremes(extremes)
+        _events += added - removed
+    elif position is None and resume_token is None:
+        return 0
+    if position is not None:
+        _position = position
+    if resume_token is not None:
+        _resume_token = resume_token
+    await _save_state()
+    return added
+
+
+async def _tail() -> int:
+    """Adds every event after the tailing position."""
+    source = get_db()[_source]
+    added = 0
+    while True:
+        batch = await source.aggregate([
+            {"$match": tailing.position_filter(_position)},
+            {"$sort": dict(tailing.sort_spec())},
+            {"$limit": ROLLUP_BATCH_SIZE},
+            _SLIM_STAGE,
+        ]).to_list(length=ROLLUP_BATCH_SIZE)
+        if not batch:
+            return added
+        added += await _sync([(event["_id"], event) for event in batch], position=tailing.position_of(batch[-1]))
+
+
+async def _add_missing() -> int:
+    """
+    Adds the events the tail skipped, when fewer events are counted than the
+    source holds: the tail misses inserts below its position whenever
+    TAIL_FIELD does not follow insertion order.
+    """
+    source = get_db()[_source]
+    if await source.estimated_document_count() <= _events:
+        return 0
+    seen = get_db()[ROLLUP_SEEN_COLLECTION]
+    added = 0
+    async for ids in tailing.iter_id_batches(source, ROLLUP_BATCH_SIZE):
+        counted = {doc["_id"] for doc in await seen.find({"_id": {"$in": ids}}, {"_id": 1}).to_list(length=len(ids))}
+        missing = [doc_id for doc_id in ids if doc_id not in counted]
+        if not missing:
+            continue
+        batch = await source.aggregate([{"$match": {"_id": {"$in": missing}}}, _SLIM_STAGE]).to_list(length=len(missing))
+        added += await _sync([(event["_id"], event) for event in batch])
+    if added:
+        logger.info(f"Rollups for '{_source}' picked up {added} events the tail skipped")
+    return added
+
+
+async def rebuild() -> None:
+    """Drops every bucket and rolls the whole source collection up again."""
+    global _position, _events, _undated, _stale, _ready
+    async with _lock:
+        _ready = False
+        _position, _events, _undated, _stale = None, 0, False, False
+        await get_db()[ROLLUP_COLLECTION].delete_many({})
+        await get_db()[ROLLUP_SEEN_COLLECTION].delete_many({})
+        await _save_state()
+        added = await _tail()
+        added += await _add_missing()
+        _ready = True
+    logger.info(f"Rebuilt rollups for '{_source}' from {added} events")
+
+
+def schedule_rebuild() -> bool:
+    """Starts rebuild() in the background; False when rollups are not running."""
+    if _task is None:
+        return False
+    asyncio.create_task(rebuild())
+    return True
+
+
+async def _load_state() -> None:
+    global _position, _resume_token, _events, _undated
+    state = await get_db()[ROLLUP_STATE_COLLECTION].find_one({"_id": _source})
+    if state is None or state.get("version") != _STATE_VERSION or state.get("pending"):
+        if state is not None:
+            logger.warning("Rollups were interrupted mid-batch or are out of date; rebuilding")
+        await rebuild()
+        return
+    _position = state.get("position")
+    _resume_token = state.get("resume_token")
+    _events = state.get("events", 0)
+    _undated = state.get("undated", False)
+
+
+async def _follow_change_stream() -> None:
+    global _ready
+    kwargs: Dict[str, Any] = {"full_document": "updateLookup", "max_await_time_ms": 1000}
+    if _resume_token is not None:
+        kwargs["resume_after"] = _resume_token
+    async with get_db()[_source].watch(**kwargs) as stream:
+        # Catch up on inserts first; the stream then replays changes the catch-up
+        # already saw, which leave the counted events as they are.
+        if _stale:
+            await rebuild()
+        else:
+            async with _lock:
+                await _tail()
+                await _add_missing()
+                _ready = True
+        batch: List[Tuple[Any, Optional[Dict[str, Any]]]] = []
+        saved_at = time.monotonic()
+        while stream.alive:
+            change = await stream.try_next()
+            if change is not None:
+                op = change.get("operationType")
+                if op in ("insert", "update", "replace") and change.get("fullDocument"):
+                    batch.append((change["documentKey"]["_id"], _slim(change["fullDocument"])))
+                elif op == "delete":
+                    batch.append((change["documentKey"]["_id"], None))
+                elif op in ("drop", "rename", "invalidate"):
+                    logger.warning(f"Rollup source '{_source}' was {op}ped; stopping updates")
+                    return
+            if batch and (change is None or len(batch) >= ROLLUP_BATCH_SIZE):
+                async with _lock:
+                    await _sync(batch, resume_token=stream.resume_token)
+                batch, saved_at = [], time.monotonic()
+            elif change is None and time.monotonic() - saved_at >= ROLLUP_REFRESH_SECONDS:
+                async with _lock:
+                    await _save_state()
+                saved_at = time.monotonic()
+
+
+async def _refresh_forever() -> None:
+    global _ready, _resume_token, _stale
+    try:
+        await _load_state()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"Could not load rollup state: {e}")
+    if ROLLUP_SYNC == "change_stream":
+        for attempt in range(2):
+            try:
+                await _follow_change_stream()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == 0 and _resume_token is not None:
+                    # The token may have fallen off the oplog; edits since then are unknown.
+                    logger.info(f"Rollup resume token rejected ({e}); rebuilding and reopening change stream")
+                    _resume_token, _stale = None, True
+                    continue
+                logger.warning(f"Change stream unavailable ({e}); rollups fall back to tailing")
+                break
+    while True:
+        try:
+            if _stale:
+                await rebuild()
+                continue
+            async with _lock:
+                added = await _tail()
+                added += await _add_missing()
+                _ready = True
+            if added:
+                logger.info(f"Rollups for '{_source}' added {added} events")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Rollup refresh failed: {e}")
+        await asyncio.sleep(ROLLUP_REFRESH_SECONDS)
+
+
+def start(collection: str) -> None:
+    global _source, _lock, _task
+    if not ROLLUPS_ENABLED or _task is not None:
+        return
+    _source = collection
+    _lock = asyncio.Lock()
+    _task = asyncio.create_task(_refresh_forever())
+
+
+async def stop() -> None:
+    global _task, _ready
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    _ready = False
+
+
+def status() -> Dict[str, Any]:
+    return {
+        "enabled": ROLLUPS_ENABLED,
+        "sync": ROLLUP_SYNC,
+        "source": _source,
+        "ready": _ready,
+        "events": _events,
+        "position": _position,
+        "undated_events": _undated,
+    }
+
+
+# --- Query rewriting -------------------------------------------------------------
+
+def _stage_name(stage: Any) -> Optional[str]:
+    return next(iter(stage)) if isinstance(stage, dict) and len(stage) == 1 else None
+
+
+def _hour_aligned(value: Any) -> bool:
+    return isinstance(value, datetime) and value.minute == value.second == value.microsecond == 0
+
+
+def _conditions(match: Dict[str, Any]) -> Optional[List[Tuple[str, Any]]]:
+    out: List[Tuple[str, Any]] = []
+    for key, value in match.items():
+        if key == "$and" and isinstance(value, list) and all(isinstance(v, dict) for v in value):
+            for sub in value:
+                nested = _conditions(sub)
+                if nested is None:
+                    return None
+                out.extend(nested)
+        elif key.startswith("$"):
+            return None
+        else:
+            out.append((key, value))
+    return out
+
+
+def _equality(value: Any) -> Any:
+    """The value of `field: v` or `field: {$eq: v}`, else _UNSUPPORTED."""
+    if isinstance(value, dict):
+        return value["$eq"] if list(value) == ["$eq"] else _UNSUPPORTED
+    return value
+
+
+def _translate_match(match: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    {"match": filter on buckets, "count": bucket field counting matching events,
+     "times": whether processing-time stats still describe the matching events},
+    or None when the filter cannot be answered from buckets.
+    """
+    conditions = _conditions(match)
+    if conditions is None:
+        return None
+    bucket_match: Dict[str, Any] = {}
+    hour_range: Dict[str, Any] = {}
+    count = "$events"
+    narrowed = False
+
+    for field, value in conditions:
+        if field == "orgId":
+            if "orgId" in bucket_match:
+                return None
+            if isinstance(value, dict):
+                if not value or not set(value) <= {"$eq", "$ne", "$in", "$nin"}:
+                    return None
+                for op, operand in value.items():
+                    values = operand if op in ("$in", "$nin") else [operand]
+                    if not isinstance(values, list) or any(isinstance(v, (dict, list)) for v in values):
+                        return None
+            elif isinstance(value, list):
+                return None
+            bucket_match["orgId"] = value
+        elif field == "eventStartTime":
+            if not isinstance(value, dict) or not value or not set(value) <= {"$gte", "$lt"}:
+                return None
+            for op, bound in value.items():
+                if op in hour_range or not _hour_aligned(bound):
+                    return None
+                hour_range[op] = bound
+        elif field == "safe" or _FEATURE_FLAG.match(field):
+            flag = _equality(value)
+            if narrowed or not isinstance(flag, bool):
+                return None
+            narrowed = True
+            if field == "safe":
+                count = f"$safe.{'true' if flag else 'false'}"
+            else:
+                feature = next(g for g in _FEATURE_FLAG.match(field).groups() if g)
+                count = f"$features.{feature}.{'true' if flag else 'false'}"
+        else:
+            return None
+
+    if hour_range:
+        bucket_match["hour"] = hour_range
+    return {"match": bucket_match, "count": count, "times": not narrowed}
+
+
+def _translate_key(key: Any) -> Any:
+    """The group key over buckets, or _UNSUPPORTED when buckets cannot provide it."""
+    if key is None or isinstance(key, (bool, int, float)) or (isinstance(key, str) and not key.startswith("$")):
+        return key
+    if key == "$orgId":
+        return "$orgId"
+    if isinstance(key, dict):
+        name = _stage_name(key)
+        if name in _DATE_PARTS and key[name] == "$eventStartTime":
+            return {name: "$hour"}
+        if name == "$dateToString":
+            spec = key[name]
+            if (isinstance(spec, dict) and set(spec) <= {"format", "date"} and spec.get("date") == "$eventStartTime"
+                    and isinstance(spec.get("format"), str) and not _HOUR_FORMAT.search(spec["format"])):
+                return {name: {**spec, "date": "$hour"}}
+            return _UNSUPPORTED
+        if name == "$dateTrunc":
+            spec = key[name]
+            if (isinstance(spec, dict) and set(spec) <= {"date", "unit", "startOfWeek"}
+                    and spec.get("date") == "$eventStartTime" and spec.get("unit") in _TRUNC_UNITS):
+                return {name: {**spec, "date": "$hour"}}
+            return _UNSUPPORTED
+        if name is not None:
+            return _UNSUPPORTED
+        out = {}
+        for field, value in key.items():
+            translated = _translate_key(value)
+            if translated is _UNSUPPORTED:
+                return _UNSUPPORTED
+            out[field] = translated
+        return out
+    return _UNSUPPORTED
+
+
+def _time_feature(expr: Any) -> Optional[str]:
+    """
+    Feature of a {$toDouble: "$eventLog.<F>...MediaProcessingTimeInSeconds"} expression,
+    or of "$features.<F>.seconds" (already a double, with or without $toDouble).
+    """
+    if _stage_name(expr) == "$toDouble":
+        expr = expr["$toDouble"]
+    elif not (isinstance(expr, str) and expr.startswith("$features.")):
+        return None
+    match = _TIME_FIELD.match(expr) if isinstance(expr, str) else None
+    return next(g for g in match.groups() if g) if match else None
+
+
+def _translate_group(group: Dict[str, Any], where: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    key = _translate_key(group.get("_id"))
+    if key is _UNSUPPORTED:
+        return None
+    accumulators: Dict[str, Any] = {"_id": key, _ROWS: {"$sum": where["count"]}}
+    output: Dict[str, Any] = {"_id": 1}
+    for name, acc in group.items():
+        if name == "_id":
+            continue
+        op = _stage_name(acc)
+        arg = acc[op] if op else None
+        if (op == "$sum" and arg == 1) or (op == "$count" and arg == {}):
+            accumulators[name] = {"$sum": where["count"]}
+            output[name] = 1
+            continue
+        feature = _time_feature(arg) if op in ("$sum", "$avg", "$min", "$max") else None
+        if feature is None or not where["times"]:
+            return None
+        prefix = f"$features.{feature}"
+        if op == "$avg":
+            total, count = f"{_ROWS}_{name}_sum", f"{_ROWS}_{name}_count"
+            accumulators[total] = {"$sum": f"{prefix}.time_sum"}
+            accumulators[count] = {"$sum": f"{prefix}.time_count"}
+            output[name] = {"$cond": [{"$gt": [f"${count}", 0]}, {"$divide": [f"${total}", f"${count}"]}, None]}
+        else:
+            field = {"$sum": "time_sum", "$min": "time_min", "$max": "time_max"}[op]
+            accumulators[name] = {op: f"{prefix}.{field}"}
+            output[name] = 1
+    # Raw $group only emits groups with at least one matching event.
+    return [{"$group": accumulators}, {"$match": {_ROWS: {"$gt": 0}}}, {"$project": output}]
+
+
+def _uses_hour(value: Any) -> bool:
+    if isinstance(value, dict):
+        return any(key == "hour" or _uses_hour(item) for key, item in value.items())
+    if isinstance(value, list):
+        return any(_uses_hour(item) for item in value)
+    return value == "$hour"
+
+
+def rewrite(collection: str, pipeline: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+    """
+    An equivalent pipeline over ROLLUP_COLLECTION, or None when `pipeline` (dates
+    already converted) is not eligible or the rollups are not caught up.
+    """
+    if not ROLLUPS_ENABLED or not _ready or collection != _source or not pipeline:
+        return None
+    try:
+        stages = list(pipeline)
+        match: Dict[str, Any] = {}
+        if _stage_name(stages[0]) == "$match":
+            match = stages.pop(0)["$match"]
+        if not stages or not isinstance(match, dict):
+            return None
+        where = _translate_match(match)
+        if where is None:
+            return None
+
+        head, rest = stages[0], stages[1:]
+        name = _stage_name(head)
+        if name == "$count" and isinstance(head["$count"], str):
+            field = head["$count"]
+            body = [
+                {"$group": {"_id": None, field: {"$sum": where["count"]}}},
+                {"$match": {field: {"$gt": 0}}},  # $count emits nothing for zero matches
+                {"$project": {"_id": 0, field: 1}},
+            ]
+        elif name == "$group" and isinstance(head["$group"], dict):
+            body = _translate_group(head["$group"], where)
+            if body is None:
+                return None
+        else:
+            return None
+        prefix = [{"$match": where["match"]}] if where["match"] else []
+        if _undated and _uses_hour(prefix + body):
+            # Events without a usable date sit in hour=null buckets.
+            return None
+        return prefix + body + rest
+    except Exception as e:
+        logger.debug(f"Rollup rewrite skipped: {e}")
+        return None
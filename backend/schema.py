@@ -1,14 +1,12 @@
+from typing import Optional
 
-from typing import Dict, Any
+import predictions
 
-def get_collection_schema() -> str:
-    """
-    Returns a string representation of the MongoDB collection schema
-    to be used in the LLM prompt.
-    """
-    return """
+_INTRO = """
 The collection contains documents representing media moderation events.
-Each document has the following structure (showing key fields):
+"""
+
+RAW_STRUCTURE = """Each document has the following structure (showing key fields):
 
 {
   "_id": "String (Unique Event ID, e.g., V1333...)",
@@ -64,10 +62,121 @@ Each document has the following structure (showing key fields):
   "complete": "Boolean",
   "moderationCode": "String"
 }
+"""
 
+RAW_NOTES = """
 Important Notes:
 1. `eventLog` contains details for each feature (Nudity, Minor, Scamster, ImageSearch).
 2. `eventLog.<Feature>.report.documentReport.report.Predictions` is often a JSON string.
 3. **CRITICAL**: For processing time or duration queries, ALWAYS use `eventLog.<Feature>.report.documentReport.report.MediaProcessingTimeInSeconds`. Do NOT try to calculate it from `processingStartTime` and `processingEndTime` because the date format is non-standard and will cause errors. You will need to convert the string to a double (e.g., `{{ "$toDouble": "$eventLog.Minor.report.documentReport.report.MediaProcessingTimeInSeconds" }}`).
 4. Timestamps are strings in a custom ISO-like format (e.g. `2025-06-10T00:01:15:005433`).
 """
+
+NORMALIZED_STRUCTURE = """Each document has the following structure (showing key fields):
+
+{
+  "_id": "String (Unique Event ID, e.g., V1333...)",
+  "userId": "String",
+  "orgId": "String",
+  "requestType": "String (e.g., 'URL')",
+  "eventStartTime": "Date",
+  "eventEndTime": "Date",
+  "processExitStatus": "Boolean",
+  "features": {
+    "Nudity": {
+      "flag": "Boolean (same as processStatus.featureStatus.Nudity)",
+      "seconds": "Double (media processing time in seconds)",
+      "operations": "Integer (same as operationsPerFeature.Nudity)",
+      "startedAt": "Date (processing start)",
+      "endedAt": "Date (processing end)",
+      "durationSeconds": "Double (endedAt - startedAt in seconds)",
+      "scores": {
+        "na/selfie": "Double (model probability for this label, parsed from Predictions)",
+        "<label>": "Double"
+      },
+      "topLabel": "String (label with the highest score)",
+      "topScore": "Double (highest score)"
+    },
+    "Minor": { ... },
+    "Scamster": { ... },
+    "ImageSearch": { ... }
+  },
+  "operationsPerFeature": {
+    "Minor": "Integer",
+    "Scamster": "Integer",
+    "Nudity": "Integer",
+    "ImageSearch": "Integer"
+  },
+  "eventLog": {
+    "Nudity": {
+      "processingStartTime": "Date",
+      "processingEndTime": "Date",
+      "report": {
+        "documentReport": {
+          "report": {
+            "Model": "String",
+            "Predictions": "String (JSON string of probabilities, e.g. \"{'na/selfie': 0.58...}\")",
+            "StatusCode": "String",
+            "MediaProcessingTimeInSeconds": "Double"
+          }
+        }
+      }
+    },
+    "Minor": { ... },
+    "Scamster": { ... },
+    "ImageSearch": { ... }
+  },
+  "processStatus": {
+    "completedProcesses": "Integer",
+    "complete": "Boolean",
+    "featureStatus": {
+      "Minor": "Boolean",
+      "Scamster": "Boolean",
+      "Nudity": "Boolean",
+      "ImageSearch": "Boolean"
+    }
+  },
+  "media": {
+    "inputMediaURL": "String",
+    "type": "String (e.g., 'IMAGE')"
+  },
+  "safe": "Boolean",
+  "complete": "Boolean",
+  "moderationCode": "String"
+}
+"""
+
+NORMALIZED_NOTES = """
+Important Notes:
+1. `features.<Feature>` (Nudity, Minor, Scamster, ImageSearch) holds each feature's flag, processing time and timestamps with proper types. Prefer it over `eventLog`.
+2. For processing time or duration queries, use `features.<Feature>.seconds` directly (e.g. `{ "$avg": "$features.Minor.seconds" }`). It is already a number: no `$toDouble` needed.
+3. All timestamps are real dates: compare them with ISO 8601 strings (e.g. `{ "eventStartTime": { "$gte": "2025-06-10T00:00:00" } }`) and use date operators such as `$dateToString` or `$hour` on them directly.
+4. For model scores / probabilities, filter and aggregate on `features.<Feature>.scores.<label>`, never on the `Predictions` string. Dots in labels are replaced by underscores.
+   - Example: "nudity selfie probability above 0.5" -> `{ "features.Nudity.scores.na/selfie": { "$gt": 0.5 } }`
+"""
+
+
+def get_collection_schema(normalized: bool = False, profile: Optional[str] = None) -> str:
+    """
+    Returns a string representation of the MongoDB collection schema
+    to be used in the LLM prompt. `normalized` describes the shadow collection
+    maintained by normalizer.py instead of the raw events. `profile` (from
+    schema_profiler) replaces the hand-written field list with sampled statistics;
+    the notes on how to query the fields are kept either way.
+    """
+    notes = NORMALIZED_NOTES if normalized else RAW_NOTES
+    if profile is not None:
+        return f"{_INTRO}{profile}\n{notes}"
+    return _INTRO + (NORMALIZED_STRUCTURE if normalized else RAW_STRUCTURE) + notes
+
+
+def prediction_labels() -> str:
+    """
+    The prediction labels seen so far (predictions.top_labels()), for the normalized
+    prompt. Kept apart from get_collection_schema() as they change on every refresh.
+    """
+    labels = predictions.top_labels()
+    if not labels:
+        return ""
+    known = "\n".join(f"   - {feature}: {', '.join(names)}" for feature, names in sorted(labels.items()))
+    return f"Prediction labels seen in `features.<Feature>.scores`:\n{known}\n"
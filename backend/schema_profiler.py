@@ -0,0 +1,403 @@
+"""
+Schema description of the knowledge collection built from sampled documents.
+
+profile() walks a $sample of SCHEMA_PROFILE_SAMPLE_SIZE documents and records,
+per field path, the BSON types seen, how often the field is present, distinct
+values and min/max of numbers, dates and numbers or timestamps stored as text.
+Sibling objects with (nearly) the same fields, such as eventLog.Nudity and
+eventLog.Minor, are folded into one `<key>` entry that lists the keys, and so
+are objects with more than SCHEMA_PROFILE_MAX_KEYS keys. The result is one
+compact line per field, e.g.
+
+    moderationCode: string, one of "FLAGGED", "OK", "REVIEW"
+    eventLog.<key>.report.documentReport.report.MediaProcessingTimeInSeconds: string (number as text), 0.05 .. 3
+
+describe() caches it per collection for SCHEMA_PROFILE_TTL_SECONDS; a stale
+entry keeps being served while a single background task refreshes it. Next to
+the text it returns a signature of the field paths and types only, so that
+statistics drifting between refreshes don't invalidate cached pipelines.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from utils import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_PROFILE_ENABLED = os.getenv("SCHEMA_PROFILE_ENABLED", "true").lower() == "true"
+SCHEMA_PROFILE_SAMPLE_SIZE = int(os.getenv("SCHEMA_PROFILE_SAMPLE_SIZE", "1000"))
+SCHEMA_PROFILE_TTL_SECONDS = float(os.getenv("SCHEMA_PROFILE_TTL_SECONDS", "3600"))
+SCHEMA_PROFILE_TIMEOUT_MS = int(os.getenv("SCHEMA_PROFILE_TIMEOUT_MS", "5000"))
+# Fields with at most this many distinct values have them listed.
+SCHEMA_PROFILE_MAX_VALUES = int(os.getenv("SCHEMA_PROFILE_MAX_VALUES", "8"))
+# Objects with more keys than this are described once as <key>.
+SCHEMA_PROFILE_MAX_KEYS = int(os.getenv("SCHEMA_PROFILE_MAX_KEYS", "12"))
+SCHEMA_PROFILE_MAX_FIELDS = int(os.getenv("SCHEMA_PROFILE_MAX_FIELDS", "120"))
+# The profile is sent to the LLM provider: sampled free-text values (ids, URLs, ...) are only
+# quoted as examples when enabled, and never for fields that are unique per document.
+SCHEMA_PROFILE_EXAMPLES = os.getenv("SCHEMA_PROFILE_EXAMPLES", "false").lower() == "true"
+
+# Siblings are folded when their field sets overlap at least this much (Jaccard).
+_FOLD_SIMILARITY = 0.6
+# ... and objects of at least this many values that all look alike.
+_FOLD_MIN_VALUES = 3
+_EXAMPLE_CHARS = 40
+# After a failed sample, the hand-written schema is used this long before trying again.
+_RETRY_SECONDS = 60
+
+# collection -> (profiled at, description, signature)
+_profiles: Dict[str, Tuple[float, str, str]] = {}
+_refreshing: Dict[str, asyncio.Task] = {}
+_failed_at: Dict[str, float] = {}
+
+
+def _kind(value: Any) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "double"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, datetime):
+        return "date"
+    if isinstance(value, dict):
+        return "object"
+    if isinstance(value, (list, tuple)):
+        return "array"
+    if isinstance(value, ObjectId):
+        return "objectId"
+    return type(value).__name__
+
+
+class _Field:
+    """Statistics of one field path."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.types: Counter = Counter()
+        self.values: set = set()
+        self.text_kinds: Counter = Counter()  # "number" / "timestamp" / "json" strings
+        self.ranges: Dict[str, List[Any]] = {}  # "number" / "date" -> [low, high]
+        self.children: Dict[str, "_Field"] = {}
+        self.items: Optional["_Field"] = None
+        self.keys: List[str] = []  # original keys folded into this field
+
+    def _extend(self, kind: str, value: Any) -> None:
+        bounds = self.ranges.get(kind)
+        if bounds is None:
+            self.ranges[kind] = [value, value]
+            return
+        try:
+            bounds[0] = min(bounds[0], value)
+            bounds[1] = max(bounds[1], value)
+        except TypeError:  # naive vs. aware datetimes
+            pass
+
+    def observe(self, value: Any) -> None:
+        self.count += 1
+        kind = _kind(value)
+        self.types[kind] += 1
+        if kind == "object":
+            for key, child in value.items():
+                self.children.setdefault(str(key), _Field()).observe(child)
+            return
+        if kind == "array":
+            if self.items is None:
+                self.items = _Field()
+            for item in value:
+                self.items.observe(item)
+            return
+        if kind in ("int", "double"):
+            if math.isfinite(value):
+                self._extend("number", value)
+        elif kind == "date":
+            self._extend("date", value)
+        elif kind == "string":
+            text = value.strip()
+            number = _number_text(text)
+            if number is not None:
+                self.text_kinds["number"] += 1
+                self._extend("number", number)
+            elif text.startswith("{") or text.startswith("["):
+                self.text_kinds["json"] += 1
+            else:
+                parsed = parse_timestamp(text) if text[:1].isdigit() else None
+                if parsed is not None:
+                    self.text_kinds["timestamp"] += 1
+                    self._extend("date", parsed)
+        if kind in ("string", "int", "double", "bool", "objectId"):
+            self.values.add(value)
+
+    def merge(self, other: "_Field") -> None:
+        self.count += other.count
+        self.types.update(other.types)
+        self.values |= other.values
+        self.text_kinds.update(other.text_kinds)
+        for kind, (low, high) in other.ranges.items():
+            self._extend(kind, low)
+            self._extend(kind, high)
+        for key, child in other.children.items():
+            if key in self.children:
+                self.children[key].merge(child)
+            else:
+                self.children[key] = child
+        if other.items is not None:
+            if self.items is None:
+                self.items = other.items
+            else:
+                self.items.merge(other.items)
+
+    def paths(self, prefix: str = "") -> set:
+        out = set()
+        for key, child in self.children.items():
+            path = f"{prefix}{key}"
+            out.add(path)
+            out |= child.paths(f"{path}.")
+        return out
+
+
+def _number_text(text: str) -> Optional[float]:
+    if not text or not (text[0].isdigit() or text[0] in "-+."):
+        return None
+    try:
+        number = float(text)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+
+def _fold(field: _Field, root: bool = False) -> None:
+    """
+    Folds look-alike sibling objects, and below the top level objects whose
+    values all look alike or that have very many keys, into `<key>` fields,
+    recursively.
+    """
+    children = field.children
+    if len(children) > SCHEMA_PROFILE_MAX_KEYS and not root:
+        folded = _Field()
+        for key, child in children.items():
+            folded.merge(child)
+            folded.keys.append(key)
+        field.children = {"<key>": folded}
+    else:
+        groups: List[List[str]] = []
+        signatures = {key: child.paths() for key, child in children.items() if child.children}
+        for key, paths in signatures.items():
+            for group in groups:
+                first = signatures[group[0]]
+                if len(paths & first) >= _FOLD_SIMILARITY * len(paths | first):
+                    group.append(key)
+                    break
+            else:
+                groups.append([key])
+        # A map of plain values, e.g. featureStatus or Predictions scores.
+        shapes = {
+            (frozenset(child.types), frozenset(child.text_kinds))
+            for child in children.values()
+            if not child.children and child.items is None
+        }
+        if not root and not signatures and len(shapes) == 1 and len(children) >= _FOLD_MIN_VALUES:
+            groups.append(list(children))
+        folded_children: Dict[str, _Field] = {}
+        placeholders = 0
+        for key, child in children.items():
+            group = next((g for g in groups if key in g), None)
+            if group is None or len(group) < 2:
+                folded_children[key] = child
+            elif key == group[0]:
+                placeholders += 1
+                merged = _Field()
+                for member in group:
+                    merged.merge(children[member])
+                    merged.keys.append(member)
+                folded_children["<key>" if placeholders == 1 else f"<key{placeholders}>"] = merged
+        field.children = folded_children
+    for child in field.children.values():
+        _fold(child)
+    if field.items is not None:
+        _fold(field.items)
+
+
+def _fmt_number(value: float) -> str:
+    if float(value).is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return f"{value:.3g}"
+
+
+def _fmt_dates(low: datetime, high: datetime) -> str:
+    try:
+        days = (high - low).days
+    except TypeError:
+        days = 0
+    fmt = "%Y-%m-%d" if days >= 2 else "%Y-%m-%dT%H:%M"
+    return f"{low.strftime(fmt)} .. {high.strftime(fmt)}"
+
+
+def _describe_leaf(field: _Field, parent_count: int) -> str:
+    kinds = [k for k, _ in field.types.most_common() if k not in ("object", "array")]
+    parts = []
+    desc = "|".join(kinds) or "object"
+    strings = field.types.get("string", 0)
+    text_kind, text_count = (field.text_kinds.most_common(1) or [(None, 0)])[0]
+    if strings and text_count == strings:
+        desc += {
+            "number": " (number as text)",
+            "timestamp": " (timestamp as text)",
+            "json": " (JSON/dict as text)",
+        }[text_kind]
+    parts.append(desc)
+
+    if parent_count and field.count < 0.95 * parent_count:
+        parts.append(f"present in ~{max(1, round(10 * field.count / parent_count)) * 10}%")
+
+    distinct = len(field.values)
+    listable = kinds != ["bool"] and distinct and distinct <= SCHEMA_PROFILE_MAX_VALUES and distinct < field.count
+    if listable:
+        shown = sorted(field.values, key=lambda v: (str(type(v)), v))
+        parts.append("one of " + ", ".join(f'"{v}"' if isinstance(v, str) else str(v) for v in shown))
+    elif "date" in field.ranges:
+        low, high = field.ranges["date"]
+        parts.append(_fmt_dates(low, high))
+        if text_kind == "timestamp" and strings:
+            example = next((v for v in field.values if isinstance(v, str)), None)
+            if example is not None:
+                parts.append(f'e.g. "{example}"')
+    elif "number" in field.ranges:
+        low, high = field.ranges["number"]
+        parts.append(f"{_fmt_number(low)} .. {_fmt_number(high)}")
+    elif strings and distinct:
+        unique = distinct >= 0.9 * field.count
+        parts.append("unique" if unique else f"{distinct} distinct")
+        example = min((v for v in field.values if isinstance(v, str)), default=None)
+        if SCHEMA_PROFILE_EXAMPLES and not unique and example is not None and text_kind != "json":
+            parts.append(f'e.g. "{example[:_EXAMPLE_CHARS]}"')
+    return ", ".join(parts)
+
+
+def _render(field: _Field, prefix: str, lines: List[str]) -> None:
+    for key, child in field.children.items():
+        path = f"{prefix}{key}"
+        keys = f"<key> is one of {', '.join(child.keys)}" if child.keys else None
+        leaf = any(kind not in ("object", "array") for kind in child.types)
+        if leaf:
+            line = f"{path}: {_describe_leaf(child, field.count)}"
+            lines.append(f"{line} ({keys})" if keys else line)
+        elif keys:
+            lines.append(f"{path}: {keys}")
+        if child.children:
+            _render(child, f"{path}.", lines)
+        if child.items is not None:
+            if child.items.children:
+                _render(child.items, f"{path}[].", lines)
+            elif child.items.count:
+                lines.append(f"{path}[]: array of {_describe_leaf(child.items, 0)}")
+
+
+def _signature(field: _Field, prefix: str = "") -> List[str]:
+    out = []
+    for key, child in sorted(field.children.items()):
+        path = f"{prefix}{key}"
+        out.append(f"{path}:{','.join(sorted(child.types))}:{','.join(sorted(child.keys))}")
+        out.extend(_signature(child, f"{path}."))
+        if child.items is not None:
+            out.extend(_signature(child.items, f"{path}[]."))
+    return out
+
+
+def profile(docs: List[Dict[str, Any]]) -> Tuple[str, str]:
+    """(description, structural signature) of a list of sampled documents."""
+    root = _Field()
+    for doc in docs:
+        root.observe(doc)
+    _fold(root, root=True)
+    lines: List[str] = []
+    _render(root, "", lines)
+    omitted = len(lines) - SCHEMA_PROFILE_MAX_FIELDS
+    if omitted > 0:
+        lines = lines[:SCHEMA_PROFILE_MAX_FIELDS] + [f"... {omitted} more fields"]
+    text = (
+        f"Fields sampled from {len(docs)} documents (path: type, values or min .. max):\n"
+        + "\n".join(lines) + "\n"
+    )
+    signature = hashlib.sha1("\n".join(_signature(root)).encode("utf-8")).hexdigest()[:16]
+    return text, signature
+
+
+async def _profile_collection(collection) -> Tuple[str, str]:
+    started = time.perf_counter()
+    docs = await collection.aggregate(
+        [{"$sample": {"size": SCHEMA_PROFILE_SAMPLE_SIZE}}], maxTimeMS=SCHEMA_PROFILE_TIMEOUT_MS
+    ).to_list(length=SCHEMA_PROFILE_SAMPLE_SIZE)
+    if not docs:
+        raise ValueError("collection is empty")
+    text, signature = await asyncio.to_thread(profile, docs)
+    _profiles[collection.name] = (time.monotonic(), text, signature)
+    logger.info(
+        f"Profiled '{collection.name}' from {len(docs)} documents in "
+        f"{(time.perf_counter() - started) * 1000:.0f} ms ({len(text)} chars)"
+    )
+    return text, signature
+
+
+async def _refresh(collection) -> None:
+    try:
+        await _profile_collection(collection)
+    except Exception as e:
+        _failed_at[collection.name] = time.monotonic()
+        logger.warning(f"Schema profile refresh for '{collection.name}' failed: {e}")
+    finally:
+        _refreshing.pop(collection.name, None)
+
+
+async def describe(collection) -> Optional[Tuple[str, str]]:
+    """
+    (description, signature) of a Motor collection, or None when profiling is
+    disabled or failed and the hand-written schema should be used.
+    """
+    if not SCHEMA_PROFILE_ENABLED:
+        return None
+    name = collection.name
+    cached = _profiles.get(name)
+    if cached is not None:
+        if time.monotonic() - cached[0] >= SCHEMA_PROFILE_TTL_SECONDS and name not in _refreshing:
+            _refreshing[name] = asyncio.create_task(_refresh(collection))
+        return cached[1], cached[2]
+
+    if time.monotonic() - _failed_at.get(name, -_RETRY_SECONDS) < _RETRY_SECONDS:
+        return None
+    # First use: concurrent callers wait for the same sample.
+    task = _refreshing.get(name)
+    if task is None:
+        task = _refreshing[name] = asyncio.create_task(_refresh(collection))
+    await asyncio.shield(task)
+    cached = _profiles.get(name)
+    return (cached[1], cached[2]) if cached is not None else None
+
+
+def invalidate(collection: Optional[str] = None) -> None:
+    """Drops the cached profile of `collection` (all when None); the next describe() samples again."""
+    if collection is None:
+        _profiles.clear()
+    else:
+        _profiles.pop(collection, None)
+
+
+def cached_profiles() -> Dict[str, Dict[str, Any]]:
+    now = time.monotonic()
+    return {
+        name: {"age_seconds": round(now - at, 1), "signature": signature, "description": text}
+        for name, (at, text, signature) in _profiles.items()
+    }
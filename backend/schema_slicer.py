@@ -0,0 +1,198 @@
+"""
+Per-question pruning of the sampled schema description (see schema_profiler).
+
+slice_schema() keeps only the field lines a question plausibly needs:
+
+  - SCHEMA_SLICE_ALWAYS_FIELDS (ids, org, time and safety flags by default);
+  - fields whose path words or listed values match a word of the question
+    (after light stemming and a few synonyms, e.g. "time" -> seconds/duration);
+  - maps whose keys are named, e.g. processStatus.featureStatus.<key> for
+    "nudity".
+
+Keys named in the question also narrow folded fields: for "average minor
+processing time", eventLog.<key>...MediaProcessingTimeInSeconds is sent as
+eventLog.Minor...MediaProcessingTimeInSeconds. A question that matches nothing
+gets the whole description, so vague questions lose nothing.
+
+The hand-written schema (used when profiling is off or failed) is not sliced.
+"""
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from database import content_tokens
+
+SCHEMA_SLICE_ENABLED = os.getenv("SCHEMA_SLICE_ENABLED", "true").lower() == "true"
+SCHEMA_SLICE_ALWAYS_FIELDS = {
+    f.strip() for f in os.getenv("SCHEMA_SLICE_ALWAYS_FIELDS", "_id,orgId,eventStartTime,safe").split(",") if f.strip()
+}
+
+# Words in nearly every question that would otherwise match half the schema.
+_GENERIC = {
+    "event", "events", "count", "counts", "number", "many", "much", "total", "show", "list", "give",
+    "get", "find", "all", "per", "each", "documents", "document", "records", "record", "data",
+    "average", "avg", "mean", "sum", "max", "maximum", "min", "minimum", "top", "most", "least",
+    "true", "false", "above", "below", "over", "under", "than", "more", "less", "between",
+}
+_SYNONYMS = {
+    "time": ("processing", "seconds", "duration"),
+    "duration": ("seconds",),
+    "latency": ("processing", "seconds", "duration"),
+    "slow": ("processing", "seconds", "duration"),
+    "fast": ("processing", "seconds", "duration"),
+    "probability": ("scores", "predictions"),
+    "probabilities": ("scores", "predictions"),
+    "confidence": ("scores", "predictions"),
+    "likely": ("scores", "predictions"),
+    "score": ("scores", "predictions"),
+    "unsafe": ("safe",),
+    "flagged": ("flag", "moderation"),
+    "organisation": ("org",),
+    "organization": ("org",),
+    "customer": ("org",),
+    "tenant": ("org",),
+    "video": ("media",),
+    "url": ("media",),
+}
+
+_PLACEHOLDER = re.compile(r"^<key\d*>$")
+_KEYS_SUFFIX = re.compile(r"^(?P<desc>.*?)\s*\(<key> is one of (?P<keys>[^()]*)\)$")
+_HEADER = re.compile(r"^<key> is one of (?P<keys>.*)$")
+_WORD = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+_VALUE = re.compile(r'"([^"]*)"')
+
+
+def _stem(word: str) -> str:
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def _words(text: str) -> List[str]:
+    return [w.lower() for w in _WORD.findall(text)]
+
+
+def question_terms(question: str) -> Set[str]:
+    """Stemmed question words, synonyms and joined neighbours ("image search" -> imagesearch)."""
+    tokens = content_tokens(question)
+    terms: Set[str] = set()
+    for i, token in enumerate(tokens):
+        if i + 1 < len(tokens):
+            terms.add(_stem(token + tokens[i + 1]))
+        if token in _GENERIC or len(token) < 3:
+            continue
+        terms.add(_stem(token))
+        terms.update(_stem(s) for s in _SYNONYMS.get(token, ()))
+    return terms
+
+
+def _matches(words: Iterable[str], terms: Set[str]) -> bool:
+    for word in words:
+        stem = _stem(word)
+        if stem in terms:
+            return True
+        # Three-letter abbreviations in field names: org -> organisation.
+        if len(word) == 3 and any(term.startswith(word) for term in terms):
+            return True
+    return False
+
+
+def _whole(value: str) -> str:
+    return _stem(re.sub(r"[^a-z0-9]", "", value.lower()))
+
+
+def _named_keys(keys: List[str], terms: Set[str], key_terms: Set[str]) -> List[str]:
+    """
+    Keys the question names, as a whole ("nudity") or by one of their words
+    ("selfie" for na/selfie). Words that name a whole key elsewhere don't count
+    as parts, so "nudity" does not select nudity/positive.
+    """
+    part_terms = terms - key_terms
+    return [
+        key for key in keys
+        if _whole(key) in terms or _matches(re.findall(r"[a-z0-9]+", key.lower()), part_terms)
+    ]
+
+
+def _parse(description: str) -> Tuple[List[str], Dict[str, List[str]], List[Tuple[str, str, Optional[List[str]]]]]:
+    """(preamble lines, placeholder prefix -> keys, [(path, desc, own keys)])."""
+    preamble: List[str] = []
+    keys: Dict[str, List[str]] = {}
+    fields: List[Tuple[str, str, Optional[List[str]]]] = []
+    for line in description.splitlines():
+        path, sep, desc = line.partition(": ")
+        if not sep or " " in path:
+            if not fields:
+                preamble.append(line)
+            continue
+        header = _HEADER.match(desc)
+        if header and _PLACEHOLDER.match(path.rsplit(".", 1)[-1]):
+            keys[path] = [k.strip() for k in header.group("keys").split(",")]
+            continue
+        own = None
+        suffix = _KEYS_SUFFIX.match(desc)
+        if suffix:
+            desc = suffix.group("desc")
+            own = [k.strip() for k in suffix.group("keys").split(",")]
+            keys[path] = own
+        fields.append((path, desc, own))
+    return preamble, keys, fields
+
+
+def slice_schema(description: str, question: str) -> str:
+    """The lines of a schema_profiler description relevant to `question`."""
+    if not SCHEMA_SLICE_ENABLED:
+        return description
+    terms = question_terms(question)
+    preamble, keys, fields = _parse(description)
+    if not terms or not fields:
+        return description
+    key_terms = {_whole(k) for values in keys.values() for k in values} & terms
+    named = {prefix: _named_keys(values, terms, key_terms) for prefix, values in keys.items()}
+
+    kept: List[Tuple[str, str, Optional[List[str]]]] = []
+    matched = False
+    for path, desc, own in fields:
+        segments = path.split(".")
+        concrete = [w for s in segments if not _PLACEHOLDER.match(s) for w in _words(s)]
+        values = {_whole(v) for v in _VALUE.findall(desc)} if "one of" in desc else set()
+        parent = path.rsplit(".", 1)[0]
+        relevant = (
+            _matches(concrete, terms)
+            # Field names typed as one word, e.g. "eventEndTime".
+            or any(_whole(s) in terms for s in segments if not _PLACEHOLDER.match(s))
+            or bool(values & terms)
+            or bool(own and named.get(path))
+            # Flags of a named key, e.g. features.<key>.flag for "nudity".
+            or (desc.startswith("bool") and bool(named.get(parent)))
+        )
+        matched = matched or relevant
+        if relevant or path in SCHEMA_SLICE_ALWAYS_FIELDS:
+            kept.append((path, desc, own))
+    if not matched:
+        return description
+
+    lines = list(preamble)
+    headers_done: Set[str] = set()
+    for path, desc, own in kept:
+        segments = path.split(".")
+        rendered: List[str] = []
+        for i, segment in enumerate(segments):
+            prefix = ".".join(segments[: i + 1])
+            choice = named.get(prefix) if _PLACEHOLDER.match(segment) else None
+            if choice and len(choice) == 1:
+                rendered.append(choice[0])
+                continue
+            rendered.append(segment)
+            if choice is not None and prefix != path and prefix not in headers_done:
+                # Header for a folded prefix, narrowed to the keys the question names.
+                headers_done.add(prefix)
+                shown = choice or keys.get(prefix, [])
+                lines.append(f"{'.'.join(rendered)}: <key> is one of {', '.join(shown)}")
+        line = f"{'.'.join(rendered)}: {desc}"
+        if own and not (named.get(path) and len(named[path]) == 1):
+            line += f" (<key> is one of {', '.join(named.get(path) or own)})"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,63 @@
+"""
+Single-pass JSON encoding for MongoDB documents.
+
+Documents are encoded straight from BSON types. A `default` hook handles
+ObjectId, Decimal128, Decimal and bytes while the encoder walks the structure;
+there is no intermediate copy of the document. orjson is used when it is
+installed (it encodes datetime/date/time natively). Otherwise the stdlib
+encoder, with the same hook, is the fallback.
+"""
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Any
+
+from bson import Decimal128, ObjectId
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return str(value)
+
+
+def _stdlib_dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, default=_default, separators=(",", ":"))
+
+
+def dumps(value: Any) -> str:
+    """Compact JSON text for `value`; unknown types are encoded with str()."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=_default, option=_ORJSON_OPTIONS).decode("utf-8")
+        except TypeError:
+            pass  # e.g. integers beyond 64 bits; the stdlib encoder handles those
+    return _stdlib_dumps(value)
+
+
+def to_jsonable(value: Any) -> Any:
+    """
+    Plain dict/list/str/number structure equivalent to `value`. An encode and
+    decode round trip in C is much cheaper than rebuilding documents in Python.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(orjson.dumps(value, default=_default, option=_ORJSON_OPTIONS))
+        except TypeError:
+            pass
+    return json.loads(_stdlib_dumps(value))
@@ -0,0 +1,58 @@
+"""
+Incremental reads of the knowledge collection for the derived copies (text
+index, rollups, normalized copy) when they do not follow a change stream.
+
+Tailing walks the source in TAIL_FIELD order and resumes after the last
+document read. That only sees every insert when TAIL_FIELD grows with
+insertion order: an ObjectId _id, or an ingest timestamp / sequence number set
+by the writer. Event ids such as "V1333_0_EVT_3615" do not, so the copies
+default to change streams and, when tailing, compare their document count with
+the source's and look for the skipped documents (iter_id_batches) when it is
+short.
+"""
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+# Field that increases with insertion order; ties are broken by _id.
+TAIL_FIELD = os.getenv("TAIL_FIELD", "_id")
+
+
+def _get(doc: Dict[str, Any], path: str) -> Any:
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def position_of(doc: Dict[str, Any]) -> List[Any]:
+    """Where tailing resumes after `doc`."""
+    if TAIL_FIELD == "_id":
+        return [doc["_id"]]
+    return [_get(doc, TAIL_FIELD), doc["_id"]]
+
+
+def position_filter(position: Optional[List[Any]]) -> Dict[str, Any]:
+    """Filter for the documents after `position` (None: all of them)."""
+    if position is None:
+        return {}
+    if TAIL_FIELD == "_id":
+        return {"_id": {"$gt": position[0]}}
+    value, doc_id = position
+    return {"$or": [{TAIL_FIELD: {"$gt": value}}, {TAIL_FIELD: value, "_id": {"$gt": doc_id}}]}
+
+
+def sort_spec() -> List[Tuple[str, int]]:
+    return [("_id", 1)] if TAIL_FIELD == "_id" else [(TAIL_FIELD, 1), ("_id", 1)]
+
+
+async def iter_id_batches(collection, batch_size: int) -> AsyncIterator[List[Any]]:
+    """Every _id of `collection` in ascending batches, read from the _id index only."""
+    last = None
+    while True:
+        query = {"_id": {"$gt": last}} if last is not None else {}
+        docs = await collection.find(query, {"_id": 1}).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+        if not docs:
+            return
+        yield [doc["_id"] for doc in docs]
+        last = docs[-1]["_id"]
@@ -1,31 +1,154 @@
-from typing import Dict, List
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
 from models import Message, Chat
 from uuid import uuid4
 from datetime import datetime
 
-temp_chats: Dict[str, Chat] = {}
-temp_messages: Dict[str, List[Message]] = {}
+logger = logging.getLogger(__name__)
 
-def new_temp_chat() -> str:
+# Budgets for abandoned/long-lived temporary sessions. When either limit is hit,
+# the least recently used sessions are evicted first.
+TEMP_CHAT_MAX_ENTRIES = int(os.getenv("TEMP_CHAT_MAX_ENTRIES", "1000"))
+TEMP_CHAT_MAX_BYTES = int(os.getenv("TEMP_CHAT_MAX_BYTES", str(64 * 1024 * 1024)))
+TEMP_CHAT_IDLE_TTL_SECONDS = float(os.getenv("TEMP_CHAT_IDLE_TTL_SECONDS", "3600"))
+TEMP_CHAT_SWEEP_INTERVAL_SECONDS = float(os.getenv("TEMP_CHAT_SWEEP_INTERVAL_SECONDS", "60"))
+
+# Rough per-object overhead so empty chats and short messages still count.
+_CHAT_OVERHEAD_BYTES = 512
+_MESSAGE_OVERHEAD_BYTES = 256
+
+# chat_id -> {"chat": Chat, "messages": [Message], "bytes": int, "last_access": float}
+_sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_bytes_held = 0
+_evicted = {"idle": 0, "capacity": 0}
+_sweeper: Optional[asyncio.Task] = None
+
+
+def _message_bytes(message: Message) -> int:
+    return _MESSAGE_OVERHEAD_BYTES + len(message.content.encode("utf-8"))
+
+
+def _touch(chat_id: str) -> Optional[Dict[str, Any]]:
+    session = _sessions.get(chat_id)
+    if session is not None:
+        session["last_access"] = time.monotonic()
+        _sessions.move_to_end(chat_id)
+    return session
+
+
+def _drop(chat_id: str) -> None:
+    global _bytes_held
+    session = _sessions.pop(chat_id, None)
+    if session is not None:
+        _bytes_held -= session["bytes"]
+
+
+def _enforce_budget(keep: Optional[str] = None) -> None:
+    while _sessions and (len(_sessions) > TEMP_CHAT_MAX_ENTRIES or _bytes_held > TEMP_CHAT_MAX_BYTES):
+        oldest = next(iter(_sessions))
+        if oldest == keep:
+            # Only the active session is left; never evict the one being written to.
+            if len(_sessions) == 1:
+                return
+            _sessions.move_to_end(oldest)
+            continue
+        _drop(oldest)
+        _evicted["capacity"] += 1
+
+
+def new_temp_chat(title: str = "Temporary Chat") -> Chat:
+    global _bytes_held
     chat_id = str(uuid4())
     chat = Chat(
         chat_id=chat_id,
-        title="Temporary Chat",
+        title=title,
         created_at=datetime.utcnow(),
         updated_at=datetime.utcnow(),
         is_temporary=True
     )
-    temp_chats[chat_id] = chat
-    temp_messages[chat_id] = []
-    return chat_id
+    size = _CHAT_OVERHEAD_BYTES + len(title.encode("utf-8"))
+    _sessions[chat_id] = {"chat": chat, "messages": [], "bytes": size, "last_access": time.monotonic()}
+    _bytes_held += size
+    _enforce_budget(keep=chat_id)
+    return chat
 
-def add_temp_message(chat_id: str, message: Message):
-    if chat_id in temp_messages:
-        temp_messages[chat_id].append(message)
+def get_temp_chat(chat_id: str) -> Optional[Chat]:
+    session = _touch(chat_id)
+    return session["chat"] if session else None
+
+def list_temp_chats() -> List[Chat]:
+    chats = [s["chat"] for s in _sessions.values()]
+    chats.sort(key=lambda c: c.updated_at, reverse=True)
+    return chats
+
+def add_temp_message(chat_id: str, message: Message) -> bool:
+    global _bytes_held
+    session = _touch(chat_id)
+    if session is None:
+        return False
+    size = _message_bytes(message)
+    session["messages"].append(message)
+    session["bytes"] += size
+    session["chat"].updated_at = message.timestamp
+    _bytes_held += size
+    _enforce_budget(keep=chat_id)
+    return True
 
 def get_temp_messages(chat_id: str) -> List[Message]:
-    return temp_messages.get(chat_id, [])
+    session = _touch(chat_id)
+    return list(session["messages"]) if session else []
 
 def delete_temp_chat(chat_id: str):
-    temp_chats.pop(chat_id, None)
-    temp_messages.pop(chat_id, None)
+    _drop(chat_id)
+
+
+def sweep_idle() -> int:
+    """
+    Evicts sessions idle for longer than TEMP_CHAT_IDLE_TTL_SECONDS.
+    Sessions are kept in access order, so the scan stops at the first live one.
+    """
+    cutoff = time.monotonic() - TEMP_CHAT_IDLE_TTL_SECONDS
+    evicted = 0
+    while _sessions:
+        chat_id, session = next(iter(_sessions.items()))
+        if session["last_access"] > cutoff:
+            break
+        _drop(chat_id)
+        evicted += 1
+    _evicted["idle"] += evicted
+    return evicted
+
+
+async def _sweep_forever() -> None:
+    while True:
+        await asyncio.sleep(TEMP_CHAT_SWEEP_INTERVAL_SECONDS)
+        evicted = sweep_idle()
+        if evicted:
+            logger.info(f"Evicted {evicted} idle temporary chats; {len(_sessions)} live, {_bytes_held} bytes held")
+
+
+def start_sweeper() -> None:
+    global _sweeper
+    if _sweeper is None or _sweeper.done():
+        _sweeper = asyncio.create_task(_sweep_forever())
+
+
+async def stop_sweeper() -> None:
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        await asyncio.gather(_sweeper, return_exceptions=True)
+        _sweeper = None
+
+
+def stats() -> Dict[str, int]:
+    return {
+        "live_sessions": len(_sessions),
+        "bytes_held": _bytes_held,
+        "evicted_idle": _evicted["idle"],
+        "evicted_capacity": _evicted["capacity"],
+    }
@@ -0,0 +1,562 @@
+"""
+In-process inverted index over the knowledge collection for search_documents_text.
+
+Documents are tokenized like search queries (database.content_tokens, same stopwords
+and minimum length) over both keys and values, so a search for "nudity" still
+matches documents whose featureStatus has a Nudity flag. Results are ranked with
+BM25.
+
+Layout on disk (TEXT_INDEX_DIR/<collection>/):
+  manifest.json     document count, segment list, tailing position / resume token
+  doc_ids.jsonl     document id per document number, appended at each flush
+  lengths.bin       uint32 token count per document number
+  deleted.bin       uint32 numbers of deleted (or re-indexed) documents
+  seg-N.post        uint32 (doc, tf) pairs, grouped by term, memory-mapped
+  seg-N.terms.json  term -> [offset, count] into seg-N.post, terms sorted
+
+New documents go to an in-memory delta that is flushed into a new segment every
+TEXT_INDEX_FLUSH_DOCS documents; once there are more than TEXT_INDEX_MAX_SEGMENTS
+segments they are merged into one, dropping deleted documents. Freshness comes
+from a change stream ("change_stream", inserts, updates and deletes; needs a
+replica set) or from tailing ("tail", inserts only, see tailing.py), which
+also indexes any documents the tail skipped whenever the index holds fewer
+documents than the collection.
+"""
+import asyncio
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import threading
+from array import array
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from bson import json_util
+
+import tailing
+from database import content_tokens, tokenize_query
+from db import get_db
+
+logger = logging.getLogger(__name__)
+
+TEXT_INDEX_ENABLED = os.getenv("TEXT_INDEX_ENABLED", "true").lower() == "true"
+TEXT_INDEX_DIR = os.getenv("TEXT_INDEX_DIR", os.path.join(os.path.dirname(__file__), "cache", "text_index"))
+# "change_stream": follow inserts, updates and deletes. "tail": poll for new documents (see tailing.py).
+TEXT_INDEX_REFRESH = os.getenv("TEXT_INDEX_REFRESH", "change_stream").lower()
+TEXT_INDEX_REFRESH_SECONDS = float(os.getenv("TEXT_INDEX_REFRESH_SECONDS", "30"))
+TEXT_INDEX_PERSIST_SECONDS = float(os.getenv("TEXT_INDEX_PERSIST_SECONDS", "300"))
+TEXT_INDEX_BATCH_SIZE = int(os.getenv("TEXT_INDEX_BATCH_SIZE", "1000"))
+TEXT_INDEX_FLUSH_DOCS = int(os.getenv("TEXT_INDEX_FLUSH_DOCS", "50000"))
+TEXT_INDEX_MAX_SEGMENTS = int(os.getenv("TEXT_INDEX_MAX_SEGMENTS", "8"))
+# Terms with more postings than this only re-score candidates found by rarer terms.
+TEXT_INDEX_MAX_POSTINGS_SCAN = int(os.getenv("TEXT_INDEX_MAX_POSTINGS_SCAN", "200000"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+_MIN_TOKEN_LENGTH = 3
+# Bump when the on-disk layout changes; an index of another version is rebuilt.
+_LAYOUT_VERSION = 2
+
+_index: Optional["InvertedIndex"] = None
+_tasks: List[asyncio.Task] = []
+
+
+def document_terms(doc: Any) -> Counter:
+    """Term frequencies over every key and scalar value of a document."""
+    parts: List[str] = []
+    stack = [doc]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            for k, v in value.items():
+                stack.append(v)
+                parts.append(str(k))
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+        elif value is not None:
+            parts.append(str(value))
+    return Counter(content_tokens(" ".join(parts), min_length=_MIN_TOKEN_LENGTH))
+
+
+def _find_tf(postings: Any, doc: int) -> int:
+    """Binary search of a doc-sorted flat (doc, tf) posting list."""
+    lo, hi = 0, len(postings) // 2
+    while lo < hi:
+        mid = (lo + hi) // 2
+        current = postings[2 * mid]
+        if current == doc:
+            return postings[2 * mid + 1]
+        if current < doc:
+            lo = mid + 1
+        else:
+            hi = mid
+    return 0
+
+
+class _Segment:
+    """Immutable, memory-mapped posting lists; document numbers ascend within each term."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        with open(f"{prefix}.terms.json", "r", encoding="utf-8") as f:
+            self.terms: Dict[str, List[int]] = json.load(f)
+        self._file = open(f"{prefix}.post", "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size:
+            self._mm: Optional[mmap.mmap] = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.postings = memoryview(self._mm).cast("I")
+        else:
+            self._mm = None
+            self.postings = memoryview(array("I"))
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.prefix)
+
+    def postings_for(self, term: str) -> Optional[memoryview]:
+        entry = self.terms.get(term)
+        if entry is None:
+            return None
+        offset, count = entry
+        return self.postings[offset : offset + 2 * count]
+
+    def iter_terms(self) -> Iterator[Tuple[str, memoryview]]:
+        for term in self.terms:
+            yield term, self.postings_for(term)
+
+    @staticmethod
+    def write(prefix: str, terms: Iterator[Tuple[str, Any]]) -> "_Segment":
+        """Writes (term, flat postings) pairs, given in sorted term order."""
+        directory: Dict[str, List[int]] = {}
+        offset = 0
+        with open(f"{prefix}.post.tmp", "wb") as f:
+            for term, postings in terms:
+                count = len(postings) // 2
+                if not count:
+                    continue
+                array("I", postings).tofile(f)
+                directory[term] = [offset, count]
+                offset += 2 * count
+        with open(f"{prefix}.terms.json.tmp", "w", encoding="utf-8") as f:
+            json.dump(directory, f, separators=(",", ":"))
+        os.replace(f"{prefix}.post.tmp", f"{prefix}.post")
+        os.replace(f"{prefix}.terms.json.tmp", f"{prefix}.terms.json")
+        return _Segment(prefix)
+
+    def close(self) -> None:
+        try:
+            self.postings.release()
+            if self._mm is not None:
+                self._mm.close()
+        except BufferError:
+            pass  # a search still holds a slice; the map is freed with it
+        self._file.close()
+
+    def remove_files(self) -> None:
+        for suffix in (".post", ".terms.json"):
+            try:
+                os.remove(f"{self.prefix}{suffix}")
+            except FileNotFoundError:
+                pass
+
+
+def _tagged_terms(position: int, segment: _Segment) -> Iterator[Tuple[str, int, memoryview]]:
+    for term, postings in segment.iter_terms():
+        yield term, position, postings
+
+
+class InvertedIndex:
+    def __init__(self, collection: str, directory: str):
+        self.collection = collection
+        self.directory = directory
+        self.ready = False
+        self.doc_ids: List[Any] = []
+        self.id_to_num: Dict[Any, int] = {}
+        self.lengths = array("I")
+        self.deleted: set = set()
+        self.total_length = 0
+        self.segments: List[_Segment] = []
+        self.delta: Dict[str, array] = {}
+        self.delta_docs = 0
+        self._flushing: Dict[str, array] = {}
+        self.position: Any = None
+        self.resume_token: Any = None
+        # doc_ids entries already in doc_ids.jsonl, and that file's valid length.
+        self._persisted_docs = 0
+        self._ids_bytes = 0
+        self._next_segment = 0
+        self._changes = 0
+        self._saved_changes = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    @property
+    def live_docs(self) -> int:
+        return len(self.doc_ids) - len(self.deleted)
+
+    # -- updates ---------------------------------------------------------
+
+    def _tombstone(self, doc_id: Any) -> None:
+        num = self.id_to_num.pop(doc_id, None)
+        if num is not None and num not in self.deleted:
+            self.deleted.add(num)
+            self.total_length -= self.lengths[num]
+
+    def add_documents(self, docs: List[Dict[str, Any]], advance_tail: bool = False) -> None:
+        """Indexes (or re-indexes) documents. Tokenizing happens outside the lock."""
+        prepared = [(doc.get("_id"), document_terms(doc)) for doc in docs]
+        position = tailing.position_of(docs[-1]) if advance_tail and docs else None
+        with self._lock:
+            for doc_id, terms in prepared:
+                self._tombstone(doc_id)
+                num = len(self.doc_ids)
+                self.doc_ids.append(doc_id)
+                self.id_to_num[doc_id] = num
+                length = sum(terms.values())
+                self.lengths.append(length)
+                self.total_length += length
+                for term, tf in terms.items():
+                    postings = self.delta.get(term)
+                    if postings is None:
+                        postings = self.delta[term] = array("I")
+                    postings.append(num)
+                    postings.append(tf)
+                self.delta_docs += 1
+            self._changes += len(prepared)
+            if position is not None:
+                self.position = position
+
+    def remove_document(self, doc_id: Any) -> None:
+        with self._lock:
+            self._tombstone(doc_id)
+            self._changes += 1
+
+    # -- search ----------------------------------------------------------
+
+    def _postings(self, term: str) -> List[Any]:
+        sources = [s.postings_for(term) for s in self.segments]
+        sources.append(self._flushing.get(term))
+        sources.append(self.delta.get(term))
+        return [p for p in sources if p is not None and len(p)]
+
+    def search(self, query: str, limit: int) -> List[Any]:
+        """Document ids of the best BM25 matches for `query`, best first."""
+        tokens = tokenize_query(query)
+        if not tokens:
+            return []
+        with self._lock:
+            n = self.live_docs
+            if not n:
+                return []
+            avgdl = (self.total_length / n) or 1.0
+            per_term = []
+            for token in tokens:
+                lists = self._postings(token)
+                df = sum(len(p) // 2 for p in lists)
+                if df:
+                    per_term.append((df, token, lists))
+            per_term.sort(key=lambda t: t[0])
+
+            lengths, deleted = self.lengths, self.deleted
+            scores: Dict[int, float] = {}
+
+            def weight(tf: int, doc: int, idf: float) -> float:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc] / avgdl)
+                return idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+            for df, _token, lists in per_term:
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                if df > TEXT_INDEX_MAX_POSTINGS_SCAN and scores:
+                    # Too common to scan: only refine documents rarer terms already found.
+                    for doc in list(scores):
+                        tf = sum(_find_tf(p, doc) for p in lists)
+                        if tf:
+                            scores[doc] += weight(tf, doc, idf)
+                    continue
+                budget = TEXT_INDEX_MAX_POSTINGS_SCAN
+                for postings in lists:
+                    for i in range(0, min(len(postings), 2 * budget), 2):
+                        doc = postings[i]
+                        if doc in deleted:
+                            continue
+                        scores[doc] = scores.get(doc, 0.0) + weight(postings[i + 1], doc, idf)
+                    budget -= len(postings) // 2
+                    if budget <= 0:
+                        break
+
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [self.doc_ids[doc] for doc, _ in best]
+
+    # -- persistence -----------------------------------------------------
+
+    def _segment_prefix(self) -> str:
+        self._next_segment += 1
+        return os.path.join(self.directory, f"seg-{self._next_segment:06d}")
+
+    def _snapshot(self) -> Dict[str, Any]:
+        """Document state matching the postings about to be flushed (call under the lock)."""
+        self._saved_changes = self._changes
+        return {
+            "version": _LAYOUT_VERSION,
+            "collection": self.collection,
+            "doc_count": len(self.doc_ids),
+            "position": self.position,
+            "resume_token": self.resume_token,
+            "new_ids": self.doc_ids[self._persisted_docs:],
+            "deleted": array("I", sorted(self.deleted)),
+            "lengths": array("I", self.lengths),
+        }
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _save_manifest(self, snapshot: Dict[str, Any]) -> None:
+        lengths, deleted, new_ids = snapshot.pop("lengths"), snapshot.pop("deleted"), snapshot.pop("new_ids")
+        # Document ids never change number, so only the ones added since the last
+        # save are appended. Bytes past the recorded length (a crash after appending)
+        # are cut off first.
+        mode = "r+b" if os.path.exists(self._path("doc_ids.jsonl")) else "wb"
+        with open(self._path("doc_ids.jsonl"), mode) as f:
+            f.seek(self._ids_bytes)
+            f.truncate()
+            f.write("".join(json_util.dumps(doc_id) + "\n" for doc_id in new_ids).encode("utf-8"))
+            ids_bytes = f.tell()
+        with self._lock:
+            manifest = {
+                **snapshot,
+                "doc_ids_bytes": ids_bytes,
+                "segments": [s.name for s in self.segments],
+                "next_segment": self._next_segment,
+            }
+        for name, values in (("lengths.bin", lengths), ("deleted.bin", deleted)):
+            with open(self._path(f"{name}.tmp"), "wb") as f:
+                values.tofile(f)
+        with open(self._path("manifest.json.tmp"), "w", encoding="utf-8") as f:
+            f.write(json_util.dumps(manifest))
+        os.replace(self._path("lengths.bin.tmp"), self._path("lengths.bin"))
+        os.replace(self._path("deleted.bin.tmp"), self._path("deleted.bin"))
+        os.replace(self._path("manifest.json.tmp"), self._path("manifest.json"))
+        self._persisted_docs = snapshot["doc_count"]
+        self._ids_bytes = ids_bytes
+
+    def load(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "manifest.json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json_util.loads(f.read())
+            if manifest.get("collection") != self.collection:
+                raise ValueError(f"index belongs to '{manifest.get('collection')}'")
+            if manifest.get("version") != _LAYOUT_VERSION:
+                raise ValueError(f"layout version {manifest.get('version')}")
+            lengths, deleted = array("I"), array("I")
+            with open(self._path("lengths.bin"), "rb") as f:
+                lengths.frombytes(f.read())
+            with open(self._path("deleted.bin"), "rb") as f:
+                deleted.frombytes(f.read())
+            with open(self._path("doc_ids.jsonl"), "rb") as f:
+                raw_ids = f.read(manifest["doc_ids_bytes"])
+            doc_ids = [json_util.loads(line) for line in raw_ids.decode("utf-8").splitlines()]
+            if len(doc_ids) != manifest["doc_count"]:
+                raise ValueError("document ids do not match the manifest")
+            segments = [_Segment(self._path(name)) for name in manifest["segments"]]
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Rebuilding text index for '{self.collection}': {e}")
+            return
+
+        self.doc_ids = doc_ids
+        self.deleted = set(deleted)
+        self.lengths = lengths
+        self.segments = segments
+        self._next_segment = manifest["next_segment"]
+        self.position = manifest.get("position")
+        self.resume_token = manifest.get("resume_token")
+        self._persisted_docs = len(doc_ids)
+        self._ids_bytes = manifest["doc_ids_bytes"]
+        self.id_to_num = {doc_id: num for num, doc_id in enumerate(self.doc_ids) if num not in self.deleted}
+        self.total_length = sum(lengths) - sum(lengths[num] for num in self.deleted)
+        logger.info(f"Loaded text index for '{self.collection}': {self.live_docs} documents, {len(segments)} segments")
+
+    def flush(self) -> None:
+        """Writes the in-memory delta as a new segment, merging segments when there are too many."""
+        with self._flush_lock:
+            with self._lock:
+                if self._changes == self._saved_changes:
+                    return
+                pending = self._flushing = self.delta
+                self.delta = {}
+                self.delta_docs = 0
+                snapshot = self._snapshot()
+            if pending:
+                segment = _Segment.write(self._segment_prefix(), ((t, pending[t]) for t in sorted(pending)))
+                with self._lock:
+                    self.segments.append(segment)
+                    self._flushing = {}
+            if len(self.segments) > TEXT_INDEX_MAX_SEGMENTS:
+                self._merge()
+            self._save_manifest(snapshot)
+
+    def _merge(self) -> None:
+        with self._lock:
+            old = list(self.segments)
+            dropped = set(self.deleted)
+
+        def merged_terms() -> Iterator[Tuple[str, array]]:
+            # Segments hold increasing document numbers, so concatenating in segment
+            # order keeps every merged posting list sorted by document.
+            streams = [_tagged_terms(i, seg) for i, seg in enumerate(old)]
+            current, postings = None, array("I")
+            for term, _i, part in heapq.merge(*streams, key=lambda item: (item[0], item[1])):
+                if term != current:
+                    if current is not None:
+                        yield current, postings
+                    current, postings = term, array("I")
+                for j in range(0, len(part), 2):
+                    if part[j] not in dropped:
+                        postings.append(part[j])
+                        postings.append(part[j + 1])
+            if current is not None:
+                yield current, postings
+
+        merged = _Segment.write(self._segment_prefix(), merged_terms())
+        with self._lock:
+            self.segments = [merged]
+        for seg in old:
+            seg.close()
+            seg.remove_files()
+        logger.info(f"Merged {len(old)} text index segments for '{self.collection}'")
+
+
+async def _tail(index: InvertedIndex) -> int:
+    """Indexes every document after the tailing position."""
+    collection = get_db()[index.collection]
+    added = 0
+    while True:
+        query = tailing.position_filter(index.position)
+        docs = await collection.find(query).sort(tailing.sort_spec()).limit(TEXT_INDEX_BATCH_SIZE).to_list(length=TEXT_INDEX_BATCH_SIZE)
+        if not docs:
+            return added
+        await asyncio.to_thread(index.add_documents, docs, True)
+        added += len(docs)
+        if index.delta_docs >= TEXT_INDEX_FLUSH_DOCS:
+            await asyncio.to_thread(index.flush)
+
+
+async def _index_missing(index: InvertedIndex) -> int:
+    """
+    Indexes the documents the tail skipped, when the index holds fewer documents
+    than the collection: the tail misses inserts below its position whenever
+    TAIL_FIELD does not follow insertion order.
+    """
+    collection = get_db()[index.collection]
+    if await collection.estimated_document_count() <= index.live_docs:
+        return 0
+    added = 0
+    async for ids in tailing.iter_id_batches(collection, TEXT_INDEX_BATCH_SIZE):
+        missing = [doc_id for doc_id in ids if doc_id not in index.id_to_num]
+        if not missing:
+            continue
+        docs = await collection.find({"_id": {"$in": missing}}).to_list(length=len(missing))
+        await asyncio.to_thread(index.add_documents, docs)
+        added += len(docs)
+        if index.delta_docs >= TEXT_INDEX_FLUSH_DOCS:
+            await asyncio.to_thread(index.flush)
+    if added:
+        logger.info(f"Text index for '{index.collection}' picked up {added} documents the tail skipped")
+    return added
+
+
+async def _follow_change_stream(index: InvertedIndex) -> None:
+    collection = get_db()[index.collection]
+    kwargs: Dict[str, Any] = {"full_document": "updateLookup"}
+    if index.resume_token is not None:
+        kwargs["resume_after"] = index.resume_token
+    async with collection.watch(**kwargs) as stream:
+        # Catch up on inserts first; events that overlap with the tail simply re-index.
+        # Without a usable resume token, inserts made while the app was down may sit
+        # below the tailing position.
+        await _tail(index)
+        await _index_missing(index)
+        index.ready = True
+        async for change in stream:
+            op = change.get("operationType")
+            if op in ("insert", "update", "replace") and change.get("fullDocument"):
+                await asyncio.to_thread(index.add_documents, [change["fullDocument"]])
+            elif op in ("delete", "update", "replace"):
+                index.remove_document(change["documentKey"]["_id"])
+            elif op in ("drop", "rename", "invalidate"):
+                logger.warning(f"Text index source '{index.collection}' was {op}ped; stopping updates")
+                return
+            index.resume_token = stream.resume_token
+            if index.delta_docs >= TEXT_INDEX_FLUSH_DOCS:
+                await asyncio.to_thread(index.flush)
+
+
+async def _refresh_forever(index: InvertedIndex) -> None:
+    await asyncio.to_thread(index.load)
+    if TEXT_INDEX_REFRESH == "change_stream":
+        for attempt in range(2):
+            try:
+                await _follow_change_stream(index)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == 0 and index.resume_token is not None:
+                    # The token may have fallen off the oplog; start following from now.
+                    logger.info(f"Text index resume token rejected ({e}); reopening change stream")
+                    index.resume_token = None
+                    continue
+                logger.warning(f"Change stream unavailable ({e}); text index falls back to tailing")
+                break
+    while True:
+        try:
+            added = await _tail(index)
+            added += await _index_missing(index)
+            index.ready = True
+            if added:
+                logger.info(f"Text index for '{index.collection}' added {added} documents")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Text index refresh failed: {e}")
+        await asyncio.sleep(TEXT_INDEX_REFRESH_SECONDS)
+
+
+async def _persist_forever(index: InvertedIndex) -> None:
+    while True:
+        await asyncio.sleep(TEXT_INDEX_PERSIST_SECONDS)
+        try:
+            await asyncio.to_thread(index.flush)
+        except Exception as e:
+            logger.warning(f"Could not persist text index: {e}")
+
+
+def get_index(collection: str) -> Optional[InvertedIndex]:
+    """The index for `collection`, once its initial build has caught up."""
+    if _index is not None and _index.collection == collection and _index.ready:
+        return _index
+    return None
+
+
+def start(collection: str) -> None:
+    global _index
+    if not TEXT_INDEX_ENABLED or _tasks:
+        return
+    _index = InvertedIndex(collection, os.path.join(TEXT_INDEX_DIR, collection))
+    _tasks.append(asyncio.create_task(_refresh_forever(_index)))
+    _tasks.append(asyncio.create_task(_persist_forever(_index)))
+
+
+async def stop() -> None:
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    if _index is not None:
+        await asyncio.to_thread(_index.flush)
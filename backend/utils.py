@@ -1,18 +1,33 @@
-
+import re
 from datetime import datetime
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Set
 
 DATE_FIELDS = {"eventStartTime", "eventEndTime", "localDateTime"}
 
-def _parse_date_string(val: str) -> Any:
+# The collection's own format puts microseconds after a colon: 2025-06-10T00:01:15:005433
+_COLON_FRACTION = re.compile(r"^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}):(\d{1,6})$")
+
+
+def parse_timestamp(val: str) -> Optional[datetime]:
+    """
+    Parses ISO 8601 strings and the collection's colon-fraction format, or
+    returns None.
+    """
+    text = val.strip()
+    match = _COLON_FRACTION.match(text)
+    if match:
+        text = f"{match.group(1)}.{match.group(2).ljust(6, '0')}"
+    # Python fromisoformat doesn't like Z before 3.11
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
     try:
-        # Handle basic ISO format with Z
-        # Python fromisoformat doesn't like Z before 3.11
-        if val.endswith("Z"):
-            val = val.replace("Z", "+00:00")
-        return datetime.fromisoformat(val)
+        return datetime.fromisoformat(text)
     except ValueError:
-        return val
+        return None
+
+def _parse_date_string(val: str) -> Any:
+    parsed = parse_timestamp(val)
+    return parsed if parsed is not None else val
 
 def _convert_value_for_date(val: Any) -> Any:
     """
@@ -28,19 +43,20 @@ def _convert_value_for_date(val: Any) -> Any:
         return {k: _convert_value_for_date(v) for k, v in val.items()}
     return val
 
-def convert_dates(obj: Any) -> Any:
+def convert_dates(obj: Any, fields: Set[str] = DATE_FIELDS) -> Any:
     """
     Recursively scans for specific keys and converts their values to datetime objects.
+    A key matches when its last path component is in `fields`.
     """
     if isinstance(obj, list):
-        return [convert_dates(item) for item in obj]
+        return [convert_dates(item, fields) for item in obj]
     if isinstance(obj, dict):
         new_obj = {}
         for k, v in obj.items():
-            if k in DATE_FIELDS:
+            if k.rsplit(".", 1)[-1] in fields:
                 new_obj[k] = _convert_value_for_date(v)
             else:
-                new_obj[k] = convert_dates(v)
+                new_obj[k] = convert_dates(v, fields)
         return new_obj
     return obj
 
@@ -68,6 +68,9 @@ function formatMessageContent(raw) {
 
   if (mdRegex.test(raw)) {
     linked = raw.replace(mdRegex, (match, label, url) => {
+      if (url.includes('/reports/jobs/')) {
+        return `<span class="report-job" data-job-path="${url}">Preparing report...</span>`;
+      }
       const isReport = url.includes('/reports/');
       const className = isReport ? 'download-btn' : '';
       // Ensure URL is absolute if it's a report
@@ -90,6 +93,47 @@ function formatMessageContent(raw) {
   return linked;
 }
 
+const REPORT_POLL_MS = 2000;
+
+function describeJob(job) {
+  if (job.status === 'queued') return 'Report queued...';
+  const rows = `${job.rows_written.toLocaleString()} rows written`;
+  if (job.eta_seconds !== null && job.eta_seconds !== undefined) {
+    return `Generating report: ${rows}, about ${Math.ceil(job.eta_seconds)}s left...`;
+  }
+  return `Generating report: ${rows}...`;
+}
+
+/**
+ * Polls every report job placeholder in the transcript until the export
+ * finishes, then swaps it for a download link.
+ */
+function watchReportJobs() {
+  for (const el of messagesEl.querySelectorAll('.report-job:not([data-watching])')) {
+    el.dataset.watching = 'true';
+    const poll = async () => {
+      if (!document.body.contains(el)) return;
+      try {
+        const job = await api(el.dataset.jobPath);
+        if (job.status === 'done' && job.download_url) {
+          el.outerHTML = `<a href="${API_BASE}${job.download_url}" class="download-btn">Download Report</a>`;
+          return;
+        }
+        if (job.status === 'failed') {
+          el.textContent = `Report failed: ${job.error || 'unknown error'}`;
+          return;
+        }
+        el.textContent = describeJob(job);
+      } catch (err) {
+        el.textContent = `Report status unavailable: ${err.message}`;
+        return;
+      }
+      setTimeout(poll, REPORT_POLL_MS);
+    };
+    poll();
+  }
+}
+
 function typeText(element, text) {
   let index = 0;
   element.textContent = '';
@@ -105,6 +149,7 @@ function typeText(element, text) {
     } else {
       // Post-typing: use formatter
       element.innerHTML = formatMessageContent(element.textContent);
+      watchReportJobs();
     }
   }
   nextChar();
@@ -140,17 +185,23 @@ function renderMessages(messages) {
     }
   }
   messagesEl.scrollTop = messagesEl.scrollHeight;
+  watchReportJobs();
 }
 
 function showTypingIndicator() {
   hideTypingIndicator();
   typingEl = document.createElement('div');
   typingEl.className = 'msg assistant';
-  typingEl.innerHTML = '<div class="content-bubble typing"><span></span><span></span><span></span></div>';
+  typingEl.innerHTML = '<div class="content-bubble typing"><span></span><span></span><span></span><small class="typing-status"></small></div>';
   messagesEl.appendChild(typingEl);
   messagesEl.scrollTop = messagesEl.scrollHeight;
 }
 
+function setTypingStatus(text) {
+  const statusEl = typingEl && typingEl.querySelector('.typing-status');
+  if (statusEl) statusEl.textContent = text || '';
+}
+
 function hideTypingIndicator() {
   if (typingEl) {
     typingEl.remove();
@@ -236,6 +287,104 @@ async function api(path, options) {
   return data;
 }
 
+function parseSseEvent(raw) {
+  let event = 'message';
+  const dataLines = [];
+  for (const line of raw.split('\n')) {
+    if (line.startsWith('event:')) event = line.slice(6).trim();
+    else if (line.startsWith('data:')) dataLines.push(line.slice(5).replace(/^ /, ''));
+  }
+  if (dataLines.length === 0) return null;
+  try {
+    return { event, data: JSON.parse(dataLines.join('\n')) };
+  } catch (err) {
+    return { event, data: dataLines.join('\n') };
+  }
+}
+
+/**
+ * POSTs to a streaming endpoint and dispatches Server-Sent Events as they arrive.
+ * @param {string} path - Endpoint path.
+ * @param {object} body - JSON request body.
+ * @param {function} onEvent - Called with (event, data) for every event.
+ * @returns {Promise<object|null>} The payload of the final `done` event.
+ */
+async function apiStream(path, body, onEvent) {
+  const res = await fetch(`${API_BASE}${path}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', Accept: 'text/event-stream' },
+    body: JSON.stringify(body)
+  });
+  if (!res.ok || !res.body) {
+    const data = await res.json().catch(() => ({}));
+    throw new Error(typeof data.detail === 'string' ? data.detail : `HTTP ${res.status}`);
+  }
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let final = null;
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true }).replace(/\r\n/g, '\n');
+    let sep = buffer.indexOf('\n\n');
+    while (sep !== -1) {
+      const evt = parseSseEvent(buffer.slice(0, sep));
+      buffer = buffer.slice(sep + 2);
+      if (evt) {
+        if (evt.event === 'done') final = evt.data;
+        onEvent(evt.event, evt.data);
+      }
+      sep = buffer.indexOf('\n\n');
+    }
+  }
+  return final;
+}
+
+/**
+ * Streams an assistant reply into a new bubble, showing status updates until
+ * the first token arrives.
+ */
+async function streamAssistantReply(path, body, onChat) {
+  const message = { role: 'assistant', content: '' };
+  let bubble = null;
+  let streamError = null;
+
+  const final = await apiStream(path, body, (event, data) => {
+    if (event === 'chat' && onChat) {
+      onChat(data);
+    } else if (event === 'error') {
+      streamError = new Error(data.detail || 'The assistant is unavailable right now.');
+    } else if (event === 'status') {
+      setTypingStatus(data);
+    } else if (event === 'token') {
+      if (!bubble) {
+        hideTypingIndicator();
+        localMessages.push(message);
+        const div = document.createElement('div');
+        div.className = 'msg assistant';
+        bubble = document.createElement('div');
+        bubble.className = 'content-bubble';
+        div.appendChild(bubble);
+        messagesEl.appendChild(div);
+      }
+      message.content += data;
+      bubble.textContent = message.content;
+      messagesEl.scrollTop = messagesEl.scrollHeight;
+    }
+  });
+
+  hideTypingIndicator();
+  if (streamError) throw streamError;
+  if (final && final.response !== undefined && final.response !== '') {
+    message.content = final.response;
+    if (!bubble) localMessages.push(message);
+    renderMessages(localMessages);
+  }
+  return final;
+}
+
 async function loadChats() {
   try {
     const chats = await api('/chat/list');
@@ -247,10 +396,16 @@ async function loadChats() {
 
 async function loadMessages(chatId) {
   try {
-    const data = await api(`/chat/${chatId}`);
+    let data = await api(`/chat/${chatId}`);
     isTemporaryChat = Boolean(data.chat?.is_temporary);
     updateModeBadge();
-    localMessages = data.messages || [];
+    const messages = data.messages || [];
+    // History is paginated; follow the cursor until the whole chat is loaded.
+    while (data.next_cursor) {
+      data = await api(`/chat/${chatId}?cursor=${encodeURIComponent(data.next_cursor)}`);
+      messages.push(...(data.messages || []));
+    }
+    localMessages = messages;
     renderMessages(localMessages);
   } catch (err) {
     console.error('loadMessages:', err.message);
@@ -266,44 +421,22 @@ function resetToNew(isTemp) {
 }
 
 async function startChat(firstMessage) {
-  if (isTemporaryChat) {
-    localMessages = [{ role: 'user', content: firstMessage }];
-    renderMessages(localMessages);
-    showTypingIndicator();
+  localMessages = [{ role: 'user', content: firstMessage }];
+  renderMessages(localMessages);
+  showTypingIndicator();
 
-    const data = await api('/chat/new', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ first_message: firstMessage, is_temporary: true })
-    });
-    activeChatId = data.chat_id;
+  const onChat = (chat) => {
+    activeChatId = chat.chat_id;
     updateModeBadge();
+  };
 
-    const reply = await api('/chat/temp/message', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ chat_id: activeChatId, content: firstMessage })
+  if (isTemporaryChat) {
+    await apiStream('/chat/new/stream', { first_message: firstMessage, is_temporary: true }, (event, data) => {
+      if (event === 'chat') onChat(data);
     });
-
-    hideTypingIndicator();
-    localMessages.push({ role: 'assistant', content: reply.response, animate: true });
-    renderMessages(localMessages);
+    await streamAssistantReply('/chat/temp/message/stream', { chat_id: activeChatId, content: firstMessage });
   } else {
-    localMessages = [{ role: 'user', content: firstMessage }];
-    renderMessages(localMessages);
-    showTypingIndicator();
-
-    const data = await api('/chat/new', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ first_message: firstMessage, is_temporary: false })
-    });
-    activeChatId = data.chat_id;
-    updateModeBadge();
-
-    hideTypingIndicator();
-    localMessages.push({ role: 'assistant', content: data.response || '...', animate: true });
-    renderMessages(localMessages);
+    await streamAssistantReply('/chat/new/stream', { first_message: firstMessage, is_temporary: false }, onChat);
     await loadChats();
   }
 }
@@ -314,32 +447,14 @@ async function sendMessage(content) {
     return;
   }
 
-  if (isTemporaryChat) {
-    localMessages.push({ role: 'user', content });
-    renderMessages(localMessages);
-    showTypingIndicator();
-
-    const reply = await api('/chat/temp/message', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ chat_id: activeChatId, content })
-    });
+  localMessages.push({ role: 'user', content });
+  renderMessages(localMessages);
+  showTypingIndicator();
 
-    hideTypingIndicator();
-    localMessages.push({ role: 'assistant', content: reply.response, animate: true });
-    renderMessages(localMessages);
+  if (isTemporaryChat) {
+    await streamAssistantReply('/chat/temp/message/stream', { chat_id: activeChatId, content });
   } else {
-    localMessages.push({ role: 'user', content });
-    renderMessages(localMessages);
-    showTypingIndicator();
-    const reply = await api(`/chat/${activeChatId}/message`, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ content, role: 'user' })
-    });
-    hideTypingIndicator();
-    localMessages.push({ role: 'assistant', content: reply.response, animate: true });
-    renderMessages(localMessages);
+    await streamAssistantReply(`/chat/${activeChatId}/message/stream`, { content, role: 'user' });
     await loadChats();
   }
 }